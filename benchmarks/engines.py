@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Compare the overhead of the bugjar-net tracing engines.
+
+Runs a CPU-bound script natively, and then under each of the tracing
+engines. The script stops once, at a breakpoint after its functions have
+been defined, and is then continued with a second breakpoint set on a line
+that is never reached. This is the situation of a program that has been
+set running under bugjar-net: no client is stopped, but a breakpoint is
+waiting to be hit.
+
+Usage:
+
+    $ python benchmarks/engines.py [--repeat N]
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bugjar.net import ENGINES, monitoring  # noqa
+
+
+SCRIPT = '''\
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def busy(count):
+    total = 0
+    for i in range(count):
+        total += i % 7
+    return total
+
+
+def never_called():
+    return 42  # BREAKPOINT
+
+
+def ready():
+    return 0  # BREAKPOINT
+
+
+ready()
+fib(22)
+busy(300000)
+'''
+
+
+def benchmark_mixin(engine):
+    "Construct a headless version of an engine that never stops."
+    class Benchmark(engine):
+        def output(self, event, **data):
+            pass
+
+        def interaction(self, frame, tb):
+            self.set_continue()
+
+    return Benchmark
+
+
+def run_native(code):
+    start = time.time()
+    exec(code, {'__name__': '__main__'})
+    return time.time() - start
+
+
+def run_engine(engine, filename, code):
+    debugger = benchmark_mixin(engine)(None, None, None)
+    for line_no, line in enumerate(SCRIPT.splitlines(), 1):
+        if line.endswith('# BREAKPOINT'):
+            debugger.do_break(filename, line_no)
+    start = time.time()
+    debugger.run(code, {'__name__': '__main__'})
+    elapsed = time.time() - start
+    debugger.clear_all_breaks()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each engine (default=5)')
+    options = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.py')
+    with os.fdopen(fd, 'w') as f:
+        f.write(SCRIPT)
+
+    try:
+        code = compile(SCRIPT, filename, 'exec')
+
+        native = min(run_native(code) for i in range(options.repeat))
+        print('%-12s %8.3fs' % ('native', native))
+
+        for name in sorted(ENGINES):
+            if name == 'monitoring' and monitoring is None:
+                print('%-12s (requires Python 3.12+)' % name)
+                continue
+            elapsed = min(run_engine(ENGINES[name], filename, code) for i in range(options.repeat))
+            print('%-12s %8.3fs  %5.1fx' % (name, elapsed, elapsed / native))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
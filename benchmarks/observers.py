@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Measure how observers affect the client in control of a session.
+
+Starts bugjar-net on a script with a lot of globals (so every stack an
+observer is sent is large), connects a client that takes control, and
+times how long each step (over a line of the script's loop) takes to
+reach it: with no observers, with observers that read everything they
+are sent, and with observers that stop reading once they have been
+greeted (a GUI that has hung, say). Observers connect the way the jar
+does, and choose the same protocol. A stalled observer shouldn't slow the controller down,
+however far behind it falls; nor should it be disconnected, since it is
+only sent the latest stack. The last run steps stalled observers more
+times than a client can have messages waiting, to show that they stay
+connected. Requires Python 3.
+
+Usage:
+
+    $ python benchmarks/observers.py [--steps N] [--observers N] [--long-steps N]
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bugjar.connection import Debugger  # noqa
+from bugjar.hub import MAX_QUEUED  # noqa
+
+SCRIPT = '''\
+globals().update(('variable_%d' % i, list(range(i, i + 10))) for i in range(20000))
+
+
+def double(i):
+    x = i * 2
+    return x
+
+
+total = 0
+for i in range(1000000):
+    total += double(i)
+'''
+
+
+class Stops(object):
+    "A view that notes when a stack arrives, and ignores everything else."
+    def __init__(self):
+        self.stopped = Event()
+
+    def on_stack(self, **data):
+        self.stopped.set()
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class Stalled(Stops):
+    "A view that hangs when it is shown the first stack, until it is released."
+    def __init__(self, released):
+        super(Stalled, self).__init__()
+        self.released = released
+
+    def on_stack(self, **data):
+        self.released.wait()
+
+
+def observe(path, read, released):
+    """Connect an observer; it reads (and ignores) everything, or stops
+    reading at the first stack until `released` is set.
+    """
+    observer = Debugger(None, None, path=path, timeout=30)
+    observer.view = Stops() if read else Stalled(released)
+    observer.start()
+    return observer
+
+
+def session(directory, observers, read, steps):
+    """Step a session `steps` times; returns the median and worst time per
+    step, and the number of observers still connected at the end.
+    """
+    path = os.path.join(directory, 'net.sock')
+    ready_fd, write_fd = os.pipe()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    proc = subprocess.Popen([
+        sys.executable, '-c', 'from bugjar.main import net; net()',
+        '--socket', path, '--ready-fd', str(write_fd), os.path.join(directory, 'script.py')
+    ], env=env, stdout=subprocess.DEVNULL, pass_fds=(write_fd,))
+    os.close(write_fd)
+
+    debugger = Debugger(None, None, proc=proc, path=path, ready_fd=ready_fd, timeout=30)
+    view = debugger.view = Stops()
+    debugger.start()
+    view.stopped.wait(30)
+    # Step over the line that creates the globals, into the loop.
+    view.stopped.clear()
+    debugger.do_next()
+    view.stopped.wait(30)
+    released = Event()
+    clients = [observe(path, read, released) for i in range(observers)]
+    # Let the observers be greeted.
+    time.sleep(0.5)
+
+    times = []
+    for i in range(steps):
+        view.stopped.clear()
+        start = time.time()
+        debugger.do_next()
+        view.stopped.wait(30)
+        times.append(time.time() - start)
+    connected = len(debugger.clients) - 1
+
+    released.set()
+    debugger.output('quit')
+    proc.wait()
+    for client in clients:
+        client.socket.close()
+    times.sort()
+    return times[len(times) // 2], times[-1], connected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--steps', type=int, default=200, help='Number of steps in each session (default=200)')
+    parser.add_argument('--observers', type=int, default=2, help='Number of observers (default=2)')
+    parser.add_argument('--long-steps', type=int, default=MAX_QUEUED + 1000,
+                        help='Number of steps in the long session with stalled observers (default=%d)' % (
+                            MAX_QUEUED + 1000))
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bugjar-')
+    try:
+        with open(os.path.join(directory, 'script.py'), 'w') as f:
+            f.write(SCRIPT)
+
+        for name, observers, read, steps in [
+                ('no observers', 0, True, options.steps),
+                ('reading observers', options.observers, True, options.steps),
+                ('stalled observers', options.observers, False, options.steps),
+                ('stalled, long', options.observers, False, options.long_steps)]:
+            median, worst, connected = session(directory, observers, read, steps)
+            print('%-18s %6d steps %7.2fms per step (median), %7.2fms (worst), %d/%d observers connected' % (
+                name, steps, median * 1000, worst * 1000, connected, observers
+            ))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
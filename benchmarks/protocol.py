@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""Compare the cost of large messages with each framing and codec.
+
+Sends a stack event of (roughly) the given size over a local socket, and
+measures how long it takes to receive and decode it: with the original
+reader (which read 1024 bytes at a time, and concatenated everything it
+had received so far), and with the protocol channel, using both the
+original ETX framing and length-prefixed framing. Then measures how long
+each of the codecs available here takes to encode and decode the event,
+and how small (and how quickly) each compression makes it at a few levels.
+
+Usage:
+
+    $ python benchmarks/protocol.py [--size MB] [--repeat N]
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bugjar.protocol import (  # noqa
+    CODECS, COMPRESSIONS, ETX, ETX_FRAMING, LENGTH_FRAMING, Channel, JSONCodec, timer
+)
+
+# The levels of each compression to measure.
+LEVELS = {
+    'zlib': [1, 6, 9],
+    'zstd': [1, 3, 9],
+}
+
+
+def stack_event(size):
+    "A stack event, with enough locals to encode to about `size` bytes."
+    variables = {}
+    for i in range(size // 90):
+        variables['variable_%06d' % i] = repr(list(range(i, i + 12)))
+    frames = [
+        ['/path/to/module.py', line, 'function_%s' % line, variables if line == 1 else {}, {}, {}]
+        for line in range(1, 21)
+    ]
+    return 'stack', {'stack': frames, 'thread': 1}
+
+
+def original_reader(sock):
+    "The reader that bugjar used before messages could be length-prefixed"
+    remainder = b''
+    while True:
+        new_buffer = sock.recv(1024)
+        if not new_buffer:
+            break
+        full_buffer = remainder + new_buffer
+        messages = full_buffer.split(ETX)
+        remainder = messages.pop()
+        for message in messages:
+            return json.loads(message.decode('utf8'))
+
+
+def channel_reader(sock, framing):
+    channel = Channel(sock)
+    channel.framing_in = framing
+    for payload in channel.payloads():
+        return channel.unpack(payload)
+
+
+def receive(reader, framing, event):
+    "Send an event to `reader`, and time how long it takes to be decoded."
+    sender, receiver = socket.socketpair()
+    channel = Channel(sender)
+    channel.framing_out = framing
+    message = channel.pack(*event)
+
+    thread = threading.Thread(target=sender.sendall, args=(message,))
+    start = time.time()
+    thread.start()
+    result = reader(receiver)
+    elapsed = time.time() - start
+
+    thread.join()
+    sender.close()
+    receiver.close()
+    assert result[0] == event[0]
+    return len(message), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=float, default=10, help='Size of the stack message, in MB (default=10)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each reader (default=3)')
+    options = parser.parse_args()
+
+    event = stack_event(int(options.size * 1024 * 1024))
+    readers = [
+        ('original', original_reader, ETX_FRAMING),
+        ('channel (etx)', lambda sock: channel_reader(sock, ETX_FRAMING), ETX_FRAMING),
+        ('channel (length)', lambda sock: channel_reader(sock, LENGTH_FRAMING), LENGTH_FRAMING),
+    ]
+    for name, reader, framing in readers:
+        results = [receive(reader, framing, event) for i in range(options.repeat)]
+        size = results[0][0]
+        elapsed = min(elapsed for size, elapsed in results)
+        print('%-18s %6.1fMB %8.3fs  %8.1fMB/s' % (name, size / 1048576.0, elapsed, size / 1048576.0 / elapsed))
+
+    print()
+    for codec in CODECS:
+        encode_time = decode_time = None
+        for i in range(options.repeat):
+            start = timer()
+            payload = codec.encode(event)
+            encoded = timer()
+            codec.decode(payload)
+            decoded = timer()
+            encode_time = min(encode_time or encoded - start, encoded - start)
+            decode_time = min(decode_time or decoded - encoded, decoded - encoded)
+        print('%-18s %6.1fMB  encode %6.3fs  decode %6.3fs' % (
+            codec.name, len(payload) / 1048576.0, encode_time, decode_time
+        ))
+
+    print()
+    payload = JSONCodec.encode(event)
+    for compression in COMPRESSIONS:
+        for level in LEVELS[compression.name]:
+            compressor = compression(level)
+            compress_time = decompress_time = None
+            for i in range(options.repeat):
+                start = timer()
+                compressed = compressor.compress(payload)
+                compressed_at = timer()
+                compressor.decompress(compressed)
+                decompressed_at = timer()
+                compress_time = min(compress_time or compressed_at - start, compressed_at - start)
+                decompress_time = min(decompress_time or decompressed_at - compressed_at, decompressed_at - compressed_at)
+            print('%-18s %6.1fMB  %5.1f%%  compress %6.3fs  decompress %6.3fs' % (
+                '%s (level %s)' % (compression.name, level), len(compressed) / 1048576.0,
+                100.0 * len(compressed) / len(payload), compress_time, decompress_time
+            ))
+
+
+if __name__ == '__main__':
+    main()
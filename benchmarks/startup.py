@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Measure the time from starting a session to its first stop.
+
+Starts bugjar-net on a small script, connects to it the way the `bugjar`
+command does, and measures how long it takes until the net is connected,
+and until the first stack (the stop at the first line of the script) has
+been received: with the readiness handshake (on an inherited pipe, and
+with a ready file), and with the sleep-and-retry startup bugjar used to
+have (sleep for 0.1s, then try to connect once a second). Requires
+Python 3.
+
+Usage:
+
+    $ python benchmarks/startup.py [--repeat N] [--tcp]
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bugjar.connection import Debugger  # noqa
+
+SCRIPT = '''\
+total = 0
+for i in range(10):
+    total += i
+'''
+
+# The port to use with --tcp.
+PORT = 3742
+
+
+class FirstStop(object):
+    "A view that notes when the first stack arrives, and ignores everything else."
+    def __init__(self):
+        self.stopped = Event()
+
+    def on_stack(self, **data):
+        self.stopped.set()
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class SleepAndRetry(Debugger):
+    "A connection that starts the way bugjar used to: by trying once a second."
+    def connect(self, deadline=None):
+        while True:
+            try:
+                self.socket = socket.socket(self.family, socket.SOCK_STREAM)
+                self.socket.connect(self.address)
+                return
+            except socket.error:
+                self.socket.close()
+                time.sleep(1.0)
+
+
+def start_session(directory, method, tcp):
+    "Start a net, and connect to it; returns (connected, first stop) times."
+    if tcp:
+        address_args = ['--host', '127.0.0.1', '--port', str(PORT)]
+        path = None
+    else:
+        path = os.path.join(directory, 'net.sock')
+        address_args = ['--socket', path]
+    command = [
+        sys.executable, '-c', 'from bugjar.main import net; net()'
+    ] + address_args
+    ready_fd = ready_file = None
+    popen_args = {}
+    if method == 'ready pipe':
+        ready_fd, write_fd = os.pipe()
+        command += ['--ready-fd', str(write_fd)]
+        popen_args['pass_fds'] = (write_fd,)
+    elif method == 'ready file':
+        ready_file = os.path.join(directory, 'ready')
+        command += ['--ready-file', ready_file]
+    command.append(os.path.join(directory, 'script.py'))
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+
+    start = time.time()
+    proc = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, **popen_args)
+    if method == 'ready pipe':
+        os.close(write_fd)
+    if method == 'sleep and retry':
+        time.sleep(0.1)
+        debugger = SleepAndRetry('127.0.0.1', PORT, proc=proc, path=path)
+        debugger.family, debugger.address = (
+            (socket.AF_INET, ('127.0.0.1', PORT)) if tcp else (socket.AF_UNIX, path)
+        )
+    else:
+        debugger = Debugger(
+            '127.0.0.1', PORT, proc=proc, path=path,
+            ready_fd=ready_fd, ready_file=ready_file, timeout=30
+        )
+    view = debugger.view = FirstStop()
+    debugger.start()
+    connected = time.time()
+    view.stopped.wait(30)
+    stopped = time.time()
+
+    debugger.output('quit')
+    proc.wait()
+    for name in ('net.sock', 'ready'):
+        if os.path.exists(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
+    return connected - start, stopped - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Number of sessions started each way (default=5)')
+    parser.add_argument('--tcp', action='store_true', help='Connect over TCP, rather than a Unix domain socket')
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bugjar-')
+    try:
+        with open(os.path.join(directory, 'script.py'), 'w') as f:
+            f.write(SCRIPT)
+
+        for method in ['ready pipe', 'ready file', 'sleep and retry']:
+            results = [start_session(directory, method, options.tcp) for i in range(options.repeat)]
+            connected = sorted(result[0] for result in results)
+            stopped = sorted(result[1] for result in results)
+            print('%-16s connected %6.3fs (median)  first stop %6.3fs (median), %6.3fs (worst)' % (
+                method, connected[len(connected) // 2], stopped[len(stopped) // 2], stopped[-1]
+            ))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
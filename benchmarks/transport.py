@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Compare the latency of a stop with each local transport.
+
+Measures how long it takes from the moment the net starts to encode a
+stack event, to the moment the client has decoded it (so, from the stop
+to the point where the jar could paint it), for stacks of a few sizes:
+over TCP on the loopback interface (which the `bugjar` command used to
+use), over a Unix domain socket, and over a Unix domain socket with large
+messages going through a ring buffer in shared memory. Both ends run in
+this process, in separate threads.
+
+Usage:
+
+    $ python benchmarks/transport.py [--sizes MB,...] [--repeat N]
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bugjar.protocol import (  # noqa
+    CODECS, LENGTH_FRAMING, Channel, SharedRing, shared_memory, timer
+)
+
+# The size of the shared memory ring, in bytes.
+RING_SIZE = 256 * 1024 * 1024
+
+
+def stack_event(size):
+    "A stack event, with enough locals to encode to about `size` bytes."
+    variables = {}
+    for i in range(max(1, size // 90)):
+        variables['variable_%06d' % i] = repr(list(range(i, i + 12)))
+    frames = [
+        ['/path/to/module.py', line, 'function_%s' % line, variables if line == 1 else {}, {}, {}]
+        for line in range(1, 21)
+    ]
+    return 'stack', {'stack': frames, 'thread': 1}
+
+
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, addr = listener.accept()
+    listener.close()
+    return server, client
+
+
+def unix_pair(directory):
+    path = os.path.join(directory, 'net.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    server, addr = listener.accept()
+    listener.close()
+    os.remove(path)
+    return server, client
+
+
+def latency(pair, event, repeat, shared=False):
+    """The shortest time, over `repeat` stops, from starting to encode
+    `event` at one end of a connection to having decoded it at the other.
+    """
+    server, client = pair
+    codec = CODECS[0]
+    sender, receiver = Channel(server), Channel(client)
+    for channel in (sender, receiver):
+        channel.framing_in = channel.framing_out = LENGTH_FRAMING
+        channel.codec_in = channel.codec_out = codec
+    if shared:
+        sender.shared_out = SharedRing.create(RING_SIZE)
+        # Both ends are in this process, so the reader can't use attach()
+        # (which leaves removing the memory to another process).
+        receiver.shared_in = SharedRing(shared_memory.SharedMemory(sender.shared_out.name))
+
+    times = []
+    received = threading.Event()
+
+    def receive():
+        for payload in receiver.payloads():
+            receiver.unpack(payload)
+            times.append(timer())
+            received.set()
+
+    thread = threading.Thread(target=receive)
+    thread.daemon = True
+    thread.start()
+
+    best = None
+    for i in range(repeat):
+        received.clear()
+        start = timer()
+        server.sendall(sender.pack(*event))
+        received.wait()
+        elapsed = times[-1] - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    server.shutdown(socket.SHUT_WR)
+    thread.join()
+    server.close()
+    client.close()
+    sender.close()
+    receiver.close()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='0.001,0.1,1,10',
+                        help='Sizes of the stack message, in MB (default=0.001,0.1,1,10)')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of stops at each size (default=5)')
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bugjar-')
+    try:
+        transports = [('tcp', tcp_pair, False)]
+        if hasattr(socket, 'AF_UNIX'):
+            transports.append(('unix', lambda: unix_pair(directory), False))
+            if shared_memory is not None:
+                transports.append(('unix + shared memory', lambda: unix_pair(directory), True))
+
+        print('codec: %s' % CODECS[0].name)
+        for size in options.sizes.split(','):
+            event = stack_event(int(float(size) * 1024 * 1024))
+            for name, pair, shared in transports:
+                elapsed = latency(pair(), event, options.repeat, shared)
+                print('%-8s %-22s %9.2fms' % ('%sMB' % size, name, elapsed * 1000))
+            print()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Measure the overhead of data watchpoints in bugjar-net.
+
+Runs a loop-heavy script natively, and then under each of the tracing
+engines: with no watchpoint, with a watchpoint on an attribute that the
+loops never mention, and with a watchpoint on a global that one of the
+loops changes (rarely). Only code that mentions a watched name is
+checked, so the first watchpoint should cost (almost) nothing; the
+second is checked on every line of that loop.
+
+The script stops at a breakpoint after its functions have been defined;
+that's where the watchpoint is set. Every time the watchpoint
+is hit, the script is continued.
+
+Usage:
+
+    $ python benchmarks/watchpoints.py [--repeat N]
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bugjar.net import ENGINES, monitoring  # noqa
+
+
+SCRIPT = '''\
+class Machine(object):
+    state = 'idle'
+
+
+machine = Machine()
+hits = 0
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def busy(count):
+    total = 0
+    for i in range(count):
+        total += i % 7
+    return total
+
+
+def tally(count):
+    global hits
+    for i in range(count):
+        if i % 50000 == 0:
+            hits += 1
+    return hits
+
+
+def ready():
+    return 0  # BREAKPOINT
+
+
+ready()
+fib(22)
+busy(300000)
+tally(300000)
+'''
+
+WATCHPOINTS = [
+    ('none', None),
+    ('untouched', 'machine.state'),
+    ('hot loop', 'hits'),
+]
+
+
+def benchmark_mixin(engine, expression):
+    "Construct a headless version of an engine that sets a watchpoint, and never stops."
+    class Benchmark(engine):
+        def output(self, event, **data):
+            if event == 'error':
+                raise RuntimeError(data['message'])
+
+        def interaction(self, frame, tb):
+            if expression and frame is not None and frame.f_code.co_name == 'ready':
+                self.setup(frame, tb)
+                self.do_watchpoint(expression)
+                self.forget()
+            self.set_continue()
+
+    return Benchmark
+
+
+def run_native(code):
+    start = time.time()
+    exec(code, {'__name__': '__main__'})
+    return time.time() - start
+
+
+def run_engine(engine, expression, filename, code):
+    debugger = benchmark_mixin(engine, expression)(None, None, None)
+    for line_no, line in enumerate(SCRIPT.splitlines(), 1):
+        if line.endswith('# BREAKPOINT'):
+            debugger.do_break(filename, line_no)
+    start = time.time()
+    try:
+        debugger.run(code, {'__name__': '__main__'})
+    finally:
+        if debugger.watchpoints is not None:
+            debugger.watchpoints.stop()
+    elapsed = time.time() - start
+    debugger.clear_all_breaks()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each engine (default=5)')
+    options = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.py')
+    with os.fdopen(fd, 'w') as f:
+        f.write(SCRIPT)
+
+    try:
+        code = compile(SCRIPT, filename, 'exec')
+
+        native = min(run_native(code) for i in range(options.repeat))
+        print('%-24s %8.3fs' % ('native', native))
+
+        for name in sorted(ENGINES):
+            if name == 'monitoring' and monitoring is None:
+                print('%-24s (requires Python 3.12+)' % name)
+                continue
+            for label, expression in WATCHPOINTS:
+                title = '%s (%s)' % (name, label)
+                if expression and monitoring is None and not ENGINES[name].OBSERVES_LINES:
+                    print('%-24s (requires Python 3.12+)' % title)
+                    continue
+                elapsed = min(run_engine(ENGINES[name], expression, filename, code) for i in range(options.repeat))
+                print('%-24s %8.3fs  %5.1fx' % (title, elapsed, elapsed / native))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
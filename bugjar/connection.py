@@ -1,8 +1,17 @@
 from __future__ import print_function, unicode_literals
-import json
+import os
+import select
 import socket
 import time
-from threading import Thread
+from itertools import count
+from threading import Event, Lock, Thread
+
+from bugjar.heatmap import decode_counts
+from bugjar.profiler import Profile
+from bugjar.protocol import (
+    CODEC_NAMES, FEATURES, FRAMINGS, REQUESTS, SHARED_MEMORY, Channel, SharedRing, choose, get_codec,
+    get_compression, patch_frame, patch_namespace
+)
 
 
 class UnknownBreakpoint(Exception):
@@ -13,14 +22,34 @@ class ConnectionNotBootstrapped(Exception):
     pass
 
 
+class ConnectionFailed(Exception):
+    pass
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class RequestTimeout(Exception):
+    pass
+
+
 class Breakpoint(object):
-    def __init__(self, bpnum, filename, line, enabled=True, temporary=False, funcname=None):
+    def __init__(self, bpnum, filename, line, enabled=True, temporary=False, funcname=None,
+                 condition=None, log=None, hits=0, evaluations=0, eval_time=0.0):
         self.bpnum = bpnum
         self.filename = filename
         self.line = line
         self.enabled = enabled
         self.temporary = temporary
         self.funcname = funcname
+        self.condition = condition
+        self.log = log
+
+        # Statistics reported by the debugger
+        self.hits = hits
+        self.evaluations = evaluations
+        self.eval_time = eval_time
 
     def __str__(self):
         return str('%s:%s' % (self.filename, self.line))
@@ -29,40 +58,99 @@ class Breakpoint(object):
         return '%s:%s' % (self.filename, self.line)
 
 
-def command_buffer(debugger):
-    "Buffer input from a socket, yielding complete command packets."
-    remainder = b''
-    while True:
-        new_buffer = debugger.socket.recv(1024)
-
-        if not new_buffer:
-            # If recv() returns None, the socket has closed
-            break
-        else:
-            # print "CLIENT NEW BUFFER: %s >%s<" % (len(new_buffer), new_buffer[:50])
-            if new_buffer[-1] == debugger.ETX:
-                terminator = new_buffer[-1]
-                full_buffer = remainder + new_buffer[:-1]
-            else:
-                terminator = None
-                full_buffer = remainder + new_buffer
+class Watch(object):
+    KIND = 'watch'
 
-            messages = full_buffer.split(debugger.ETX)
-            if terminator is None:
-                remainder = messages.pop()
-            else:
-                remainder = ''
-            for message in messages:
-                # print "READ %s bytes" % len(message)
-                message = message.decode('utf8')
-                event, data = json.loads(message)
+    def __init__(self, number, expression, value=None):
+        self.number = number
+        self.expression = expression
+        # The value in the current frame, as reported by the debugger
+        self.value = value
+
+
+class Watchpoint(Watch):
+    KIND = 'watchpoint'
+
+
+class Request(object):
+    """A command sent to the debugger, and its reply.
+
+    Every event the debugger sends while running the command is collected
+    in `events`, as (event, data) pairs; if one of them is an error, its
+    message is the `error`. The request is done once the debugger has
+    finished the command. If the debugger can't tell which command an
+    event belongs to (an older debugger, or a command sent before the
+    protocol was agreed), the request is done as soon as it is sent.
+
+    Callbacks are called with the request, in the thread that reads from
+    the debugger (or straight away, if the request is already done).
+    """
+    def __init__(self, command, args, id=None):
+        self.command = command
+        self.args = args
+        self.id = id
+        self.events = []
+        self.error = None
+        self._done = Event()
+        self._callbacks = []
+        self._lock = Lock()
 
-                if hasattr(debugger, 'on_%s' % event):
-                    getattr(debugger, 'on_%s' % event)(**data)
-                else:
-                    print("Unknown server event:", event)
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        "Wait until the request is done; returns False if it timed out"
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """The events sent in reply to the request, once it is done.
+
+        Raises RequestTimeout if it isn't done within `timeout` seconds,
+        and RequestFailed if the debugger reported an error.
+        """
+        if not self.wait(timeout):
+            raise RequestTimeout('No reply to %s after %ss' % (self.command, timeout))
+        if self.error is not None:
+            raise RequestFailed(self.error)
+        return self.events
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def finish(self, error=None):
+        if error is not None and self.error is None:
+            self.error = error
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def command_buffer(debugger):
+    "Read event packets from the debugger, and dispatch them."
+    channel = debugger.channel
+    for message in channel.payloads():
+        # print "READ %s bytes" % len(message)
+        event, data = channel.unpack(message)
+
+        request = data.pop('request', None)
+        if request is not None and debugger.reply(request, event, data):
+            continue
+
+        if hasattr(debugger, 'on_%s' % event):
+            getattr(debugger, 'on_%s' % event)(**data)
+        else:
+            print("Unknown server event:", event)
 
     # print "FINISH PROCESSING CLIENT COMMAND BUFFER"
+    channel.close()
+    debugger.cancel_requests()
 
 
 class Debugger(object):
@@ -70,32 +158,151 @@ class Debugger(object):
 
     ETX = b'\x03'
 
-    def __init__(self, host, port, proc=None):
+    def __init__(self, host, port, proc=None, codecs=None, compression=None,
+                 compress_level=None, compress_threshold=None, features=None,
+                 path=None, shared_memory=None, ready_fd=None, ready_file=None, timeout=None):
         self.host = host
         self.port = port
+        # If the debugger is listening on a Unix domain socket, its path.
+        self.path = path
 
         self.proc = proc
 
+        # If this session started the debugger, how it will say it is
+        # ready: the read end of a pipe, or a file that will appear.
+        self.ready_fd = ready_fd
+        self.ready_file = ready_file
+        # The longest (in seconds) to wait for the debugger, or None to
+        # wait forever.
+        self.timeout = timeout
+
+        # The protocol spoken with the debugger, and the codecs
+        # we would like it to use, in order of preference.
+        self.channel = None
+        self.codecs = codecs or CODEC_NAMES
+        # The compression to ask for (if any), and how to use it.
+        self.compression = compression
+        self.compress_level = compress_level
+        self.compress_threshold = compress_threshold
+        # The optional features of the protocol we'd like to use.
+        self.features = FEATURES if features is None else features
+        # The size of the shared memory to ask for (if any), for large
+        # messages from a debugger on this machine.
+        self.shared_memory = shared_memory
+        # The channel's decoding time when the debugger last sent stats.
+        self._decode_time = 0.0
+        # The GUI and the reading thread can both send.
+        self._send_lock = Lock()
+        # Request id -> the Request waiting for its reply.
+        self._requests = {}
+        self._request_ids = count(1)
+        # Thread ident -> {frame id: description} for the frames of the
+        # last stack received as a delta.
+        self._stack_frames = {}
+        # Namespace id -> {name: repr} for the globals and builtins that
+        # frames share.
+        self.namespaces = {}
+
+        # The process ID of the debugged process, once known.
+        self.pid = None
+
+        # The number the debugger gave this client, the number of the
+        # client in control of the session, and every client connected
+        # to it (see bugjar.hub). Debuggers that don't say have only
+        # one client, which is in control.
+        self.client_number = None
+        self.controller = None
+        self.clients = []
+
+        # The samples collected by the debugger, if it is profiling.
+        self.profile = None
+
+        # If the debugger is counting lines, filename -> (first line, counts)
+        self.heatmap = {}
+
+        # Watch number -> Watch
+        self.watches = {}
+
+        # Watchpoint number -> Watchpoint
+        self.watchpoints = {}
+
+        # If the debugger is replaying recorded history, the position
+        # of the stack in the recording, and the length of the recording.
+        self.history = None
+
         # By default, no view is known.
         # It must be set after
         self.view = None
 
     def start(self):
-        "Start the debugger session"
-        connected = False
-        while not connected:
-            try:
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((self.host, self.port))
-                connected = True
-            except socket.error as e:
-                print("Waiting for connection...", e)
-                time.sleep(1.0)
+        """Start the debugger session.
+
+        If the debugger says when it is ready, connect as soon as it does;
+        otherwise, keep trying (more and more slowly) until it answers.
+        Raises ConnectionFailed if that takes longer than the timeout, or
+        if the debugger this session started has exited.
+        """
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        if self.ready_fd is not None or self.ready_file is not None:
+            self.wait_until_ready(deadline)
+        self.connect(deadline)
 
+        self.channel = Channel(self.socket)
         t = Thread(target=command_buffer, args=(self,))
         t.daemon = True
         t.start()
 
+    def connect(self, deadline=None):
+        "Connect to the debugger, retrying until it answers (or the deadline passes)"
+        if self.path is not None:
+            family, address = socket.AF_UNIX, self.path
+        else:
+            family, address = socket.AF_INET, (self.host, self.port)
+        delay = 0.01
+        while True:
+            self.socket = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                self.socket.connect(address)
+                break
+            except socket.error as e:
+                self.socket.close()
+                self.check_alive()
+                if deadline is not None and time.time() + delay > deadline:
+                    raise ConnectionFailed("Couldn't connect to the debugger: %s" % e)
+                if delay == 1.0:
+                    print("Waiting for connection...", e)
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    def wait_until_ready(self, deadline=None):
+        "Wait for the debugger this session started to say it is listening"
+        while True:
+            self.check_alive()
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise ConnectionFailed("The debugger wasn't ready after %ss" % self.timeout)
+            if self.ready_fd is not None:
+                # The debugger writes a line, and closes its end of the
+                # pipe; if it exits first, the pipe is closed anyway.
+                readable = select.select([self.ready_fd], [], [], remaining)[0]
+                if readable:
+                    ready = os.read(self.ready_fd, 1024)
+                    os.close(self.ready_fd)
+                    self.ready_fd = None
+                    if not ready:
+                        self.check_alive()
+                        raise ConnectionFailed('The debugger closed its ready pipe without being ready')
+                    return
+            elif os.path.exists(self.ready_file):
+                return
+            else:
+                time.sleep(0.01 if remaining is None else min(0.01, remaining))
+
+    def check_alive(self):
+        "Raise ConnectionFailed if the debugger this session started has exited"
+        if self.proc is not None and self.proc.poll() is not None:
+            raise ConnectionFailed('The debugger exited (with status %s)' % self.proc.returncode)
+
     def stop(self):
         "Shut down the debugger session"
         if self.proc is not None:
@@ -114,15 +321,68 @@ class Debugger(object):
         "Send a single command packet to the debugger"
         try:
             # print "OUTPUT %s byte message" % len(json.dumps((event, data)) + Debugger.ETX)
-            dumped = json.dumps((event, data))
-            if not isinstance(dumped, bytes):
-                dumped = dumped.encode('utf8')
-            self.socket.sendall(dumped + Debugger.ETX)
+            with self._send_lock:
+                self.socket.sendall(self.channel.pack(event, data))
         except socket.error as e:
             print("CLIENT ERROR", e)
         except AttributeError as e:
             print("No client yet", e)
 
+    def request(self, command, **args):
+        """Send a command to the debugger, and return a Request for its reply.
+
+        Commands don't wait for each other; any number of requests can be
+        waiting for a reply at once.
+        """
+        channel = self.channel
+        if channel is None or REQUESTS not in channel.features:
+            self.output(command, **args)
+            request = Request(command, args)
+            request.finish()
+            return request
+
+        request = Request(command, args, next(self._request_ids))
+        # Register the request first; the reply may arrive before
+        # the command has been sent.
+        self._requests[request.id] = request
+        try:
+            with self._send_lock:
+                self.socket.sendall(channel.pack(command, dict(args, request=request.id)))
+        except socket.error as e:
+            print("CLIENT ERROR", e)
+            self._requests.pop(request.id, None)
+            request.finish(error=str(e))
+        return request
+
+    def reply(self, request_id, event, data):
+        """Record an event sent in reply to a request.
+
+        Returns True if the event has been dealt with, and shouldn't be
+        dispatched to a handler.
+        """
+        if event == 'done':
+            request = self._requests.pop(request_id, None)
+            if request is not None:
+                request.finish()
+            return True
+        request = self._requests.get(request_id)
+        if request is not None:
+            request.events.append((event, data))
+            if event == 'error':
+                request.error = data.get('message')
+        return False
+
+    def cancel_requests(self):
+        "Fail every request still waiting for a reply (the connection has closed)"
+        requests, self._requests = self._requests, {}
+        for request in requests.values():
+            request.finish(error='The connection to the debugger was closed')
+
+    @property
+    def in_control(self):
+        "Can this client change what the program does?"
+        return self.client_number is None or self.controller == self.client_number
+
     #################################################################
     # Utilities for retrieving current breakpoints.
     #################################################################
@@ -155,48 +415,184 @@ class Debugger(object):
 
     def create_breakpoint(self, filename, line, temporary=False):
         "Create a new, enabled breakpoint at the specified line of the given file"
-        self.output('break', filename=filename, line=line, temporary=temporary)
+        return self.request('break', filename=filename, line=line, temporary=temporary)
 
     def enable_breakpoint(self, breakpoint):
         "Enable an existing breakpoint"
-        self.output('enable', bpnum=breakpoint.bpnum)
+        return self.request('enable', bpnum=breakpoint.bpnum)
 
     def disable_breakpoint(self, breakpoint):
         "Disable an existing breakpoint"
-        self.output('disable', bpnum=breakpoint.bpnum)
+        return self.request('disable', bpnum=breakpoint.bpnum)
 
     def ignore_breakpoint(self, breakpoint, count):
         """Ignore an existing breakpoint for `count` iterations
 
         Use a count of 0 to restore the breakpoint.
         """
-        self.output('ignore', bpnum=breakpoint.bpnum, count=count)
+        return self.request('ignore', bpnum=breakpoint.bpnum, count=count)
+
+    def condition_breakpoint(self, breakpoint, condition):
+        """Only stop at an existing breakpoint when `condition` is true
+
+        Use a condition of None to make the breakpoint unconditional.
+        """
+        return self.request('condition', bpnum=breakpoint.bpnum, condition=condition)
+
+    def log_breakpoint(self, breakpoint, message):
+        """Log `message` each time a breakpoint is hit, rather than stopping.
+
+        The message can contain Python expressions in braces, as in
+        str.format(). Use a message of None to make the breakpoint
+        stop again.
+        """
+        return self.request('logpoint', bpnum=breakpoint.bpnum, message=message)
 
     def clear_breakpoint(self, breakpoint):
         "Clear an existing breakpoint"
-        self.output('clear', bpnum=breakpoint.bpnum)
+        return self.request('clear', bpnum=breakpoint.bpnum)
+
+    def create_watch(self, expression):
+        "Watch the value of an expression whenever the program stops"
+        return self.request('watch', expression=expression)
 
-    def do_run(self):
-        "Set the debugger running until the next breakpoint"
-        self.output('continue')
+    def clear_watch(self, watch):
+        "Stop watching an expression"
+        return self.request('unwatch', number=watch.number)
+
+    def create_watchpoint(self, expression):
+        "Stop when a variable or attribute (in the current frame) changes"
+        return self.request('watchpoint', expression=expression)
+
+    def clear_watchpoint(self, watchpoint):
+        "Remove a watchpoint"
+        return self.request('clear_watchpoint', number=watchpoint.number)
+
+    def do_run(self, thread=None):
+        """Set the debugger running until the next breakpoint
+
+        The step, next, return and run commands all apply to the current
+        thread, unless a specific (stopped) thread is given.
+        """
+        return self.request('continue', thread=thread)
 
-    def do_step(self):
+    def do_step(self, thread=None):
         "Step through one stack frame"
-        self.output('step')
+        return self.request('step', thread=thread)
 
-    def do_next(self):
+    def do_next(self, thread=None):
         "Go to the next line in the current stack frame"
-        self.output('next')
+        return self.request('next', thread=thread)
 
-    def do_return(self):
+    def do_return(self, thread=None):
         "Return to the previous stack frame"
-        self.output('return')
+        return self.request('return', thread=thread)
+
+    def do_step_back(self, thread=None):
+        "Go back to the previous line in the recorded history"
+        return self.request('step_back', thread=thread)
+
+    def do_reverse_continue(self, thread=None):
+        "Go back through the recorded history to the last breakpoint"
+        return self.request('reverse_continue', thread=thread)
+
+    def select_thread(self, thread):
+        "Make a stopped thread the current thread, and retrieve its stack"
+        return self.request('select', thread=thread)
+
+    def freeze_threads(self, frozen):
+        "Freeze all other threads while a thread is stopped"
+        return self.request('freeze', frozen=frozen)
+
+    def take_control(self):
+        "Take control of the session, if nobody has it"
+        return self.request('control', holder=self.client_number)
+
+    def give_control(self, client=None):
+        """Hand control of the session to another client (by number), or
+        give it up for any client to take.
+        """
+        return self.request('control', holder=client)
+
+    def inspect(self, node, frame=None, scope=None, ref=None, offset=0):
+        """Ask for a page of the variables in a scope of a frame of the
+        current stack, or of the children of a value (by reference).
+
+        The answer is passed to the view's on_inspection(), with `node`.
+        """
+        return self.request(
+            'inspect', node=node, frame=frame, scope=scope, ref=ref,
+            offset=offset, thread=self.thread
+        )
 
     #################################################################
     # Handlers for events raised by the debugger
     #################################################################
 
-    def on_bootstrap(self, breakpoints):
+    def on_protocol_offer(self, framing, codecs=('json',), compression=(), features=()):
+        "The debugger can speak a better protocol; pick one."
+        choice = choose(framing, FRAMINGS)
+        if choice is None:
+            return
+        codec = get_codec(choose(codecs, self.codecs) or 'json')
+        chosen = {'framing': choice, 'codec': codec.name}
+        wanted = [feature for feature in self.features if feature in features]
+        if wanted:
+            chosen['features'] = wanted
+        if self.shared_memory and SHARED_MEMORY in features:
+            chosen['shared_memory'] = self.shared_memory
+        if self.compression is not None:
+            if self.compression in compression:
+                chosen.update(
+                    compression=self.compression,
+                    level=self.compress_level,
+                    threshold=self.compress_threshold,
+                )
+            else:
+                print("The debugger can't compress with %s; messages won't be compressed." % self.compression)
+        with self._send_lock:
+            self.socket.sendall(self.channel.pack('protocol', chosen))
+            self.channel.framing_out = choice
+            self.channel.codec_out = codec
+            if 'compression' in chosen:
+                self.channel.compression_out = get_compression(self.compression)(self.compress_level)
+                if self.compress_threshold is not None:
+                    self.channel.threshold = self.compress_threshold
+
+    def on_protocol(self, framing, codec='json', compression=None, level=None, threshold=None, features=(),
+                    shared_memory=None):
+        "The debugger has switched to the protocol we chose."
+        self.channel.framing_in = framing
+        self.channel.codec_in = get_codec(codec)
+        if compression is not None:
+            self.channel.compression_in = get_compression(compression)(level)
+        if shared_memory is not None:
+            self.channel.shared_in = SharedRing.attach(shared_memory)
+        self.channel.features = set(features)
+
+    def on_control(self, holder, client, clients=()):
+        "The client in control of the session (or the clients connected) has changed."
+        self.client_number = client
+        self.controller = holder
+        self.clients = clients
+        self.view.on_control(holder=holder, client=client, clients=clients)
+
+    def on_protocol_stats(self, codec, messages, bytes, encode_time, compression=None, wire_bytes=None,
+                          reprs=None, repr_time=None, reprs_skipped=None):
+        # The debugger has reported what it cost to send everything
+        # since the last stop; add what it cost to decode.
+        last, self._decode_time = self._decode_time, self.channel.decode_time
+        self.view.on_protocol_stats(
+            codec=codec, compression=compression, messages=messages,
+            bytes=bytes, wire_bytes=bytes if wire_bytes is None else wire_bytes,
+            encode_time=encode_time, decode_time=self._decode_time - last,
+            session_bytes=self.channel.received_bytes,
+            session_wire_bytes=self.channel.received_wire_bytes,
+            reprs=reprs, repr_time=repr_time, reprs_skipped=reprs_skipped,
+        )
+
+    def on_bootstrap(self, breakpoints, pid=None):
+        self.pid = pid
         self.bp_index = {}
         self.bp_list = [None]
         for bp_data in breakpoints:
@@ -226,13 +622,151 @@ class Debugger(object):
         bp.ignore = count
         self.view.on_breakpoint_ignore(bp=bp, count=count)
 
+    def on_breakpoint_condition(self, bpnum, condition):
+        bp = self.bp_list[bpnum]
+        bp.condition = condition
+        self.view.on_breakpoint_condition(bp=bp)
+
+    def on_breakpoint_log(self, bpnum, message):
+        bp = self.bp_list[bpnum]
+        bp.log = message
+        self.view.on_breakpoint_log(bp=bp)
+
+    def on_log(self, entries, dropped=0):
+        entries = [
+            (timestamp, self.bp_list[bpnum], message)
+            for timestamp, bpnum, message in entries
+        ]
+        self.view.on_log(entries=entries, dropped=dropped)
+
+    def on_breakpoint_stats(self, breakpoints):
+        updated = []
+        for stats in breakpoints:
+            bp = self.bp_list[stats['bpnum']]
+            bp.hits = stats['hits']
+            bp.evaluations = stats['evaluations']
+            bp.eval_time = stats['eval_time']
+            updated.append(bp)
+        self.view.on_breakpoint_stats(breakpoints=updated)
+
     def on_breakpoint_clear(self, bpnum):
         bp = self.bp_list[bpnum]
+        self.bp_index.get(bp.filename, {}).pop(bp.line, None)
         self.view.on_breakpoint_clear(bp=bp)
 
-    def on_stack(self, stack):
+    def on_watch_create(self, number, expression):
+        watch = Watch(number, expression)
+        self.watches[number] = watch
+        self.view.on_watch_create(watch=watch)
+
+    def on_watch_clear(self, number):
+        watch = self.watches.pop(number)
+        self.view.on_watch_clear(watch=watch)
+
+    def on_watches(self, watches):
+        changed = []
+        for data in watches:
+            watch = self.watches.get(data['number'])
+            if watch is not None:
+                watch.value = data['value']
+                changed.append(watch)
+        self.view.on_watches(watches=changed)
+
+    def on_watchpoint_create(self, number, expression, value=None):
+        watchpoint = Watchpoint(number, expression, value)
+        self.watchpoints[number] = watchpoint
+        self.view.on_watch_create(watch=watchpoint)
+
+    def on_watchpoint_clear(self, number):
+        watchpoint = self.watchpoints.pop(number)
+        self.view.on_watch_clear(watch=watchpoint)
+
+    def on_watchpoint(self, number, expression, old, new, filename, line):
+        watchpoint = self.watchpoints.get(number)
+        if watchpoint is not None:
+            watchpoint.value = new
+            self.view.on_watchpoint(watchpoint=watchpoint, old=old, new=new)
+
+    def on_namespace(self, id, variables=None, changes=None):
+        # Replace (rather than change) the namespace, as the view may
+        # still be showing it.
+        if variables is None:
+            variables = patch_namespace(self.namespaces.get(id, {}), changes)
+        self.namespaces[id] = variables
+
+    def on_stack(self, stack, thread=None):
+        # A full stack replaces any frames we were given ids for.
+        self._stack_frames.pop(thread, None)
         self.stack = stack
-        self.view.on_stack(stack=stack)
+        self.thread = thread
+        self.view.on_stack(stack=stack, thread=thread)
+
+    def on_stack_delta(self, frames, thread=None):
+        # Rebuild the stack from the frames we already know about, and
+        # the changes to them; the view sees a full stack either way.
+        known = self._stack_frames.get(thread, {})
+        current = {}
+        stack = []
+        for entry in frames:
+            if 'frame' in entry:
+                frame = entry['frame']
+            else:
+                frame = patch_frame(known[entry['id']], entry.get('changes', {}))
+            current[entry['id']] = frame
+            stack.append((entry['line'], frame))
+        self._stack_frames[thread] = current
+        self.stack = stack
+        self.thread = thread
+        self.view.on_stack(stack=stack, thread=thread)
+
+    def on_inspection(self, node, ref, offset, total, children):
+        self.view.on_inspection(node=node, ref=ref, offset=offset, total=total, children=children)
+
+    def on_history(self, position, length):
+        if position is None:
+            self.history = None
+        else:
+            self.history = (position, length)
+        self.view.on_history(position=position, length=length)
+
+    def on_threads(self, threads):
+        self.threads = threads
+        # Forget the frames of any threads that have finished.
+        alive = set(thread['ident'] for thread in threads)
+        for ident in list(self._stack_frames):
+            if ident not in alive:
+                del self._stack_frames[ident]
+        self.view.on_threads(threads=threads)
+
+    def on_tasks(self, tasks, thread=None):
+        self.tasks = tasks
+        self.view.on_tasks(tasks=tasks)
+
+    def on_process(self, pid, port, parent=None):
+        # A child process is available for debugging. It has its own
+        # debugger session, on its own port.
+        # Child processes are always debugged over TCP.
+        child = Debugger(
+            self.host or 'localhost', port, codecs=self.codecs, compression=self.compression,
+            compress_level=self.compress_level, compress_threshold=self.compress_threshold,
+            features=self.features
+        )
+        child.pid = pid
+        self.view.on_process(debugger=child, parent=parent)
+
+    def on_process_exit(self, pid):
+        self.view.on_process_exit(pid=pid)
+
+    def on_profile(self, interval, frames, stacks, reset=False):
+        if reset or self.profile is None:
+            self.profile = Profile(interval)
+        self.profile.update(frames, stacks)
+        self.view.on_profile(profile=self.profile)
+
+    def on_heatmap(self, files):
+        for filename, data in files.items():
+            self.heatmap[filename] = (data['first'], decode_counts(data['counts']))
+        self.view.on_heatmap(filenames=list(files))
 
     def on_restart(self):
         self.view.on_restart()
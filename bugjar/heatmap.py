@@ -0,0 +1,205 @@
+"""Line execution counts for a program running under bugjar-net.
+
+Every code object that runs gets an array of counters, one for each line
+between its first and last line. On Python 3.12+, lines are counted by a
+sys.monitoring tool of their own, so counting works alongside any tracing
+engine. On older versions, the debugger's trace function does the counting.
+
+Counts are sent to the client as a vector for each file: the count for
+every line from the first line of code in the file to the last, encoded
+as a compressed JSON list.
+"""
+from __future__ import print_function, unicode_literals
+import base64
+from array import array
+import dis
+import json
+import sys
+import zlib
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident  # python 2.x
+
+try:
+    from coverage import CoverageData
+except ImportError:
+    CoverageData = None
+
+try:
+    monitoring = sys.monitoring
+except AttributeError:
+    monitoring = None  # python < 3.12
+
+try:
+    array('Q')
+    COUNTER_TYPE = 'Q'
+except ValueError:
+    COUNTER_TYPE = 'L'  # python 2.x
+
+
+def encode_counts(counts):
+    "Encode a list of line counts for sending to the client"
+    return base64.b64encode(zlib.compress(json.dumps(counts).encode('ascii'))).decode('ascii')
+
+
+def decode_counts(data):
+    "Decode a list of line counts sent by the net"
+    return json.loads(zlib.decompress(base64.b64decode(data)).decode('ascii'))
+
+
+class LineCounts(object):
+    """The number of times each line of code has been executed.
+
+    Code from any of `ignore_files` (i.e., the debugger) isn't counted.
+    When counting with sys.monitoring, `ignore_thread` is called with the
+    ident of each thread that runs a line; lines run by threads for which
+    it returns True (i.e., the debugger's threads) aren't counted.
+    """
+    TOOL_NAME = 'bugjar heatmap'
+    if monitoring is not None:
+        TOOL_ID = monitoring.COVERAGE_ID
+
+    def __init__(self, ignore_files=(), ignore_thread=None):
+        self.ignore_files = set(ignore_files)
+        # Never count the code that does the counting.
+        self.ignore_files.add(sys._getframe().f_code.co_filename)
+        self.ignore_thread = ignore_thread
+        # Thread ident -> should the thread's lines be ignored?
+        self._ignored_threads = {}
+        # Code object -> (array of counts, the line of the first counter)
+        self.codes = {}
+        # Filename -> the encoded counts last returned by changes()
+        self._sent = {}
+        self.monitoring = False
+
+    def start(self):
+        """Prepare to count lines with sys.monitoring, if it's available.
+
+        Lines aren't counted until resume() is called. Returns False if
+        the lines have to be counted by calling count().
+        """
+        if monitoring is None:
+            return False
+        monitoring.use_tool_id(self.TOOL_ID, self.TOOL_NAME)
+        monitoring.register_callback(self.TOOL_ID, monitoring.events.LINE, self._on_line)
+        self.monitoring = True
+        return True
+
+    def resume(self):
+        "Count lines while the program is running"
+        if self.monitoring:
+            monitoring.set_events(self.TOOL_ID, monitoring.events.LINE)
+
+    def pause(self):
+        "Stop counting lines while the debugger starts or restarts the program"
+        if self.monitoring:
+            monitoring.set_events(self.TOOL_ID, 0)
+
+    def forget_threads(self):
+        """Forget which threads are ignored.
+
+        Call this when a thread that should be ignored has started; it
+        can run a few lines before it can be recognized.
+        """
+        self._ignored_threads = {}
+
+    def stop(self):
+        if self.monitoring:
+            self.monitoring = False
+            monitoring.set_events(self.TOOL_ID, 0)
+            monitoring.register_callback(self.TOOL_ID, monitoring.events.LINE, None)
+            monitoring.free_tool_id(self.TOOL_ID)
+
+    def _on_line(self, code, line):
+        ident = get_ident()
+        try:
+            if self._ignored_threads[ident]:
+                return
+        except KeyError:
+            ignored = bool(self.ignore_thread and self.ignore_thread(ident))
+            self._ignored_threads[ident] = ignored
+            if ignored:
+                return
+        try:
+            counts, first = self.codes[code]
+            counts[line - first] += 1
+        except KeyError:
+            if not self.add_code(code):
+                return monitoring.DISABLE
+            self.count(code, line)
+
+    def observe(self, frame, event):
+        "Count a line event seen by a trace function"
+        if event == 'line':
+            self.count(frame.f_code, frame.f_lineno)
+
+    def count(self, code, line):
+        "Count one execution of a line of a code object"
+        try:
+            counts, first = self.codes[code]
+            counts[line - first] += 1
+        except KeyError:
+            if self.add_code(code):
+                self.count(code, line)
+
+    def add_code(self, code):
+        """Start counting the lines of a code object.
+
+        Returns False if the code shouldn't be counted.
+        """
+        if code.co_filename in self.ignore_files:
+            return False
+        lines = [line for _, line in dis.findlinestarts(code) if line is not None]
+        lines.append(code.co_firstlineno)
+        first = min(lines)
+        self.codes[code] = (array(COUNTER_TYPE, [0]) * (max(lines) - first + 1), first)
+        return True
+
+    def files(self):
+        """The counts for every file, as a (first line, [count, ...]) pair.
+
+        A file's counts run from its first line of counted code to its last.
+        """
+        ranges = {}
+        for code, (counts, first) in list(self.codes.items()):
+            filename = code.co_filename
+            start, end = ranges.get(filename, (first, first + len(counts)))
+            ranges[filename] = (min(start, first), max(end, first + len(counts)))
+
+        files = {}
+        for filename, (start, end) in ranges.items():
+            files[filename] = (start, [0] * (end - start))
+        for code, (counts, first) in list(self.codes.items()):
+            start, file_counts = files[code.co_filename]
+            for offset, count in enumerate(counts):
+                file_counts[first - start + offset] += count
+        return files
+
+    def changes(self, full=False):
+        """The counts for every file that has changed since the last call.
+
+        If `full` is True, the counts for every file are returned.
+        """
+        changed = {}
+        for filename, (first, counts) in self.files().items():
+            encoded = encode_counts(counts)
+            if full or self._sent.get(filename) != encoded:
+                self._sent[filename] = encoded
+                changed[filename] = {'first': first, 'counts': encoded}
+        return changed
+
+    def save_coverage(self, filename):
+        """Write the lines that have been executed to a coverage.py data file.
+
+        coverage.py's data files record which lines ran, not how often.
+        """
+        if CoverageData is None:
+            raise RuntimeError('Saving line counts requires coverage.py.')
+        data = CoverageData(filename)
+        data.add_lines(dict(
+            (path, [first + offset for offset, count in enumerate(counts) if count])
+            for path, (first, counts) in self.files().items()
+        ))
+        data.write()
@@ -0,0 +1,399 @@
+"""A recording of the recent execution of a program running under bugjar-net.
+
+While recording, every line that runs is appended to a ring buffer as
+a (frame serial, line, changes) event. Frames are numbered as they start;
+`changes` lists the locals of the frame whose (compact) repr differs from
+the previous line of the same frame. When the buffer uses more than its
+memory allowance, the oldest events are folded into a base set of locals
+for their frame, and frames with no events left are forgotten.
+
+A stopped thread can replay its part of the recording, reconstructing the
+stack (with locals) as it was at any recorded line. Nothing in the
+program is re-executed; only what was recorded can be shown.
+
+On Python 3.12+, lines are recorded by a sys.monitoring tool of their
+own; on older versions, the debugger's trace function does the recording.
+"""
+from __future__ import print_function, unicode_literals
+from bisect import bisect_right
+from collections import deque
+import sys
+import types
+from threading import Lock
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident  # python 2.x
+
+try:
+    monitoring = sys.monitoring
+except AttributeError:
+    monitoring = None  # python < 3.12
+
+from bugjar.reprs import ReprEngine
+
+
+# Values whose repr can't change while the same object is bound to a name.
+# Recording holds a reference to these, so the comparison by identity is safe.
+STABLE_TYPES = (
+    int, float, complex, bool, type(None), bytes, type(''),
+    type, types.FunctionType, types.BuiltinFunctionType, types.ModuleType,
+)
+try:
+    STABLE_TYPES += (long, unicode)
+except NameError:
+    pass  # python 3.x
+
+# The code flags of frames that are resumed, rather than started, by
+# later call events.
+CO_RESUMABLE = 0x0020 | 0x0080 | 0x0100 | 0x0200
+
+# An approximation of the memory used by an event, a changed local,
+# and a frame, in addition to the text of any names and reprs.
+EVENT_SIZE = 100
+CHANGE_SIZE = 60
+FRAME_SIZE = 250
+
+# A marker for a local whose value isn't kept (it's compared by repr).
+UNSTABLE = object()
+
+# The most characters in the repr of a recorded local.
+MAX_CHARS = 80
+
+
+class History(object):
+    """A bounded recording of the lines executed by the program.
+
+    `max_bytes` is the (approximate) memory allowance for the recording.
+    Code from any of `ignore_files` (i.e., the debugger) isn't recorded.
+    When recording with sys.monitoring, `ignore_thread` is called with the
+    ident of each thread that runs a line; lines run by threads for which
+    it returns True (i.e., the debugger's threads) aren't recorded.
+    """
+    TOOL_NAME = 'bugjar history'
+    # sys.monitoring has no reserved tool id for a recorder.
+    TOOL_ID = 3
+
+    def __init__(self, max_bytes, ignore_files=(), ignore_thread=None):
+        self.max_bytes = max_bytes
+        self.ignore_files = set(ignore_files)
+        # Never record the code that does the recording.
+        self.ignore_files.add(sys._getframe().f_code.co_filename)
+        self.ignore_thread = ignore_thread
+        self._ignored_threads = {}
+
+        # Locals are described on every line, in the thread being
+        # recorded; a __repr__ written in Python is never run (it could be
+        # slow, or wait for a lock), and there is no stop to reset the
+        # budget of time at.
+        self.reprs = ReprEngine(max_chars=MAX_CHARS, budget=float('inf'), run_python=False)
+
+        self.lock = Lock()
+        # (serial, line, changes, size) for each line executed, oldest first.
+        # changes is a tuple of (name, repr) pairs; a repr of None means
+        # the name was deleted.
+        self.events = deque()
+        # Serial -> [parent serial, parent line, thread ident, filename,
+        #            function name, number of events, number of children,
+        #            id(frame)]
+        self.frames = {}
+        # Serial -> {name: repr} for the events that have been discarded.
+        self.bases = {}
+        self.size = 0
+        self._next_serial = 1
+        # id(frame) -> [serial, code, {name: (value or UNSTABLE, repr)}]
+        # for every frame that has been seen.
+        self._live = {}
+        self.monitoring = False
+
+    def start(self):
+        """Prepare to record with sys.monitoring, if it's available.
+
+        Nothing is recorded until resume() is called. Returns False if
+        the recording has to be done by calling observe().
+        """
+        if monitoring is None:
+            return False
+        monitoring.use_tool_id(self.TOOL_ID, self.TOOL_NAME)
+        monitoring.register_callback(self.TOOL_ID, monitoring.events.PY_START, self._on_start)
+        monitoring.register_callback(self.TOOL_ID, monitoring.events.LINE, self._on_line)
+        self.monitoring = True
+        return True
+
+    def resume(self):
+        "Record while the program is running"
+        if self.monitoring:
+            monitoring.set_events(
+                self.TOOL_ID,
+                monitoring.events.PY_START | monitoring.events.LINE
+            )
+
+    def pause(self):
+        "Stop recording while the debugger starts or restarts the program"
+        if self.monitoring:
+            monitoring.set_events(self.TOOL_ID, 0)
+
+    def forget_threads(self):
+        """Forget which threads are ignored.
+
+        Call this when a thread that should be ignored has started; it
+        can run a few lines before it can be recognized.
+        """
+        self._ignored_threads = {}
+
+    def stop(self):
+        if self.monitoring:
+            self.monitoring = False
+            monitoring.set_events(self.TOOL_ID, 0)
+            monitoring.register_callback(self.TOOL_ID, monitoring.events.PY_START, None)
+            monitoring.register_callback(self.TOOL_ID, monitoring.events.LINE, None)
+            monitoring.free_tool_id(self.TOOL_ID)
+
+    def clear(self):
+        "Discard the recording (e.g., when the program restarts)"
+        with self.lock:
+            self.events.clear()
+            self.frames.clear()
+            self.bases.clear()
+            self._live.clear()
+            self.size = 0
+
+    def _ignored(self):
+        ident = get_ident()
+        try:
+            return self._ignored_threads[ident]
+        except KeyError:
+            ignored = bool(self.ignore_thread and self.ignore_thread(ident))
+            self._ignored_threads[ident] = ignored
+            return ignored
+
+    def _on_start(self, code, instruction_offset):
+        if code.co_filename in self.ignore_files:
+            return monitoring.DISABLE
+        if not self._ignored():
+            self.record_call(sys._getframe(1))
+
+    def _on_line(self, code, line):
+        if code.co_filename in self.ignore_files:
+            return monitoring.DISABLE
+        if not self._ignored():
+            self.record_line(sys._getframe(1), line)
+
+    def observe(self, frame, event):
+        "Record a call or line event seen by a trace function"
+        if frame.f_code.co_filename in self.ignore_files:
+            return
+        if event == 'call':
+            self.record_call(frame)
+        elif event == 'line':
+            self.record_line(frame, frame.f_lineno)
+
+    def record_call(self, frame):
+        "Record the start of a frame"
+        live = self._live.get(id(frame))
+        if live is not None and live[1] is frame.f_code and frame.f_code.co_flags & CO_RESUMABLE:
+            # A generator or coroutine is being resumed.
+            return live
+        with self.lock:
+            return self._add_frame(frame)
+
+    def _add_frame(self, frame):
+        serial = self._next_serial
+        self._next_serial += 1
+
+        parent = None
+        caller = frame.f_back
+        if caller is not None:
+            caller_live = self._live.get(id(caller))
+            if caller_live is not None and caller_live[1] is caller.f_code:
+                parent = caller_live[0]
+                if parent in self.frames:
+                    self.frames[parent][6] += 1
+                else:
+                    parent = None
+        code = frame.f_code
+        self.frames[serial] = [
+            parent, caller.f_lineno if parent else None, get_ident(),
+            code.co_filename, code.co_name, 0, 0, id(frame)
+        ]
+        self.size += FRAME_SIZE
+        live = [serial, code, {}]
+        self._live[id(frame)] = live
+        return live
+
+    def record_line(self, frame, line):
+        "Record a line that is about to be executed, and the locals that have changed"
+        live = self._live.get(id(frame))
+        if live is None or live[1] is not frame.f_code or live[0] not in self.frames:
+            # A frame that started before recording did, or was forgotten.
+            live = self.record_call(frame)
+
+        last = live[2]
+        changes = []
+        size = EVENT_SIZE
+        local_vars = frame.f_locals
+        for name, value in local_vars.items():
+            old = last.get(name)
+            if old is not None and old[0] is value:
+                continue
+            text = self.reprs.repr(value)
+            if old is None or old[1] != text:
+                changes.append((name, text))
+                size += CHANGE_SIZE + len(name) + len(text)
+            last[name] = (value if isinstance(value, STABLE_TYPES) else UNSTABLE, text)
+        if len(last) > len(local_vars):
+            for name in [name for name in last if name not in local_vars]:
+                del last[name]
+                changes.append((name, None))
+                size += CHANGE_SIZE + len(name)
+
+        with self.lock:
+            serial = live[0]
+            self.events.append((serial, line, tuple(changes), size))
+            self.frames[serial][5] += 1
+            self.size += size
+            if self.size > self.max_bytes:
+                self._discard()
+
+    def _discard(self):
+        "Discard the oldest events until the recording fits in its allowance"
+        while self.size > self.max_bytes and self.events:
+            serial, line, changes, size = self.events.popleft()
+            self.size -= size
+            if changes:
+                base = self.bases.setdefault(serial, {})
+                for name, text in changes:
+                    old = base.pop(name, None)
+                    if old is not None:
+                        self.size -= CHANGE_SIZE + len(name) + len(old)
+                    if text is not None:
+                        base[name] = text
+                        self.size += CHANGE_SIZE + len(name) + len(text)
+            frame = self.frames[serial]
+            frame[5] -= 1
+            self._forget(serial)
+
+    def _forget(self, serial):
+        "Forget a frame once it has no events, and no frames that it called"
+        while serial is not None:
+            frame = self.frames[serial]
+            if frame[5] or frame[6]:
+                return
+            del self.frames[serial]
+            self.size -= FRAME_SIZE
+            live = self._live.get(frame[7])
+            if live is not None and live[0] == serial:
+                del self._live[frame[7]]
+            for name, text in self.bases.pop(serial, {}).items():
+                self.size -= CHANGE_SIZE + len(name) + len(text)
+            serial = frame[0]
+            if serial is not None:
+                self.frames[serial][6] -= 1
+
+    def replay(self, thread, frame):
+        """Start replaying the recording of a stopped thread.
+
+        `frame` is the frame the thread is stopped in.
+        """
+        with self.lock:
+            return Replay(self, thread, frame)
+
+
+class Replay(object):
+    """A copy of the recording of one thread, with a position in it.
+
+    The position is an index into `events`; a position equal to the
+    number of events is the present (i.e., the live stack).
+    """
+    def __init__(self, history, thread, frame):
+        self.events = [event for event in history.events if history.frames[event[0]][2] == thread]
+        self.frames = dict(
+            (serial, tuple(data)) for serial, data in history.frames.items() if data[2] == thread
+        )
+        self.bases = dict(
+            (serial, dict(base)) for serial, base in history.bases.items() if serial in self.frames
+        )
+        # Serial -> the positions of that frame's events
+        self.positions = {}
+        for position, event in enumerate(self.events):
+            self.positions.setdefault(event[0], []).append(position)
+
+        self.present = len(self.events)
+        # Depending on the engine, the line the thread has stopped on may
+        # already have been recorded; if so, it's part of the present.
+        live = history._live.get(id(frame))
+        if (self.events and live is not None and live[1] is frame.f_code and
+                self.events[-1][:2] == (live[0], frame.f_lineno)):
+            self.present -= 1
+        self.position = self.present
+
+    def __len__(self):
+        return self.present
+
+    @property
+    def at_present(self):
+        return self.position >= self.present
+
+    def parents(self, serial):
+        "The serials of a frame and the frames that called it, innermost first"
+        while serial is not None and serial in self.frames:
+            yield serial
+            serial = self.frames[serial][0]
+
+    def within(self, position, serial):
+        "Is the event at a position in a frame, or in a frame called by it?"
+        return serial in self.parents(self.events[position][0])
+
+    def seek(self, step, stop=None):
+        """Move through the recording, one event at a time, in the direction of `step`.
+
+        Stops at the first event for which `stop(position)` is True, or at
+        either end of the recording. Returns False if the position didn't move.
+        """
+        position = self.position + step
+        while 0 <= position < self.present:
+            if stop is None or stop(position):
+                break
+            position += step
+        position = max(0, min(position, self.present))
+        moved = position != self.position
+        self.position = position
+        return moved
+
+    def local_vars(self, serial, position):
+        "The (repr of the) locals of a frame, as they were at a position"
+        local_vars = dict(self.bases.get(serial, {}))
+        positions = self.positions.get(serial, [])
+        for index in positions[:bisect_right(positions, position)]:
+            for name, text in self.events[index][2]:
+                if text is None:
+                    local_vars.pop(name, None)
+                else:
+                    local_vars[name] = text
+        return local_vars
+
+    def stack(self):
+        """The stack at the current position, in the form used by the net.
+
+        Only locals are recorded; globals and builtins are left empty.
+        """
+        serial, line = self.events[self.position][:2]
+        stack = []
+        for serial in self.parents(serial):
+            parent, parent_line, thread, filename, name = self.frames[serial][:5]
+            stack.append((line, {
+                'filename': filename,
+                'locals': self.local_vars(serial, self.position),
+                'globals': {},
+                'builtins': {},
+                'restricted': '',
+                'lasti': '',
+                'exc_type': '',
+                'exc_value': '',
+                'exc_traceback': '',
+                'current': not stack,
+            }))
+            line = parent_line
+        stack.reverse()
+        return stack
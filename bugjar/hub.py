@@ -0,0 +1,289 @@
+"""The clients of a debugging session.
+
+Any number of clients can connect to a net at once - say, the engineer
+debugging a stuck process, and a colleague watching over their shoulder.
+Every client has its own queue of messages waiting to be sent, and a
+thread that sends them; a client that is slow to read holds up neither
+the program nor the other clients. A client that falls too far behind is
+disconnected.
+
+One client at a time holds the control token; only that client can step,
+continue, set breakpoints, or otherwise change what the program does.
+The others are observers: they are shown everything, and can inspect
+variables, but nothing more. A client that connects while nobody has
+control takes it; the controller can hand the token to another client,
+or give it up for anyone to take. If the controller disconnects, the
+token passes to the client that has been connected longest.
+
+Observers don't need to see every stop of a program that is being
+stepped quickly. While an observer's queue is backed up, a newer stack
+(or list of threads, or of tasks, or the place a thread stopped, or the
+protocol's running totals) replaces one that is still waiting to be sent, so an observer catches up
+with the latest state rather than replaying every step (and stepping
+the program, by itself, doesn't leave an observer that has stopped
+reading any further behind).
+"""
+from __future__ import print_function, unicode_literals
+from collections import deque
+from itertools import count
+from threading import Condition, Lock
+import socket
+
+from bugjar.protocol import Channel
+
+
+# Events that describe the whole of something (for a thread); an
+# observer only needs the latest one. Event -> what it describes (a
+# line, call or return is where the program stopped).
+COALESCED = {
+    'stack': 'stack',
+    'threads': 'threads',
+    'tasks': 'tasks',
+    'protocol_stats': 'protocol_stats',
+    'line': 'stop',
+    'call': 'stop',
+    'return': 'stop',
+}
+
+# The most messages that can be waiting for a client; a client that
+# falls further behind than this is disconnected.
+MAX_QUEUED = 10000
+
+# The longest (in seconds) to wait for the messages queued for a client
+# to be sent, when the session ends.
+FLUSH_TIMEOUT = 5.0
+
+
+class Client(object):
+    """A connected client, and the messages waiting to be sent to it.
+
+    Messages are encoded (in the protocol the client chose) by the
+    sending thread, so the thread that sends an event doesn't pay for
+    encoding it either.
+    """
+    def __init__(self, number, sock):
+        self.number = number
+        self.socket = sock
+        self.channel = Channel(sock)
+        # Observers are sent coalesced updates.
+        self.observer = True
+
+        # Thread ident -> {id(frame): (code, frame id, description)} for
+        # the last stack sent to this client as a delta.
+        self.sent_stacks = {}
+        # Namespace id -> the reprs last sent to this client.
+        self.namespaces = {}
+        # The channel's totals when the protocol stats were last sent.
+        self.protocol_totals = (0, 0, 0, 0.0)
+
+        # Every entry is [event, data, channel changes]; an entry that has
+        # been coalesced away has an event (and data) of None.
+        self._queue = deque()
+        # The number of entries in the queue that are still to be sent,
+        # and the number that have been coalesced away.
+        self._live = 0
+        self._dead = 0
+        # (what an event describes, thread) -> the queued entry, for
+        # coalesced events.
+        self._latest = {}
+        self._ready = Condition(Lock())
+        self.closed = False
+        self._released = False
+        self.coalesced = 0
+        self._thread = None
+
+    def __repr__(self):
+        return '<Client %s>' % self.number
+
+    def start(self, start_thread):
+        "Start sending, in a thread started by `start_thread`"
+        self._thread = start_thread(self._run)
+
+    def send(self, event, data, changes=None):
+        """Queue an event for the client.
+
+        `changes` are attributes of the channel to set once the event
+        has been encoded (for instance, a new framing, which applies
+        to everything after the event that announces it).
+        """
+        entry = [event, data, changes]
+        with self._ready:
+            if self.closed:
+                return
+            if self.observer and event in COALESCED:
+                key = (COALESCED[event], data.get('thread'))
+                previous = self._latest.get(key)
+                if previous is not None:
+                    # Leave the old entry's place in the queue empty (and
+                    # let go of its data); the new one goes at the end,
+                    # after anything it depends on.
+                    previous[0] = previous[1] = None
+                    self._live -= 1
+                    self._dead += 1
+                    self.coalesced += 1
+                self._latest[key] = entry
+            if self._live >= MAX_QUEUED:
+                print("Client %s isn't keeping up; disconnecting it" % self.number)
+                self._abandon()
+                return
+            self._queue.append(entry)
+            self._live += 1
+            if self._dead > len(self._queue) // 2:
+                # Most of the queue is empty places; drop them.
+                self._queue = deque(e for e in self._queue if e[0] is not None)
+                self._dead = 0
+            self._ready.notify()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue and not self.closed:
+                    self._ready.wait()
+                if not self._queue:
+                    return
+                entry = self._queue.popleft()
+                event, data, changes = entry
+                if event is None:
+                    self._dead -= 1
+                    continue
+                self._live -= 1
+                if event in COALESCED:
+                    key = (COALESCED[event], data.get('thread'))
+                    if self._latest.get(key) is entry:
+                        del self._latest[key]
+            try:
+                self.socket.sendall(self.channel.pack(event, data))
+            except socket.error:
+                # The client has gone; the thread reading from it will
+                # notice, and remove it from the session.
+                with self._ready:
+                    self._abandon()
+                return
+            except (TypeError, ValueError) as e:
+                print("Can't send %s to client %s: %s" % (event, self.number, e))
+            if changes:
+                for name, value in changes.items():
+                    setattr(self.channel, name, value)
+
+    def _abandon(self):
+        "Stop sending, and disconnect the client. Called with the lock held."
+        self._queue.clear()
+        self._latest.clear()
+        self._live = self._dead = 0
+        self.closed = True
+        self._ready.notify()
+        try:
+            # Wake up the thread reading from the client.
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        "Stop taking new events, and wait for the queued ones to be sent"
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def close(self):
+        "Stop sending, and release the channel"
+        with self._ready:
+            if self._released:
+                return
+            self._released = True
+            self._abandon()
+        if self._thread is not None:
+            self._thread.join(FLUSH_TIMEOUT)
+        self.channel.close()
+
+
+class Hub(object):
+    """The clients connected to a session, and which of them is in control.
+
+    `clients` is replaced (never changed), so it can be iterated over
+    without holding the lock.
+    """
+    def __init__(self, start_thread):
+        self.start_thread = start_thread
+        self.clients = []
+        self.controller = None
+        self._numbers = count(1)
+        self._lock = Lock()
+
+    def client(self, sock):
+        """A client for a newly connected socket.
+
+        Events can be sent to the client straight away, but it isn't sent
+        the session's events until it is added.
+        """
+        client = Client(next(self._numbers), sock)
+        client.start(self.start_thread)
+        return client
+
+    def add(self, client):
+        "Add a client to the session; if nobody is in control, it takes control."
+        with self._lock:
+            if self.controller is None:
+                self._give(client)
+            self.clients = self.clients + [client]
+
+    def remove(self, client):
+        """Stop sending to a client that has gone.
+
+        If it was in control, the client that has been connected
+        longest takes over.
+        """
+        with self._lock:
+            self.clients = [c for c in self.clients if c is not client]
+            if self.controller is client:
+                self._give(self.clients[0] if self.clients else None)
+        client.close()
+
+    def controls(self, client):
+        "Can the client change what the program does?"
+        return client is self.controller
+
+    def hand_over(self, client, number):
+        """Pass control from `client` to the client with the given number
+        (or to nobody, if it is None).
+
+        A client can take control if nobody has it; otherwise, only the
+        controller can pass it on. Returns an error message if the token
+        can't be passed.
+        """
+        with self._lock:
+            if self.controller is None:
+                if number != client.number:
+                    return 'Nobody has control of the session; a client can only take it for itself'
+            elif self.controller is not client:
+                return 'Client %s has control of the session' % self.controller.number
+            if number is None:
+                self._give(None)
+                return None
+            for candidate in self.clients:
+                if candidate.number == number:
+                    self._give(candidate)
+                    return None
+            return 'There is no client %s' % number
+
+    def _give(self, client):
+        if self.controller is not None:
+            self.controller.observer = True
+        self.controller = client
+        if client is not None:
+            client.observer = False
+
+    def close(self, flush=True):
+        "Disconnect every client, after sending what is queued for them (if `flush`)"
+        with self._lock:
+            clients, self.clients = self.clients, []
+            self.controller = None
+        for client in clients:
+            if flush:
+                client.flush()
+                try:
+                    client.socket.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+            client.close()
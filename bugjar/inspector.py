@@ -0,0 +1,178 @@
+"""Lazy inspection of the variables of a stopped program.
+
+Rather than sending the repr of every variable of every frame whenever
+the program stops, the net describes the current frame's locals by name
+and type (see summarize()), and the client asks for the values it wants
+to see, a page at a time. Any value that has children (the items of a
+container, or the attributes of an object) is given a reference, so the
+client can ask for its children in turn.
+
+References are only good while the thread that handed them out is
+stopped; they are numbered from a counter shared by every thread, so a
+reference from an earlier stop is never mistaken for a new one.
+
+Values are described by the net's repr engine (see bugjar.reprs).
+"""
+from __future__ import print_function, unicode_literals
+from collections import deque
+from itertools import islice
+import types
+
+try:
+    unicode
+except NameError:
+    unicode = str  # python 3
+
+try:
+    range = xrange
+except NameError:
+    pass  # python 3
+
+
+# The number of children sent in each page.
+PAGE_SIZE = 100
+
+# Builtin types whose length is cheap, and safe, to ask for.
+SIZED_TYPES = (str, unicode, bytes, bytearray, list, tuple, dict, set, frozenset, deque)
+
+# Builtin containers whose items are their children.
+SEQUENCE_TYPES = (list, tuple, deque)
+SET_TYPES = (set, frozenset)
+
+MAPPING_PROXY = getattr(types, 'MappingProxyType', dict)  # python 2.x has no proxies
+
+
+def summarize(value):
+    "A short description of a value's type (and size, for builtin containers)"
+    name = type(value).__name__
+    if isinstance(value, SIZED_TYPES):
+        return '%s (%d)' % (name, len(value))
+    return name
+
+
+def attributes(value):
+    "The namespace of an object's attributes, if it has one"
+    try:
+        namespace = value.__dict__
+    except Exception:
+        return None
+    if isinstance(namespace, (dict, MAPPING_PROXY)):
+        return namespace
+    return None
+
+
+def page_of(keys, offset, limit):
+    "The keys from `offset` of a list or range of keys"
+    try:
+        return keys[offset:offset + limit]
+    except TypeError:
+        return islice(keys, offset, offset + limit)  # python 2.x can't slice an xrange
+
+
+def has_children(value):
+    if isinstance(value, (dict,) + SEQUENCE_TYPES + SET_TYPES):
+        return len(value) > 0
+    namespace = attributes(value)
+    return bool(namespace)
+
+
+class Inspector(object):
+    """The values a client has been told about while a thread is stopped.
+
+    `refs` is the counter that numbers references; `describe` gives the
+    (abbreviated) repr of a value.
+    """
+    def __init__(self, refs, describe):
+        self.refs = refs
+        self.describe = describe
+        # Reference -> [value, the keys of its children (once listed),
+        # is it a namespace?]
+        self.values = {}
+        # (id(value), is it a namespace?) -> reference, so a value is
+        # only referenced once (as a namespace, and as a value).
+        self._ids = {}
+
+    def ref(self, value, namespace=False):
+        """The reference to a value.
+
+        The children of a namespace (e.g., the locals of a frame) are
+        variables; they are listed by name, in order. A namespace needn't
+        be a dict (on Python 3.13, f_locals is a proxy for the frame).
+        """
+        try:
+            return self._ids[id(value), namespace]
+        except KeyError:
+            ref = next(self.refs)
+            self._ids[id(value), namespace] = ref
+            self.values[ref] = [value, None, namespace]
+            return ref
+
+    def page(self, ref, offset=0, limit=PAGE_SIZE):
+        """A page of the children of a referenced value.
+
+        Returns the total number of children, and a list of dictionaries
+        describing the children from `offset`: their name, their repr, and
+        (if they have children of their own) a reference. Raises KeyError
+        if the reference isn't known.
+        """
+        entry = self.values[ref]
+        value, keys, namespace = entry
+        if keys is None:
+            # Remember the order of the children, so later pages are
+            # consistent with the first.
+            keys = entry[1] = self._keys(value, namespace)
+        children = []
+        for name, child in self._children(value, keys, namespace, offset, limit):
+            children.append({
+                'name': name,
+                'value': self.describe(child),
+                'ref': self.ref(child) if has_children(child) else None,
+            })
+        return len(keys), children
+
+    def _keys(self, value, namespace):
+        if namespace:
+            return sorted(value.keys(), key=unicode)
+        if isinstance(value, dict):
+            return list(value)
+        if isinstance(value, SEQUENCE_TYPES):
+            return range(len(value))
+        if isinstance(value, SET_TYPES):
+            # Sets have no order (or indices) of their own; their members
+            # are listed in iteration order, which is kept (rather than
+            # sorted by repr, which would describe every member at once).
+            return list(value)
+        namespace = attributes(value)
+        if namespace:
+            return sorted(namespace, key=unicode)
+        return []
+
+    def _children(self, value, keys, namespace, offset, limit):
+        "The names and values of a page of children"
+        if isinstance(value, deque) and not namespace:
+            # Indexing a deque is slow away from its ends, so the page is
+            # read in a single pass.
+            try:
+                for index, child in zip(page_of(keys, offset, limit), islice(value, offset, offset + limit)):
+                    yield '[%d]' % index, child
+            except RuntimeError:
+                pass  # Another thread has changed it since it was listed.
+            return
+        for key in page_of(keys, offset, limit):
+            try:
+                yield self._child(value, key, namespace)
+            except (KeyError, IndexError):
+                # Another thread has removed it since it was listed.
+                continue
+
+    def _child(self, value, key, namespace):
+        "The name and value of a child"
+        if namespace:
+            return key, value[key]
+        if isinstance(value, dict):
+            return self.describe(key), value[key]
+        if isinstance(value, SEQUENCE_TYPES):
+            return '[%d]' % key, value[key]
+        if isinstance(value, SET_TYPES):
+            return '', key
+        return key, attributes(value)[key]
@@ -4,9 +4,11 @@ This is the main entry point for the Bugjar GUI.
 from __future__ import unicode_literals
 import argparse
 import os
+import shutil
+import socket
 import subprocess
 import sys
-import time
+import tempfile
 
 try:
     from Tkinter import Tk
@@ -15,8 +17,10 @@ except ImportError:
 
 from bugjar import VERSION
 from bugjar.view import MainWindow
-from bugjar.connection import Debugger
-from bugjar.net import run as net_run
+from bugjar.connection import ConnectionFailed, Debugger
+from bugjar.heatmap import CoverageData
+from bugjar.net import run as net_run, ATTACH_SIGNAL, ENGINES, monitoring
+from bugjar.protocol import CODEC_NAMES, COMPRESSION_NAMES, COMPRESS_THRESHOLD, shared_memory
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -25,12 +29,227 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-v', '--version', action='version', version=VERSION)
 
 
+def add_engine_argument(parser):
+    "Add the option to select the tracing engine used by the net."
+    parser.add_argument(
+        "-e", "--engine",
+        metavar='ENGINE',
+        help="Tracing engine to use; one of %s (default=settrace). "
+             "The monitoring engine requires Python 3.12+." % ', '.join(sorted(ENGINES)),
+        action="store",
+        choices=sorted(ENGINES),
+        default="settrace",
+        dest="engine"
+    )
+
+
+def add_codec_argument(parser):
+    "Add the option to choose how messages are encoded."
+    parser.add_argument(
+        "--codec",
+        metavar='CODEC',
+        help="Encoding to use for messages, if the net supports it; one of %s "
+             "(default=the first of these). Uses JSON if the net can't." % ', '.join(CODEC_NAMES),
+        action="store",
+        choices=CODEC_NAMES,
+        default=None,
+        dest="codec"
+    )
+
+
+def add_compression_arguments(parser):
+    "Add the options to compress large messages."
+    parser.add_argument(
+        "--compress",
+        metavar='COMPRESSION',
+        help="Compress large messages, if the net supports it; one of %s." % ', '.join(COMPRESSION_NAMES),
+        action="store",
+        choices=COMPRESSION_NAMES,
+        default=None,
+        dest="compression"
+    )
+    parser.add_argument(
+        "--compress-level",
+        metavar='LEVEL',
+        help="Compression level (default=6 for zlib, 3 for zstd)",
+        action="store",
+        type=int,
+        default=None,
+        dest="compress_level"
+    )
+    parser.add_argument(
+        "--compress-threshold",
+        metavar='BYTES',
+        help="Only compress messages of at least this size (default=%s)" % COMPRESS_THRESHOLD,
+        action="store",
+        type=int,
+        default=None,
+        dest="compress_threshold"
+    )
+
+
+def check_compression(parser, options):
+    if options.compression is None and (
+            options.compress_level is not None or options.compress_threshold is not None):
+        parser.error("--compress-level and --compress-threshold require --compress.")
+
+
+def add_socket_argument(parser, help):
+    "Add the option to use a Unix domain socket, rather than TCP."
+    if hasattr(socket, 'AF_UNIX'):
+        parser.add_argument(
+            "--socket",
+            metavar='PATH',
+            help=help,
+            action="store",
+            default=None,
+            dest="socket_path"
+        )
+    else:
+        parser.set_defaults(socket_path=None)
+
+
+def add_timeout_argument(parser, help, default=None):
+    "Add the option to limit how long to wait for the net."
+    parser.add_argument(
+        "--timeout",
+        metavar='SECONDS',
+        help=help,
+        action="store",
+        type=float,
+        default=default,
+        dest="timeout"
+    )
+
+
+def add_follow_argument(parser):
+    "Add the option to debug child processes."
+    parser.add_argument(
+        "--follow-children",
+        help="Also debug child processes that are forked or spawned by the script.",
+        action="store_true",
+        dest="follow_children"
+    )
+
+
+def add_profile_arguments(parser):
+    "Add the options to run the sampling profiler."
+    parser.add_argument(
+        "--profile",
+        help="Sample the stacks of all threads while the script runs.",
+        action="store_true",
+        dest="profile"
+    )
+    parser.add_argument(
+        "--profile-rate",
+        metavar='HZ',
+        help="Number of samples to take per second when profiling (default=100)",
+        action="store",
+        type=float,
+        default=100.0,
+        dest="profile_rate"
+    )
+    parser.add_argument(
+        "--profile-output",
+        metavar='FILENAME',
+        help="Save the profile when the debugger exits. A filename ending in .json "
+             "is saved in speedscope format; anything else as collapsed stacks.",
+        action="store",
+        default=None,
+        dest="profile_output"
+    )
+
+
+def check_profile(parser, options):
+    "Ensure the profiler options make sense."
+    if options.profile_rate <= 0:
+        parser.error("--profile-rate must be greater than 0.")
+    if options.profile_output and not options.profile:
+        parser.error("--profile-output requires --profile.")
+
+
+def add_heatmap_arguments(parser):
+    "Add the options to count line executions."
+    parser.add_argument(
+        "--heatmap",
+        help="Count how many times each line is executed, and shade the code by those counts.",
+        action="store_true",
+        dest="heatmap"
+    )
+    parser.add_argument(
+        "--heatmap-output",
+        metavar='FILENAME',
+        help="Save the lines that were executed as a coverage.py data file "
+             "when the debugger exits.",
+        action="store",
+        default=None,
+        dest="heatmap_output"
+    )
+
+
+def check_heatmap(parser, options):
+    "Ensure lines can be counted."
+    if options.heatmap_output and not options.heatmap:
+        parser.error("--heatmap-output requires --heatmap.")
+    if options.heatmap_output and CoverageData is None:
+        parser.error("--heatmap-output requires coverage.py to be installed.")
+    if options.heatmap and monitoring is None and options.engine != 'settrace':
+        parser.error("Before Python 3.12, --heatmap requires the settrace engine.")
+
+
+def add_record_arguments(parser):
+    "Add the options to record execution, so it can be stepped back through."
+    parser.add_argument(
+        "--record",
+        help="Record the lines that are executed, and how the locals change, "
+             "so that a stopped program can step backwards.",
+        action="store_true",
+        dest="record"
+    )
+    parser.add_argument(
+        "--record-memory",
+        metavar='MB',
+        help="The memory (in MB) the recording may use before the oldest "
+             "part is discarded (default=64)",
+        action="store",
+        type=float,
+        default=64,
+        dest="record_memory"
+    )
+
+
+def check_record(parser, options):
+    "Ensure execution can be recorded."
+    if options.record_memory <= 0:
+        parser.error("--record-memory must be greater than 0.")
+    if options.record and monitoring is None and options.engine != 'settrace':
+        parser.error("Before Python 3.12, --record requires the settrace engine.")
+
+
+def check_follow(parser, options):
+    "Ensure child processes can be followed."
+    if options.follow_children and not hasattr(os, 'register_at_fork'):
+        parser.error("--follow-children requires Python 3.7 or later on a POSIX platform.")
+
+
+def check_engine(parser, options):
+    "Ensure the requested tracing engine is available."
+    if options.engine == 'monitoring' and monitoring is None:
+        parser.error("The monitoring engine requires Python 3.12 or later.")
+
+
 def jar_run(debugger):
     # Set up the root Tk context
     root = Tk()
 
     # Construct a window debugging the nominated program
-    view = MainWindow(root, debugger)
+    try:
+        view = MainWindow(root, debugger)
+    except ConnectionFailed as e:
+        root.destroy()
+        if debugger.proc is not None and debugger.proc.poll() is None:
+            debugger.proc.kill()
+        sys.exit("bugjar: %s" % e)
 
     # Run the main loop
     try:
@@ -48,12 +267,33 @@ def local():
     parser.add_argument(
         "-p", "--port",
         metavar='PORT',
-        help="Port number to use for debugger communications (default=3742)",
+        help="Port number to use for debugger communications. By default, a Unix domain socket "
+             "that only you can use is used instead, if the platform has them; otherwise, "
+             "port 3742.",
         action="store",
         type=int,
-        default=3742,
+        default=None,
         dest="port"
     )
+    parser.add_argument(
+        "--shared-memory",
+        metavar='MB',
+        help="Send large messages (such as stacks) from the script through a ring buffer "
+             "of this size (in MB) in shared memory. Requires Python 3.8+, and a Unix "
+             "domain socket.",
+        action="store",
+        type=float,
+        default=None,
+        dest="shared_memory"
+    )
+    add_timeout_argument(parser, "How long to wait for the script's debugger to start (default=30)", 30.0)
+    add_engine_argument(parser)
+    add_codec_argument(parser)
+    add_compression_arguments(parser)
+    add_follow_argument(parser)
+    add_profile_arguments(parser)
+    add_heatmap_arguments(parser)
+    add_record_arguments(parser)
 
     parser.add_argument(
         'filename',
@@ -66,25 +306,97 @@ def local():
     )
 
     options = parser.parse_args()
+    check_engine(parser, options)
+    check_compression(parser, options)
+    check_follow(parser, options)
+    check_profile(parser, options)
+    check_heatmap(parser, options)
+    check_record(parser, options)
+
+    use_socket = options.port is None and hasattr(socket, 'AF_UNIX')
+    if options.shared_memory is not None:
+        if shared_memory is None:
+            parser.error("--shared-memory requires Python 3.8 or later.")
+        if not use_socket:
+            parser.error("--shared-memory requires a Unix domain socket (don't use --port).")
+        if options.shared_memory <= 0:
+            parser.error("--shared-memory must be greater than 0.")
+
+    # The socket (and the ready file, if there is one) live in a
+    # directory only we can use.
+    session_dir = tempfile.mkdtemp(prefix='bugjar-')
+    if use_socket:
+        socket_path = os.path.join(session_dir, 'net.sock')
+        address_args = ["--socket", socket_path]
+    else:
+        socket_path = None
+        port = options.port or 3742
+        address_args = ["--port", str(port)]
+
+    # The net says when it is listening: on a pipe it inherits, where
+    # that's possible, or by writing a file.
+    popen_args = {'close_fds': 'posix' in sys.builtin_module_names}
+    if sys.version_info[0] >= 3 and os.name == 'posix':
+        ready_fd, ready_write_fd = os.pipe()
+        ready_file = None
+        ready_args = ["--ready-fd", str(ready_write_fd)]
+        popen_args['pass_fds'] = (ready_write_fd,)
+    else:
+        ready_fd = ready_write_fd = None
+        ready_file = os.path.join(session_dir, 'ready')
+        ready_args = ["--ready-file", ready_file]
+
+    mode_args = []
+    if options.profile:
+        mode_args = ["--profile", "--profile-rate", str(options.profile_rate)]
+        if options.profile_output:
+            mode_args.extend(["--profile-output", options.profile_output])
+    if options.heatmap:
+        mode_args.append("--heatmap")
+        if options.heatmap_output:
+            mode_args.extend(["--heatmap-output", options.heatmap_output])
+    if options.record:
+        mode_args.extend(["--record", "--record-memory", str(options.record_memory)])
 
     # Start the program to be debugged
     proc = subprocess.Popen(
-        ["bugjar-net", options.filename] + options.args,
+        [
+            "bugjar-net",
+        ] + address_args + ready_args + [
+            "--engine", options.engine,
+        ] + (["--follow-children"] if options.follow_children else []) + mode_args + [
+            options.filename
+        ] + options.args,
         stdin=None,
         stdout=None,
         stderr=None,
         shell=False,
         bufsize=1,
-        close_fds='posix' in sys.builtin_module_names
+        **popen_args
     )
-    # Pause, ever so briefly, so that the net can be established.
-    time.sleep(0.1)
+    if ready_write_fd is not None:
+        # Only the net should hold the write end, so we see it close.
+        os.close(ready_write_fd)
 
     # Create a connection to the debugger instance
-    debugger = Debugger('localhost', options.port, proc=proc)
+    debugger = Debugger(
+        'localhost', None if use_socket else port, proc=proc,
+        codecs=[options.codec] if options.codec else None,
+        compression=options.compression,
+        compress_level=options.compress_level,
+        compress_threshold=options.compress_threshold,
+        path=socket_path,
+        shared_memory=int(options.shared_memory * 1024 * 1024) if options.shared_memory else None,
+        ready_fd=ready_fd,
+        ready_file=ready_file,
+        timeout=options.timeout,
+    )
 
     # Run the debugger
-    jar_run(debugger)
+    try:
+        jar_run(debugger)
+    finally:
+        shutil.rmtree(session_dir, ignore_errors=True)
 
 
 def jar():
@@ -109,11 +421,25 @@ def jar():
         default=3742,
         dest="port"
     )
+    add_socket_argument(parser, "Connect to a headless debugger on this machine, listening on the "
+                                "Unix domain socket at PATH, rather than to a host and port.")
+    add_timeout_argument(parser, "How long to wait for the headless debugger to answer (default=forever)")
+    add_codec_argument(parser)
+    add_compression_arguments(parser)
 
     options = parser.parse_args()
+    check_compression(parser, options)
 
     # Create a connection to the remote debugger instance
-    debugger = Debugger(options.hostname, options.port, proc=None)
+    debugger = Debugger(
+        options.hostname, options.port, proc=None,
+        codecs=[options.codec] if options.codec else None,
+        compression=options.compression,
+        compress_level=options.compress_level,
+        compress_threshold=options.compress_threshold,
+        path=options.socket_path,
+        timeout=options.timeout,
+    )
 
     # Run the debugger
     jar_run(debugger)
@@ -141,6 +467,37 @@ def net():
         default=3742,
         dest="port"
     )
+    add_socket_argument(parser, "Listen for connections on a Unix domain socket at PATH, "
+                                "rather than on a host and port. Only you can connect to it.")
+    parser.add_argument(
+        "--ready-fd",
+        metavar='FD',
+        help="Once listening for connections, write the address to this (inherited) "
+             "file descriptor, and close it.",
+        action="store",
+        type=int,
+        default=None,
+        dest="ready_fd"
+    )
+    parser.add_argument(
+        "--ready-file",
+        metavar='PATH',
+        help="Once listening for connections, write the address to a file at PATH.",
+        action="store",
+        default=None,
+        dest="ready_file"
+    )
+    add_engine_argument(parser)
+    parser.add_argument(
+        "--attach-on-connect",
+        help="Run the script at full speed until a client connects.",
+        action="store_true",
+        dest="attach_on_connect"
+    )
+    add_follow_argument(parser)
+    add_profile_arguments(parser)
+    add_heatmap_arguments(parser)
+    add_record_arguments(parser)
     parser.add_argument(
         'filename',
         metavar='script.py',
@@ -152,13 +509,33 @@ def net():
     )
 
     options = parser.parse_args()
+    check_engine(parser, options)
+    check_follow(parser, options)
+    check_profile(parser, options)
+    check_heatmap(parser, options)
+    check_record(parser, options)
+    if options.attach_on_connect and options.engine != 'monitoring' and ATTACH_SIGNAL is None:
+        parser.error("--attach-on-connect requires the monitoring engine on this platform.")
 
     # Convert the filename provided on the command line into a canonical form
     filename = os.path.abspath(options.filename)
     filename = os.path.normcase(filename)
 
     # Run the debugger
-    net_run(options.hostname, options.port, filename, *options.args)
+    net_run(
+        options.hostname, options.port, filename, *options.args,
+        engine=options.engine,
+        socket_path=options.socket_path and os.path.abspath(options.socket_path),
+        ready_fd=options.ready_fd,
+        ready_file=options.ready_file,
+        attach_on_connect=options.attach_on_connect,
+        follow_children=options.follow_children,
+        profile=1.0 / options.profile_rate if options.profile else None,
+        profile_output=options.profile_output,
+        heatmap=options.heatmap,
+        heatmap_output=options.heatmap_output,
+        record=int(options.record_memory * 1024 * 1024) if options.record else None
+    )
 
 if __name__ == '__main__':
     local()
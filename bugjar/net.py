@@ -14,20 +14,69 @@ License terms for the original PDB code can be found here:
 """
 
 from __future__ import print_function, unicode_literals
+import __future__
+import ast
 import bdb
+import dis
+import gc
 import linecache
 import json
 import os
 import re
+import signal
 import socket
+import string
 import sys
-from threading import Thread
+import threading
+from threading import Event, Lock, RLock, Thread, local
+import time
 import traceback
+import types
+from collections import deque
+from itertools import count
 
 try:
-    from Queue import Queue
+    from Queue import Empty, Queue
 except ImportError:
-    from queue import Queue  # python 3.x
+    from queue import Empty, Queue  # python 3.x
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident  # python 2.x
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins  # python 2.x
+
+try:
+    basestring
+except NameError:
+    basestring = str  # python 3.x
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time  # python 2.x
+
+try:
+    monitoring = sys.monitoring
+except AttributeError:
+    monitoring = None  # python < 3.12
+
+from bugjar.heatmap import LineCounts
+from bugjar.history import History
+from bugjar.hub import Hub
+from bugjar.protocol import (
+    CODEC_NAMES, COMPRESSION_NAMES, ETX_FRAMING, FEATURES, FRAMINGS, INSPECT, LENGTH_FRAMING,
+    NAMESPACES, SHARED_MEMORY, STACK_DELTA, SharedRing, diff_frame, diff_namespace,
+    get_codec, get_compression, shared_memory
+)
+from bugjar.inspector import PAGE_SIZE, Inspector, summarize
+from bugjar.reprs import ReprEngine
+from bugjar.watchpoints import Watchpoint, Watchpoints
+from bugjar.profiler import Sampler
 
 
 class Restart(Exception):
@@ -40,7 +89,204 @@ class ClientClose(Exception):
     pass
 
 
-__all__ = ["Debugger"]
+__all__ = ["Debugger", "MonitoringDebugger", "PatchingDebugger", "ENGINES"]
+
+
+# How many clients can be waiting to be accepted at once.
+LISTEN_BACKLOG = 5
+
+# The commands a client can send without having control of the session.
+OBSERVER_COMMANDS = ('inspect',)
+
+# Events sent while running a command that only the client that sent the
+# command is told about.
+REPLIES = ('error', 'inspection', 'done')
+
+# Queued (in place of a command) to a stopped thread, so it describes its
+# stop to a client that has just connected.
+GREET = object()
+
+# The signal used to interrupt the script when a client attaches.
+# Not available on Windows.
+ATTACH_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+# The name of the builtin that patched breakpoints call.
+TRAP_NAME = '__bugjar_trap__'
+
+# Statements whose first line runs again once they have started (on each
+# pass of a loop, or on leaving a with block); a trap can't catch them.
+RERUN_STATEMENTS = tuple(
+    getattr(ast, name) for name in ('For', 'AsyncFor', 'While', 'With', 'AsyncWith')
+    if hasattr(ast, name)
+)
+
+# Logpoint messages are buffered, and sent to the client in batches: when
+# a batch is full, or after an interval. If the client can't keep up, the
+# oldest messages are dropped once the buffer is full.
+LOG_BUFFER_SIZE = 10000
+LOG_BATCH_SIZE = 1000
+LOG_INTERVAL = 0.1
+
+# How often (in seconds) line counts are sent to the client.
+HEATMAP_INTERVAL = 1.0
+
+# The compiler flags for every __future__ feature.
+FUTURE_FLAGS = 0
+for _feature in __future__.all_feature_names:
+    FUTURE_FLAGS |= getattr(__future__, _feature).compiler_flag
+
+# The code flags of coroutines and asynchronous generators. Their frames
+# return to the event loop every time they await something.
+CO_ASYNC = 0x0080 | 0x0200  # CO_COROUTINE | CO_ASYNC_GENERATOR
+
+# The instructions at which a generator or coroutine is suspended.
+YIELD_VALUE = dis.opmap['YIELD_VALUE']
+YIELD_FROM = dis.opmap.get('YIELD_FROM')  # Python < 3.11
+
+
+def is_suspended(frame):
+    """Is a returning coroutine frame suspended, rather than finished?
+
+    A coroutine frame returns every time it awaits something that
+    isn't ready; it has only finished if it returns anywhere else.
+    """
+    code = bytearray(frame.f_code.co_code)
+    lasti = frame.f_lasti
+    if lasti < 0:
+        return False
+    if code[lasti] in (YIELD_VALUE, YIELD_FROM):
+        return True
+    # Before Python 3.11, the last instruction is the one before the
+    # YIELD_FROM, so that it repeats when the coroutine resumes; from
+    # Python 3.13, it's the one after the YIELD_VALUE.
+    if YIELD_FROM is not None:
+        return lasti + 2 < len(code) and code[lasti + 2] == YIELD_FROM
+    return lasti >= 2 and code[lasti - 2] == YIELD_VALUE
+
+
+def is_asyncio(frame):
+    "Is the frame part of asyncio itself?"
+    return (frame.f_globals.get('__name__') or '').partition('.')[0] == 'asyncio'
+
+
+def asyncio_tasks():
+    """Find the asyncio tasks of the event loop running in this thread.
+
+    Returns a list of tasks, and the task that is currently running.
+    If the program isn't using asyncio at all, the list is None.
+    """
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None or not hasattr(asyncio, '_get_running_loop'):
+        return None, None
+    loop = asyncio._get_running_loop()
+    if loop is None:
+        return [], None
+    try:
+        return list(asyncio.all_tasks(loop)), asyncio.current_task(loop)
+    except AttributeError:
+        # Python < 3.7
+        return [
+            task for task in asyncio.Task.all_tasks(loop) if not task.done()
+        ], asyncio.Task.current_task(loop)
+
+
+def coroutine_frames(task):
+    """The frames of the chain of coroutines in a task, outermost first.
+
+    The chain is followed through every coroutine (or generator) that
+    is being awaited, until it reaches something - usually a future -
+    that isn't a coroutine.
+    """
+    frames = []
+    coro = task.get_coro() if hasattr(task, 'get_coro') else task._coro
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None) or getattr(coro, 'ag_frame', None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None) or getattr(coro, 'ag_await', None)
+    return frames
+
+
+class Logpoint(object):
+    """The compiled message of a logpoint.
+
+    The message uses the syntax of str.format(), but the replacement
+    fields are Python expressions, evaluated in the frame that hit the
+    logpoint - e.g., "total is {sum(items):.2f} after {i!r}", or
+    "{name:>{width}}". All the expressions are compiled into a single
+    piece of code.
+    """
+    # The conversions a replacement field can ask for; on python 2.x,
+    # repr() is already ASCII.
+    CONVERSIONS = {'r': repr, 's': str, 'a': getattr(builtins, 'ascii', repr)}
+
+    def __init__(self, message):
+        self.message = message
+        expressions = []
+        self.parts = self._parse(message, expressions, 0)
+        self.code = compile('(%s)' % ''.join(expressions), '<logpoint>', 'eval', 0, True)
+
+    def _parse(self, text, expressions, depth):
+        """Split `text` into (literal, field, spec, conversion) parts,
+        adding the expression of every field to `expressions`.
+
+        The spec of a field is itself parsed into parts, as it can
+        contain replacement fields of its own - but, as in str.format(),
+        only one level deep.
+        """
+        parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if field is None:
+                parts.append((literal, False, None, None))
+                continue
+            if not field.strip():
+                raise ValueError('Every {} in a log message must contain an expression')
+            if depth > 1:
+                raise ValueError('Replacement fields in a log message can only be nested one level deep')
+            if conversion is not None and conversion not in self.CONVERSIONS:
+                raise ValueError('Unknown conversion !%s in a log message' % conversion)
+            expressions.append('(%s), ' % field)
+            parts.append((literal, True, self._parse(spec, expressions, depth + 1) if spec else [], self.CONVERSIONS.get(conversion)))
+        return parts
+
+    def _render(self, parts, values):
+        "Join `parts`, taking the value of each field from `values`."
+        pieces = []
+        for literal, field, spec, conversion in parts:
+            pieces.append(literal)
+            if field:
+                value = next(values)
+                if conversion is not None:
+                    value = conversion(value)
+                pieces.append(format(value, self._render(spec, values)))
+        return ''.join(pieces)
+
+    def format(self, frame):
+        "Produce the message for a hit of the logpoint in the given frame."
+        return self._render(self.parts, iter(eval(self.code, frame.f_globals, frame.f_locals)))
+
+
+class Watch(object):
+    """A watch expression, compiled once.
+
+    The repr of its value is evaluated in the current frame whenever a
+    thread stops; `value` is the result that was last sent to the client.
+    """
+    def __init__(self, number, expression):
+        self.number = number
+        self.expression = expression
+        self.code = compile(expression, '<watch>', 'eval', 0, True)
+        self.value = None
+
+    def evaluate(self, frame_globals, frame_locals, describe=repr):
+        """The repr of the value of the expression (as given by `describe`),
+        or a description of the error it raised.
+        """
+        try:
+            return describe(eval(self.code, frame_globals, frame_locals))
+        except Exception as e:
+            return '<%s: %s>' % (type(e).__name__, e)
 
 
 def find_function(funcname, filename):
@@ -64,50 +310,225 @@ def find_function(funcname, filename):
     return answer
 
 
-def command_buffer(debugger):
-    "Buffer input from a socket, yielding complete command packets."
-    remainder = b''
-    while True:
-        new_buffer = debugger.client.recv(1024)
+def source_file(filename):
+    "The source file for a module's __file__, which may be compiled."
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+    return filename
 
-        if not new_buffer:
-            # If recv() returns None, the socket has closed
-            break
-        else:
-            # print "SERVER NEW BUFFER: %s >%s<" % (len(new_buffer), new_buffer[:50])
-            if new_buffer[-1] == debugger.ETX:
-                terminator = new_buffer[-1]
-                full_buffer = remainder + new_buffer[:-1]
-            else:
-                terminator = None
-                full_buffer = remainder + new_buffer
 
-            messages = full_buffer.split(debugger.ETX)
-            if terminator is None:
-                remainder = messages.pop()
+def command_buffer(debugger, client):
+    "Read command packets from a client, and queue them for the debugger."
+    # Anything this thread sends (errors, mostly) is for this client alone.
+    debugger._request.client = client
+    debugger._request.private = True
+    channel = client.channel
+    try:
+        for message in channel.payloads():
+            # print "READ %s bytes" % len(message)
+            try:
+                command, args = channel.unpack(message)
+            except ValueError:
+                print("Invalid command: %s" % message.decode('utf8', 'replace'))
+                continue
+            if command == 'protocol':
+                # This changes how the rest of the stream is read, so it
+                # can't wait in the queue.
+                debugger.use_protocol(client, **args)
+            elif command == 'control':
+                # Control can change hands while the program is running.
+                debugger.control(client, **args)
             else:
-                remainder = b''
-            for message in messages:
-                # print "READ %s bytes" % len(message)
-                # command, args = json.loads(message)
-                message = message.decode('utf8')
-                try:
-                    debugger.commands.put(json.loads(message))
-                except ValueError:
-                    print("Invalid command: %s" % message)
+                debugger.queue_command(command, args, client)
+    except socket.error:
+        pass
 
     # print "FINISH PROCESSING SERVER COMMAND BUFFER"
-    debugger.commands.put(('close', {}))
+    debugger.disconnect(client)
+
+
+class BreakpointIndex(object):
+    """An index of the enabled breakpoints, by file and by code object.
+
+    Bdb asks `break_anywhere()` on every call event, which canonicalizes
+    the filename of every frame that is entered. The index answers the
+    same question for a code object with a couple of dictionary lookups,
+    and only says yes if an enabled breakpoint falls inside the range of
+    lines covered by the code object.
+
+    The index must be told when a breakpoint is created, cleared, enabled
+    or disabled (see `update()`).
+    """
+    def __init__(self, canonic):
+        self.canonic = canonic
+
+        # Canonical filename -> {line: set of enabled breakpoint numbers}
+        self.files = {}
+        # Raw co_filename -> breakpoint lines for that file.
+        self._filenames = {}
+        # Code object -> (first line, last line)
+        self._ranges = {}
+        # Code object -> (generation, has breakpoints)
+        self._codes = {}
+        # Incremented whenever the set of enabled breakpoints changes.
+        self.generation = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _lines(self, co_filename):
+        "Return the breakpoint lines for a raw code filename."
+        try:
+            return self._filenames[co_filename]
+        except KeyError:
+            lines = self.files.setdefault(self.canonic(co_filename), {})
+            self._filenames[co_filename] = lines
+            return lines
+
+    def _range(self, code):
+        "Return the range of lines covered by a code object."
+        try:
+            return self._ranges[code]
+        except KeyError:
+            last = code.co_firstlineno
+            for _, line in dis.findlinestarts(code):
+                if line is not None and line > last:
+                    last = line
+            self._ranges[code] = code.co_firstlineno, last
+            return self._ranges[code]
+
+    def update(self, bp):
+        "Record the current state of a breakpoint."
+        lines = self.files.setdefault(bp.file, {})
+        bpnums = lines.setdefault(bp.line, set())
+        before = len(bpnums)
+        if bp.enabled and bdb.Breakpoint.bpbynumber[bp.number] is bp:
+            bpnums.add(bp.number)
+        else:
+            bpnums.discard(bp.number)
+            if not bpnums:
+                del lines[bp.line]
+        if len(bpnums) != before:
+            self.count = self.count + len(bpnums) - before
+            self.generation = self.generation + 1
+
+    def has_line(self, co_filename, line):
+        "Is there an enabled breakpoint on a line of a file?"
+        return line in self._lines(co_filename)
+
+    def has_breaks(self, code):
+        "Is there an enabled breakpoint in the lines covered by a code object?"
+        lines = self._lines(code.co_filename)
+        if not lines:
+            return False
+        try:
+            generation, found = self._codes[code]
+            if generation == self.generation:
+                return found
+        except KeyError:
+            pass
+        first, last = self._range(code)
+        found = any(first <= line <= last for line in lines)
+        self._codes[code] = self.generation, found
+        return found
+
+
+class ThreadState(object):
+    """The stop state of a single thread of the program being debugged.
+
+    Bdb keeps its stop state (stopframe, botframe, and so on) as attributes
+    of the debugger; the Debugger redirects those attributes to the state
+    of whichever thread is asking (see `ThreadAttribute`).
+    """
+    def __init__(self, ident, name):
+        self.ident = ident
+        self.name = name
+
+        # Bdb's stop state
+        self.botframe = None
+        self.stopframe = None
+        self.returnframe = None
+        self.stoplineno = 0
+        self.frame_returning = None
+        self.currentbp = None
+        self.enterframe = None
+        self.cmdframe = None
+        self.cmdlineno = None
+
+        # The stack, while the thread is stopped.
+        self.line = None
+        self.stack = []
+        self.curindex = 0
+        self.curframe = None
+        self.curframe_locals = None
+        # The values the client has been told about, while stopped.
+        self.inspector = None
+
+        self.stopped = False
+        # If replaying the recorded history of the thread, the Replay.
+        self.replay = None
+        # Commands from the client, while the thread is stopped.
+        self.commands = Queue()
+        # Allowed to run, even though another thread has frozen the program.
+        self.thawed = False
+
+
+class ThreadAttribute(object):
+    "An attribute of the debugger that has a separate value in each thread."
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, debugger, owner):
+        if debugger is None:
+            return self
+        # This is on the tracing hot path, so thread_state() is inlined.
+        try:
+            state = debugger._thread_states[get_ident()]
+        except KeyError:
+            state = debugger._register_thread()
+        return getattr(state, self.name)
+
+    def __set__(self, debugger, value):
+        setattr(debugger.thread_state(), self.name, value)
 
 
-class Debugger(bdb.Bdb):
+# On Python 2, bdb.Bdb is an old-style class, which would bypass the
+# ThreadAttributes below; `object` makes the debugger a new-style class.
+class Debugger(bdb.Bdb, object):
     NOT_STARTED = 0
     STARTING = 1
     STARTED = 2
 
     ETX = b'\x03'
 
-    def __init__(self, socket, host, port, skip=None):
+    # Can the trace function pass every event to line observers?
+    # (see observe_lines())
+    OBSERVES_LINES = True
+
+    # Stop state is kept separately for every thread.
+    botframe = ThreadAttribute('botframe')
+    stopframe = ThreadAttribute('stopframe')
+    returnframe = ThreadAttribute('returnframe')
+    stoplineno = ThreadAttribute('stoplineno')
+    frame_returning = ThreadAttribute('frame_returning')
+    currentbp = ThreadAttribute('currentbp')
+    enterframe = ThreadAttribute('enterframe')
+    cmdframe = ThreadAttribute('cmdframe')
+    cmdlineno = ThreadAttribute('cmdlineno')
+    line = ThreadAttribute('line')
+    stack = ThreadAttribute('stack')
+    curindex = ThreadAttribute('curindex')
+    curframe = ThreadAttribute('curframe')
+    curframe_locals = ThreadAttribute('curframe_locals')
+    inspector = ThreadAttribute('inspector')
+    replay = ThreadAttribute('replay')
+
+    def __init__(self, socket, host, port, skip=None, attach_on_connect=False, path=None):
+        # Thread ident -> ThreadState (None for the debugger's own threads)
+        self._thread_states = {}
+        # Threads that belong to the debugger, and are never traced.
+        self._own_threads = set()
         bdb.Bdb.__init__(self, skip=skip)
 
         self._run_state = Debugger.NOT_STARTED
@@ -115,75 +536,950 @@ class Debugger(bdb.Bdb):
         self.socket = socket
         self.host = host
         self.port = port
-        self.client = None
-        self.command_thread = None
-        self.commands = None
+        # If listening on a Unix domain socket, its path.
+        self.path = path
+        # The connected clients (see bugjar.hub).
+        self.hub = Hub(self.start_thread)
+        self._frame_ids = count(1)
+        # Numbers the references to values handed out by inspectors.
+        self._inspect_refs = count(1)
+        # id(namespace) -> (namespace id, namespace) for the globals and
+        # builtins sent to clients.
+        self._namespaces = {}
+        self._namespace_ids = count(1)
+        self._namespace_lock = Lock()
+        # Commands waiting for a thread to stop.
+        self.commands = Queue()
+
+        # If attaching on connect, clients are accepted in the background,
+        # and the script runs untraced until one connects.
+        self.attach_on_connect = attach_on_connect
+        # The thread that is running the script.
+        self._thread_ident = None
+        self._client_lock = RLock()
+        # The client whose command each thread is running, and the id of
+        # the request (if the client gave it one), which is added to
+        # everything the thread sends that client. While `private`, the
+        # thread only talks to that client.
+        self._request = local()
+
+        # The threads that are currently stopped, in the order they stopped.
+        # Commands that don't name a thread go to the current thread.
+        self._stopped = []
+        self._current_thread = None
+
+        # If freezing, all other threads wait while a thread is stopped.
+        self.freeze_threads = False
+        self._frozen = False
+        self._running = Event()
+        self._running.set()
+
+        self.breakpoint_index = BreakpointIndex(self.canonic)
+
+        # Breakpoint number -> compiled condition
+        self.conditions = {}
+        # Breakpoint number -> [evaluations, seconds spent evaluating]
+        self.condition_timings = {}
+        # Breakpoint number -> the statistics last sent to the client
+        self._reported_stats = {}
+
+        # Breakpoint number -> the Logpoint for breakpoints that log
+        # a message instead of stopping.
+        self.logpoints = {}
+        self.log_buffer = deque(maxlen=LOG_BUFFER_SIZE)
+        self.log_dropped = 0
+        self._log_ready = Event()
+        self._log_lock = Lock()
+        self._log_thread = None
+
+        # Watch number -> Watch
+        self.watches = {}
+        self._next_watch = 1
+
+        # The data watchpoints, once one has been set.
+        self.watchpoints = None
+        self._next_watchpoint = 1
+
+        # Every value shown to the client is described by the repr engine.
+        self.reprs = ReprEngine(start_thread=self.start_thread)
+        self._repr_totals = (0, 0.0, 0)
+
+        # If following children, the address that child processes report
+        # to. Only the top process listens on it, and tracks the children.
+        self.registry = None
+        self.children = {}
+        self.forked = False
+        self._registry_socket = None
+        self._registry_connection = None
+
+        # If profiling, the sampler that is collecting the profile.
+        self.sampler = None
+        self._profile_lock = Lock()
+
+        # If counting lines, the counts.
+        self.line_counts = None
+        self._heatmap_lock = Lock()
+
+        # If recording, the history of recent execution.
+        self.history = None
+
+        # Without sys.monitoring, lines are counted and recorded by the
+        # trace function, which passes every event to these observers.
+        self._line_observers = []
+        self._line_codes = []
+        self._trace_lines = False
 
     def output(self, event, **data):
-        try:
-            # print "OUTPUT %s byte %s message" % (len(json.dumps((event, data)) + Debugger.ETX), event)
-            # print json.dumps((event, data))
-            dumped = json.dumps((event, data))
-            if not isinstance(dumped, bytes):
-                dumped = dumped.encode('utf8')
-            self.client.sendall(dumped + Debugger.ETX)
-        except socket.error:
-            pass
-            # print "CLIENT ERROR", e
-        except AttributeError:
-            pass
-            # print "No client yet"
+        "Send an event to every client that should see it"
+        self.send(self.audience(event), event, data)
 
-    def output_stack(self):
-        "Output the current stack"
+    def audience(self, event):
+        """The clients an event is for.
+
+        Events are for every client, except when they're the reply to a
+        command, or the thread is talking to one client in private.
+        """
+        client = getattr(self._request, 'client', None)
+        if client is not None and (getattr(self._request, 'private', False) or event in REPLIES):
+            return [client]
+        return self.hub.clients
+
+    def send(self, clients, event, data):
+        "Queue an event for some clients"
+        # print "OUTPUT %s message" % event
+        request = getattr(self._request, 'id', None)
+        requester = getattr(self._request, 'client', None)
+        for client in clients:
+            if request is not None and client is requester and 'request' not in data:
+                client.send(event, dict(data, request=request))
+            else:
+                client.send(event, data)
+
+    def visible_stack(self):
+        "The part of the current stack that is shown to the client"
         # If this is a normal operational stack frame,
         # the top two frames are BDB and the Bugjar frame
         # that is executing the program.
         # If this is an exception, there are 2 extra frames
         # from the Bugjar net.
         # All these frames can be ignored.
-        if self.stack[1][0].f_code.co_filename == '<string>':
+        # Other threads start in the threading module; skip those frames.
+        str_index = 0
+        if get_ident() != self._thread_ident:
+            while (str_index < len(self.stack) - 1 and
+                    self.stack[str_index][0].f_globals.get('__name__') == 'threading'):
+                str_index = str_index + 1
+        elif self.stack[1][0].f_code.co_filename == '<string>':
             str_index = 2
         elif self.stack[3][0].f_code.co_filename == '<string>':
             str_index = 4
+        return self.stack[str_index:]
 
-        stack_data = [
-            (
-                line_no,
-                {
-                    'filename': frame.f_code.co_filename,
-                    'locals': dict((k, repr(v)) for k, v in frame.f_locals.items()),
-                    'globals': dict((k, repr(v)) for k, v in frame.f_globals.items()),
-                    'builtins': dict((k, repr(v)) for k, v in frame.f_builtins.items()),
-                    'restricted': getattr(frame, 'f_restricted', ''),
-                    'lasti': repr(frame.f_lasti),
-                    'exc_type': repr(getattr(frame, 'f_exc_type', '')),
-                    'exc_value': repr(getattr(frame, 'f_exc_value', '')),
-                    'exc_traceback': repr(getattr(frame, 'f_exc_traceback', '')),
-                    'current': frame is self.curframe,
-                }
+    def output_stack(self):
+        """Output the current stack.
+
+        The stack is described once for all the clients that chose the
+        same way of describing variables. Observers are always sent the
+        whole stack, so a newer stack can replace one they haven't been
+        sent yet.
+        """
+        frames = self.visible_stack()
+        thread = get_ident()
+        # A client may be choosing its protocol while the stack is
+        # described; describe it all for the same features.
+        kinds = {}
+        for client in self.audience('stack'):
+            features = client.channel.features
+            if INSPECT in features:
+                kind = INSPECT
+            elif NAMESPACES in features:
+                kind = NAMESPACES
+            else:
+                kind = None
+            kinds.setdefault(kind, []).append((client, STACK_DELTA in features and not client.observer))
+
+        for kind, clients in kinds.items():
+            if kind == INSPECT:
+                describe = self.summarize_frame
+            elif kind == NAMESPACES:
+                describe = self.share_namespaces(frames, [client for client, delta in clients])
+            else:
+                describe = self.describe_frame
+            stack_data = [(line_no, describe(frame)) for frame, line_no in frames]
+            for client, delta in clients:
+                if delta:
+                    self.send([client], 'stack_delta', {
+                        'frames': self.stack_delta(client, frames, stack_data), 'thread': thread
+                    })
+                else:
+                    # The client replaces its stack with this one, so the
+                    # next stack it is sent as a delta must be sent in full.
+                    client.sent_stacks.pop(thread, None)
+                    self.send([client], 'stack', {'stack': stack_data, 'thread': thread})
+
+    def describe_frame(self, frame, namespaces=True):
+        """Describe a frame, with the repr of every variable it can see
+        (unless `namespaces` is False).
+        """
+        description = {
+            'filename': frame.f_code.co_filename,
+            'restricted': getattr(frame, 'f_restricted', ''),
+            'lasti': repr(frame.f_lasti),
+            'exc_type': repr(getattr(frame, 'f_exc_type', '')),
+            'exc_value': repr(getattr(frame, 'f_exc_value', '')),
+            'exc_traceback': repr(getattr(frame, 'f_exc_traceback', '')),
+            'current': frame is self.curframe,
+        }
+        if namespaces:
+            description['locals'] = self.describe_namespace(frame.f_locals)
+            description['globals'] = self.describe_namespace(frame.f_globals)
+            description['builtins'] = self.describe_namespace(frame.f_builtins)
+        return description
+
+    def describe_namespace(self, namespace):
+        "The reprs of the variables in a namespace"
+        describe = self.reprs.repr
+        return dict((k, describe(v)) for k, v in namespace.items())
+
+    def share_namespaces(self, frames, clients):
+        """Send the globals and builtins of a stack to some clients, so
+        frames can refer to them by id.
+
+        Every namespace is sent to a client in full the first time it's
+        seen, and after that, only when (and what) it has changed. Returns
+        a function that describes a frame with those ids in place of its
+        globals and builtins (and of its locals, in module code).
+        """
+        with self._namespace_lock:
+            ids = {}
+            for frame, line_no in frames:
+                for namespace in (frame.f_globals, frame.f_builtins):
+                    if id(namespace) in ids:
+                        continue
+                    known = self._namespaces.get(id(namespace))
+                    if known is None or known[1] is not namespace:
+                        # Keep the namespace, so its id can't be reused.
+                        known = self._namespaces[id(namespace)] = (next(self._namespace_ids), namespace)
+                    namespace_id = known[0]
+                    reprs = self.describe_namespace(namespace)
+                    for client in clients:
+                        sent = client.namespaces.get(namespace_id)
+                        if sent is None:
+                            self.send([client], 'namespace', {'id': namespace_id, 'variables': reprs})
+                        else:
+                            changes = diff_namespace(sent, reprs)
+                            if changes:
+                                self.send([client], 'namespace', {'id': namespace_id, 'changes': changes})
+                        client.namespaces[namespace_id] = reprs
+                    ids[id(namespace)] = namespace_id
+
+        def describe(frame):
+            description = self.describe_frame(frame, namespaces=False)
+            description['globals'] = ids[id(frame.f_globals)]
+            description['builtins'] = ids[id(frame.f_builtins)]
+            if frame.f_locals is frame.f_globals:
+                description['locals'] = description['globals']
+            else:
+                description['locals'] = self.describe_namespace(frame.f_locals)
+            return description
+        return describe
+
+    def summarize_frame(self, frame):
+        """Describe a frame for a client that inspects variables lazily.
+
+        Only the locals of the current frame are described, by name and
+        type; the client asks for anything else it wants (see
+        do_inspect()). The locals of module code are its globals, which
+        may be huge, so they're never described.
+        """
+        if frame is self.curframe and frame.f_locals is not frame.f_globals:
+            local_vars = dict((k, summarize(v)) for k, v in self.curframe_locals.items())
+        else:
+            local_vars = None
+        return {
+            'filename': frame.f_code.co_filename,
+            'locals': local_vars,
+            'lazy': True,
+            'lasti': repr(frame.f_lasti),
+            'current': frame is self.curframe,
+        }
+
+    def stack_delta(self, client, frames, stack_data):
+        """Describe a stack as changes to the last stack sent to a client
+        for this thread.
+
+        Every frame is given an id the first time it is sent, and is sent
+        in full; after that, only what has changed in it is sent. Frames
+        are recognized by their identity (and code); if a finished
+        frame's memory is reused for another call of the same code, that
+        call is described as changes to the finished one, which is still
+        correct, if a little misleading.
+        """
+        thread = get_ident()
+        last = client.sent_stacks.get(thread, {})
+        sent = {}
+        delta = []
+        for (frame, line_no), (line_no, description) in zip(frames, stack_data):
+            previous = last.get(id(frame))
+            if previous is not None and previous[0] is frame.f_code:
+                frame_id = previous[1]
+                entry = {'id': frame_id, 'line': line_no}
+                changes = diff_frame(previous[2], description)
+                if changes:
+                    entry['changes'] = changes
+            else:
+                frame_id = next(self._frame_ids)
+                entry = {'id': frame_id, 'line': line_no, 'frame': description}
+            delta.append(entry)
+            sent[id(frame)] = (frame.f_code, frame_id, description)
+        client.sent_stacks[thread] = sent
+        return delta
+
+    def output_watches(self, full=False):
+        """Output the value of every watch expression that has changed.
+
+        The expressions are evaluated in the current frame. If `full` is
+        True, output the value of every watch.
+        """
+        if self.curframe is None:
+            return
+        changed = []
+        for number, watch in sorted(self.watches.items()):
+            value = watch.evaluate(self.curframe.f_globals, self.curframe_locals, self.reprs.repr)
+            if full or value != watch.value:
+                watch.value = value
+                changed.append({'number': number, 'value': value})
+        if changed:
+            self.output('watches', watches=changed)
+
+    def output_protocol_stats(self):
+        """Report what sending (and describing the values sent) has cost
+        since the last report.
+
+        Sent at every stop, so the cost of the stop (and of anything
+        sent while running up to it) can be compared between codecs. Every
+        client is told what it has cost to send to that client; messages
+        are encoded as they are sent, so the last few may not be counted
+        until the next stop.
+        """
+        repr_totals = (self.reprs.reprs, self.reprs.repr_time, self.reprs.skipped)
+        last_reprs, self._repr_totals = self._repr_totals, repr_totals
+        for client in self.audience('protocol_stats'):
+            channel = client.channel
+            if channel.framing_out == ETX_FRAMING:
+                # Only clients that have chosen a protocol know about this.
+                continue
+            totals = (channel.sent, channel.sent_bytes, channel.sent_wire_bytes, channel.encode_time)
+            last, client.protocol_totals = client.protocol_totals, totals
+            self.send([client], 'protocol_stats', {
+                'codec': channel.codec_out.name,
+                'compression': channel.compression_out.name if channel.compression_out else None,
+                'messages': totals[0] - last[0], 'bytes': totals[1] - last[1],
+                'wire_bytes': totals[2] - last[2], 'encode_time': totals[3] - last[3],
+                'reprs': repr_totals[0] - last_reprs[0], 'repr_time': repr_totals[1] - last_reprs[1],
+                'reprs_skipped': repr_totals[2] - last_reprs[2],
+            })
+
+    def output_threads(self):
+        "Output the list of threads in the program"
+        threads = []
+        with self._client_lock:
+            alive = set()
+            for thread in threading.enumerate():
+                if thread in self._own_threads:
+                    continue
+                alive.add(thread.ident)
+                state = self._thread_states.get(thread.ident)
+                threads.append({
+                    'ident': thread.ident,
+                    'name': thread.name,
+                    'stopped': bool(state and state.stopped),
+                    'current': thread.ident == self._current_thread,
+                })
+            # Forget about any threads that have finished.
+            for client in self.hub.clients:
+                for ident in list(client.sent_stacks):
+                    if ident not in alive:
+                        del client.sent_stacks[ident]
+            for ident in list(self._thread_states):
+                if ident not in alive and ident != self._thread_ident:
+                    state = self._thread_states[ident]
+                    if state is None or not state.stopped:
+                        del self._thread_states[ident]
+        self.output('threads', threads=threads)
+
+    def output_tasks(self):
+        """Output the asyncio tasks of the event loop in the current thread.
+
+        Every task is described by the chain of coroutines it is
+        awaiting, so it's possible to see where each task is stuck.
+        """
+        tasks, current = asyncio_tasks()
+        if tasks is None:
+            return
+        stack_frames = [frame for frame, lineno in self.stack]
+        task_data = []
+        for task in tasks:
+            frames = coroutine_frames(task)
+            if task is current and frames and frames[-1] in stack_frames:
+                # The coroutines of the running task aren't awaiting
+                # each other yet; they're on the stack.
+                frames = frames[:-1] + stack_frames[stack_frames.index(frames[-1]):]
+            task_data.append({
+                'id': id(task),
+                'name': task.get_name() if hasattr(task, 'get_name') else 'Task-%x' % id(task),
+                'current': task is current,
+                'stack': [
+                    [frame.f_lineno, self.canonic(frame.f_code.co_filename), frame.f_code.co_name]
+                    for frame in frames
+                ],
+            })
+        task_data.sort(key=lambda task: (not task['current'], task['name']))
+        self.output('tasks', tasks=task_data, thread=get_ident())
+
+    def breakpoint_stats(self, bp):
+        "Describe how often a breakpoint has been hit."
+        evaluations, eval_time = self.condition_timings.get(bp.number, (0, 0.0))
+        return {
+            'bpnum': bp.number,
+            'hits': bp.hits,
+            'evaluations': evaluations,
+            'eval_time': eval_time,
+        }
+
+    def output_breakpoint_stats(self):
+        "Output the statistics for any breakpoint that has changed"
+        changed = []
+        for bp in bdb.Breakpoint.bpbynumber[1:]:
+            if bp:
+                stats = self.breakpoint_stats(bp)
+                if self._reported_stats.get(bp.number) != stats:
+                    self._reported_stats[bp.number] = stats
+                    changed.append(stats)
+        if changed:
+            self.output('breakpoint_stats', breakpoints=changed)
+
+    def output_heatmap(self, joining=None):
+        """Output the line counts of every file that has changed.
+
+        If a client is `joining`, the other clients are brought up to
+        date, and it is sent the counts for every file.
+        """
+        if not self.hub.clients:
+            return
+        with self._heatmap_lock:
+            others = [client for client in self.hub.clients if client is not joining]
+            files = self.line_counts.changes()
+            if files:
+                self.send(others, 'heatmap', {'files': files})
+            if joining is not None:
+                self.send([joining], 'heatmap', {'files': self.line_counts.changes(full=True)})
+
+    def output_profile(self, joining=None):
+        """Output the samples that have been collected since the last output.
+
+        If a client is `joining`, the other clients are brought up to
+        date, and it is sent the whole profile.
+        """
+        if not self.hub.clients:
+            return
+        with self._profile_lock:
+            others = [client for client in self.hub.clients if client is not joining]
+            snapshot = self.sampler.snapshot()
+            if snapshot['stacks']:
+                self.send(others, 'profile', dict(interval=self.sampler.interval, reset=False, **snapshot))
+            if joining is not None:
+                # The whole profile replaces anything the client had.
+                self.send([joining], 'profile', dict(
+                    interval=self.sampler.interval, reset=True, **self.sampler.snapshot(full=True)
+                ))
+
+    def thread_state(self):
+        """Return the stop state of the current thread.
+
+        Returns None if the current thread belongs to the debugger.
+        """
+        try:
+            return self._thread_states[get_ident()]
+        except KeyError:
+            return self._register_thread()
+
+    def _register_thread(self):
+        "Start keeping track of the current thread."
+        thread = threading.current_thread()
+        if thread in self._own_threads:
+            state = None
+        else:
+            state = ThreadState(thread.ident, thread.name)
+            # A new thread runs freely until it hits a breakpoint; the
+            # bottom of its stack is the frame that started the thread.
+            frame = sys._getframe()
+            while frame.f_back is not None:
+                frame = frame.f_back
+            state.botframe = frame
+            state.stopframe = frame
+            state.stoplineno = -1
+        self._thread_states[get_ident()] = state
+        return state
+
+    def start_thread(self, target, *args):
+        "Start a thread that belongs to the debugger, and won't be traced."
+        thread = Thread(target=target, args=args)
+        thread.daemon = True
+        self._own_threads = set(t for t in self._own_threads if t.is_alive())
+        self._own_threads.add(thread)
+        thread.start()
+        if self.line_counts is not None:
+            self.line_counts.forget_threads()
+        if self.history is not None:
+            self.history.forget_threads()
+        if self.watchpoints is not None:
+            self.watchpoints.forget_threads()
+        return thread
+
+    def queue_command(self, command, args, client=None):
+        """Pass a command from a client to the thread that will run it.
+
+        Commands can name a stopped thread; anything else goes to the
+        current thread. If no thread is stopped, the command waits until
+        a thread stops. Only the client in control of the session can
+        change what the program does.
+        """
+        if client is not None and not self.hub.controls(client) and command not in OBSERVER_COMMANDS:
+            self.refuse(
+                "Can't %s: client %s is observing the session" % (command, client.number),
+                args.get('request')
             )
-            for frame, line_no in self.stack[str_index:]
-        ]
-        self.output('stack', stack=stack_data)
+            return
+        with self._client_lock:
+            ident = args.pop('thread', None)
+            if ident is None:
+                state = self._thread_states.get(self._current_thread)
+            else:
+                state = self._thread_states.get(ident)
+                if state is None or not state.stopped:
+                    self.refuse('Thread %s is not stopped' % ident, args.get('request'))
+                    return
+            if state is not None and state.stopped:
+                state.commands.put((command, args, client))
+            else:
+                self.commands.put((command, args, client))
+
+    def refuse(self, message, request=None):
+        "Reply to a command that won't be run"
+        if request is None:
+            self.output('error', message=message)
+        else:
+            self.output('error', message=message, request=request)
+            self.output('done', request=request)
+
+    def stop_thread(self, state):
+        "Record that a thread has stopped, and make it the current thread."
+        with self._client_lock:
+            state.stopped = True
+            self._stopped.append(state)
+            self._current_thread = state.ident
+            # Take over any commands that were waiting for a thread to stop.
+            while True:
+                try:
+                    state.commands.put(self.commands.get(block=False))
+                except Empty:
+                    break
+            if self.freeze_threads:
+                self.freeze(True)
+
+    def resume_thread(self, state):
+        "Record that a thread has resumed running."
+        with self._client_lock:
+            state.stopped = False
+            self._stopped.remove(state)
+            if self._stopped:
+                self._current_thread = self._stopped[-1].ident
+                # Other threads are still stopped; but this thread
+                # has been told to run.
+                state.thawed = True
+            else:
+                self._current_thread = None
+                self.freeze(False)
+
+    def release_threads(self):
+        "Let every other stopped thread carry on running."
+        with self._client_lock:
+            for state in self._stopped:
+                if state.ident != get_ident():
+                    state.commands.put(('continue', {}, None))
+
+    def freeze(self, frozen):
+        "Freeze (or thaw) every thread that isn't stopped."
+        if frozen:
+            for state in self._thread_states.values():
+                if state is not None:
+                    state.thawed = False
+            self._frozen = True
+            self._running.clear()
+        else:
+            self._frozen = False
+            self._running.set()
+
+    def wait_while_frozen(self, state):
+        "Block the current thread while other threads are stopped."
+        if not (state.stopped or state.thawed):
+            self._running.wait()
 
     def forget(self):
         self.line = None
         self.stack = []
         self.curindex = 0
         self.curframe = None
+        self.replay = None
+        self.inspector = None
+
+    def trace_stack(self, frame):
+        """Make sure every frame between `frame` and the bottom of the
+        stack is being traced.
+
+        Continuing removes tracing from frames that can't stop, but
+        once we've stopped, we may need to step back out into them.
+        """
+        while frame is not None and frame is not self.botframe:
+            if not frame.f_trace or frame.f_trace == self.trace_lines:
+                frame.f_trace = self.trace_dispatch
+            frame = frame.f_back
 
     def setup(self, f, t):
         self.forget()
         self.stack, self.curindex = self.get_stack(f, t)
         self.curframe = self.stack[self.curindex][0]
+        self.trace_stack(f)
         # The f_locals dictionary is updated from the actual frame
         # locals whenever the .f_locals accessor is called, so we
         # cache it here to ensure that modifications are not overwritten.
         self.curframe_locals = self.curframe.f_locals
 
+    def update_breakpoint(self, bp):
+        "Record a change in the state of a breakpoint."
+        self.breakpoint_index.update(bp)
+
     # Override Bdb methods
 
+    def reset(self):
+        bdb.Bdb.reset(self)
+        if self.history is not None:
+            # Every run has a history of its own. Recording starts here,
+            # so the debugger's own setup (e.g., checking the line cache)
+            # isn't recorded.
+            self.history.clear()
+            self.history.resume()
+
+    def run(self, cmd, globals=None, locals=None):
+        self._thread_ident = get_ident()
+        threading.settrace(self.trace_dispatch)
+        try:
+            bdb.Bdb.run(self, cmd, globals, locals)
+        finally:
+            threading.settrace(None)
+
+    def trace_dispatch(self, frame, event, arg):
+        try:
+            state = self._thread_states[get_ident()]
+        except KeyError:
+            state = self._register_thread()
+        if state is None:
+            # One of the debugger's own threads.
+            return None
+        if self._trace_lines:
+            for observe in self._line_observers:
+                if observe(frame, event):
+                    # The observer has stopped the thread (e.g., at a
+                    # watchpoint); there's nothing more to do.
+                    return self.trace_dispatch
+        if self._frozen:
+            self.wait_while_frozen(state)
+        if (event == 'call' and state.stopframe and frame is not state.stopframe and
+                state.botframe is not None and not self.skip and not self.break_anywhere(frame)):
+            # This is what Bdb.dispatch_call() would decide - the call
+            # can't stop - without looking up the thread state again.
+            return self.trace_lines if self._trace_lines and self.observes(frame.f_code) else None
+        result = bdb.Bdb.trace_dispatch(self, frame, event, arg)
+        if result is None and self._trace_lines and self.observes(frame.f_code):
+            return self.trace_lines
+        return result
+
+    def trace_lines(self, frame, event, arg):
+        "The trace function for frames that can't stop, but have lines to count or record."
+        for observe in self._line_observers:
+            observe(frame, event)
+        return self.trace_lines
+
+    def observe_lines(self, observer, codes=None):
+        """Pass every traced event to `observer`; used when there is no sys.monitoring.
+
+        An observer that stops the thread should return True. If `codes`
+        is given, it is called with a code object, and returns False if
+        the observer doesn't need the lines of that code.
+        """
+        self._line_observers.append(observer)
+        self._line_codes.append(codes)
+        self._trace_lines = True
+
+    def observes(self, code):
+        "Does any line observer need the lines of a code object?"
+        for codes in self._line_codes:
+            if codes is None or codes(code):
+                return True
+        return False
+
+    def settrace(self, trace):
+        "Set the trace function for the current thread, and any new threads."
+        if trace is None and self._trace_lines:
+            # Lines are still being counted or recorded.
+            trace = self.trace_dispatch
+        threading.settrace(trace)
+        sys.settrace(trace)
+
+    def stop_here(self, frame):
+        if sys.version_info[0] < 3:
+            # Python 2's bdb also stops in any caller of the stop frame
+            # (e.g., on a `next` off the end of a function).
+            return bdb.Bdb.stop_here(self, frame)
+        # Bdb looks up the stop state several times; only look it up once.
+        if self.skip and self.is_skipped_module(frame.f_globals.get('__name__')):
+            return False
+        state = self.thread_state()
+        if frame is state.stopframe:
+            if state.stoplineno == -1:
+                return False
+            return frame.f_lineno >= state.stoplineno
+        if not state.stopframe:
+            return True
+        return False
+
+    def break_here(self, frame):
+        filename = self.canonic(frame.f_code.co_filename)
+        if filename not in self.breaks:
+            return False
+        lineno = frame.f_lineno
+        if lineno not in self.breaks[filename]:
+            # The line itself has no breakpoint, but maybe the line is the
+            # first line of a function with breakpoint set by function name.
+            lineno = frame.f_code.co_firstlineno
+            if lineno not in self.breaks[filename]:
+                return False
+
+        # flag says ok to delete temp. bp
+        (bp, flag) = self.effective(filename, lineno, frame)
+        if bp:
+            self.currentbp = bp.number
+            if (flag and bp.temporary):
+                self.do_clear(str(bp.number))
+            return True
+        else:
+            return False
+
+    def effective(self, filename, line, frame):
+        """Determine which breakpoint for this file:line is to be acted upon.
+
+        This is bdb.effective(), except that conditions are evaluated
+        from their compiled code, and the time spent evaluating each
+        condition is recorded.
+        """
+        for bp in bdb.Breakpoint.bplist[filename, line]:
+            if not bp.enabled or not bdb.checkfuncname(bp, frame):
+                continue
+            # Count every hit, even if the breakpoint doesn't trigger.
+            bp.hits = bp.hits + 1
+            if bp.cond:
+                code = self.conditions.get(bp.number)
+                if code is None:
+                    code = self.conditions[bp.number] = compile(bp.cond, '<condition>', 'eval', 0, True)
+                timing = self.condition_timings.setdefault(bp.number, [0, 0.0])
+                start = timer()
+                try:
+                    value = eval(code, frame.f_globals, frame.f_locals)
+                except Exception as e:
+                    # If the condition can't be evaluated, the safest
+                    # thing to do is stop - but don't delete a temporary
+                    # breakpoint.
+                    self.output(
+                        'warning',
+                        message='Error evaluating condition for breakpoint %s: %s' % (bp.number, e)
+                    )
+                    return (bp, False)
+                finally:
+                    timing[0] = timing[0] + 1
+                    timing[1] = timing[1] + timer() - start
+                if not value:
+                    continue
+            if bp.ignore > 0:
+                bp.ignore = bp.ignore - 1
+                continue
+            logpoint = self.logpoints.get(bp.number)
+            if logpoint is not None:
+                # Log a message, and carry on without stopping.
+                self.log(bp, logpoint, frame)
+                continue
+            return (bp, True)
+        return (None, None)
+
+    # Logpoints
+
+    def log(self, bp, logpoint, frame):
+        "Record the message for a hit of a logpoint."
+        try:
+            message = logpoint.format(frame)
+        except Exception as e:
+            message = 'Error evaluating log message: %s' % e
+        if len(self.log_buffer) == LOG_BUFFER_SIZE:
+            # The oldest message is about to be pushed out.
+            self.log_dropped = self.log_dropped + 1
+        self.log_buffer.append((time.time(), bp.number, message))
+        if self._log_thread is None:
+            self._log_thread = self.start_thread(self._flush_log)
+        elif len(self.log_buffer) >= LOG_BATCH_SIZE:
+            self._log_ready.set()
+
+    def flush_log(self):
+        """Send any buffered log messages to the client, in batches.
+
+        Messages are kept until there is a client to send them to.
+        """
+        if not self.hub.clients:
+            return
+        with self._log_lock:
+            while self.log_buffer:
+                entries = []
+                try:
+                    while len(entries) < LOG_BATCH_SIZE:
+                        entries.append(self.log_buffer.popleft())
+                except IndexError:
+                    pass
+                dropped, self.log_dropped = self.log_dropped, 0
+                self.output('log', entries=entries, dropped=dropped)
+
+    def _flush_log(self):
+        while True:
+            self._log_ready.wait(LOG_INTERVAL)
+            self._log_ready.clear()
+            self.flush_log()
+
+    def break_anywhere(self, frame):
+        """Only trace a frame if its code can contain an enabled breakpoint.
+
+        Bdb checks for any breakpoint in the same file; the index narrows
+        that down to the lines of the code object being called.
+        """
+        return self.breakpoint_index.has_breaks(frame.f_code)
+
+    def dispatch_line(self, frame):
+        bdb.Bdb.dispatch_line(self, frame)
+        # If continuing removed tracing from this frame, don't reinstate it.
+        return frame.f_trace
+
+    def dispatch_return(self, frame, arg):
+        if frame.f_code.co_flags & CO_ASYNC:
+            if is_suspended(frame):
+                self.coroutine_suspend(frame)
+            else:
+                self.coroutine_return(frame, arg)
+            return self.trace_dispatch
+        return bdb.Bdb.dispatch_return(self, frame, arg)
+
+    def dispatch_exception(self, frame, arg):
+        state = self.thread_state()
+        if state.stopframe is not None and state.stopframe.f_code.co_flags & CO_ASYNC and not self.stop_here(frame):
+            # Bdb stops at the StopIteration raised in the caller when a
+            # generator that is being stepped over finishes. For a coroutine,
+            # that's in the event loop; coroutine_return() handles it instead.
+            return self.trace_dispatch
+        return bdb.Bdb.dispatch_exception(self, frame, arg)
+
+    def coroutine_suspend(self, frame):
+        """A coroutine is waiting for something.
+
+        If the thread is stepping, the next line of this task is where
+        the coroutine resumes - not in the event loop, or another task.
+
+        Returns True if the thread's stop state has changed.
+        """
+        state = self.thread_state()
+        if state.stopframe is None:
+            self._set_stopinfo(frame, None)
+            return True
+        return False
+
+    def coroutine_return(self, frame, return_value):
+        """A coroutine has finished (rather than being suspended).
+
+        Bdb can't tell this apart from the coroutine awaiting something,
+        so it ignores it. Stop here like any other return; then, rather
+        than stepping into the event loop, carry on in the coroutine that
+        is awaiting this one.
+
+        Returns True if the thread's stop state has changed.
+        """
+        state = self.thread_state()
+        # Bdb's set_return() stops nowhere in a coroutine frame (stoplineno
+        # of -1), so that it runs to the end, whatever it awaits on the way.
+        returning = frame is state.returnframe or (frame is state.stopframe and state.stoplineno == -1)
+        if returning or self.stop_here(frame):
+            try:
+                self.frame_returning = frame
+                self.user_return(frame, return_value)
+            finally:
+                self.frame_returning = None
+            if self.quitting:
+                raise bdb.BdbQuit
+        if state.stopframe is None or state.stopframe is frame or frame is state.returnframe:
+            caller = self.awaiting_frame(frame)
+            if caller is not None:
+                self._set_stopinfo(caller, None)
+            else:
+                self._set_stopinfo(state.botframe, None, -1)
+            return True
+        return False
+
+    def awaiting_frame(self, frame):
+        """Find the frame that logically continues when a coroutine finishes.
+
+        That's the frame that awaited the coroutine; if the coroutine is
+        the top of an asyncio task, it's the innermost coroutine of the
+        task that is awaiting this task. Frames in asyncio itself are
+        never the logical caller.
+        """
+        caller = frame.f_back
+        if caller is not None and not is_asyncio(caller):
+            return caller
+        tasks, current = asyncio_tasks()
+        for task in tasks or []:
+            if current is not None and getattr(task, '_fut_waiter', None) is current:
+                frames = [f for f in coroutine_frames(task) if not is_asyncio(f)]
+                if frames:
+                    return frames[-1]
+        # Nothing is awaiting this task; carry on in the code that
+        # is running the event loop (e.g., the caller of asyncio.run()).
+        while caller is not None and is_asyncio(caller):
+            caller = caller.f_back
+        return caller
+
+    def set_continue(self):
+        """Stop only at breakpoints or when finished.
+
+        Tracing is removed from any frame on the stack that can't stop; if
+        there are no enabled breakpoints, the trace function is removed
+        altogether.
+        """
+        self._set_stopinfo(self.botframe, None, -1)
+        if not self.breakpoint_index:
+            self.settrace(None)
+        frame = sys._getframe().f_back
+        while frame and frame is not self.botframe:
+            if not self.breakpoint_index.has_breaks(frame.f_code):
+                if self._trace_lines and self.observes(frame.f_code):
+                    frame.f_trace = self.trace_lines
+                else:
+                    del frame.f_trace
+            frame = frame.f_back
+
     def user_call(self, frame, argument_list):
         """This method is called when there is the remote possibility
         that we ever need to stop in this function."""
@@ -207,7 +1503,7 @@ class Debugger(bdb.Bdb):
         if self._run_state == Debugger.STARTING:
             return
         frame.f_locals['__return__'] = return_value
-        self.output('return', retval=repr(return_value))
+        self.output('return', retval=self.reprs.repr(return_value))
         self.interaction(frame, None)
 
     def user_exception(self, frame, exc_info):
@@ -221,71 +1517,616 @@ class Debugger(bdb.Bdb):
             exc_type_name = exc_type
         else:
             exc_type_name = exc_type.__name__
-        self.output('exception', name=exc_type_name, value=repr(exc_value))
+        self.output('exception', name=exc_type_name, value=self.reprs.repr(exc_value))
         self.interaction(frame, exc_traceback)
 
     # General interaction function
 
     def interaction(self, frame, tb):
+        state = self.thread_state()
+        self.stop_thread(state)
+        try:
+            self._interaction(frame, tb, state)
+        finally:
+            self.resume_thread(state)
+            if self._stopped:
+                # Let the client know which threads are still stopped.
+                self.output_threads()
+
+    def _interaction(self, frame, tb, state):
+        # Anything logged before the stop should be seen before it.
+        self.flush_log()
         self.setup(frame, tb)
+        self.reprs.reset_budget()
+        self.output_breakpoint_stats()
+        self.output_threads()
+        self.output_tasks()
         self.output_stack()
+        self.output_watches()
+        self.output_protocol_stats()
         while 1:
             try:
+                # If there are no clients yet, this waits until one
+                # connects, and is greeted.
                 # print "Server Wait for input..."
-                command, args = self.commands.get(block=True)
+                command, args, client = state.commands.get(block=True)
 
-                # print "Server command:", command, args
-                if hasattr(self, 'do_%s' % command):
+                if command is GREET:
+                    # print "Describe initial stack..."
+                    self._request.client, self._request.private = client, True
                     try:
-                        resume = getattr(self, 'do_%s' % command)(**args)
-                        if resume:
-                            # print "resume running"
-                            break
-                    except (ClientClose, Restart):
-                        # Reraise any control exceptions
-                        raise
-                    except Exception as e:
-                        # print "Unknown problem with command %s: %s" % (command, e)
-                        self.output('error', message='Unknown problem with command %s: %s' % (command, e))
-                else:
-                    # print "Unknown command %s" % command
-                    self.output('error', message='Unknown command: %s' % command)
+                        self.describe_stop()
+                    finally:
+                        self._request.client, self._request.private = None, False
+                    continue
+
+                # print "Server command:", command, args
+                request = args.pop('request', None)
+                self._request.client, self._request.id = client, request
+                try:
+                    if hasattr(self, 'do_%s' % command):
+                        try:
+                            resume = getattr(self, 'do_%s' % command)(**args)
+                            if resume:
+                                # print "resume running"
+                                break
+                        except (ClientClose, Restart):
+                            # Reraise any control exceptions
+                            raise
+                        except Exception as e:
+                            # print "Unknown problem with command %s: %s" % (command, e)
+                            self.output('error', message='Unknown problem with command %s: %s' % (command, e))
+                    else:
+                        # print "Unknown command %s" % command
+                        self.output('error', message='Unknown command: %s' % command)
+                finally:
+                    # Anything sent after the command has been run
+                    # (including when resuming) isn't part of the reply.
+                    self._request.id = None
+                    if request is not None:
+                        self.output('done', request=request)
+                    self._request.client = None
+
+            except ClientClose:
+                # The last client has gone away. If attaching on connect,
+                # let the script carry on running, unless somebody has
+                # connected since; otherwise, wait for a new client.
+                if self.attach_on_connect and not self.hub.clients:
+                    self.release_threads()
+                    self.set_continue()
+                    break
+
+        # print "END INTERACTION LOOP"
+        self.forget()
+
+    def describe_stop(self):
+        "Output everything a client needs to know about the current stop"
+        self.output_threads()
+        self.output_tasks()
+        self.output_stack()
+        self.output_watches(full=True)
 
-            except (socket.error, AttributeError, ClientClose):
-                # Problem with connection; look for new client
-                print("Listening on %s:%s for a bugjar client" % (self.host, self.port))
-                client, addr = self.socket.accept()
+    @property
+    def _interacting(self):
+        "Is any thread stopped?"
+        return bool(self._stopped)
 
-                print("Got connection from", client.getpeername())
-                self.client = client
+    # Client connections
 
-                # Start the command queue
-                self.commands = Queue()
-                self.command_thread = Thread(target=command_buffer, args=(self,))
-                self.command_thread.daemon = True
-                self.command_thread.start()
+    def connect(self, sock):
+        """Add a newly connected client to the session.
 
-                # print "Bootstrap the state of a new connection..."
+        The client is told everything it needs to catch up with the
+        session before it is sent anything else; if a thread is stopped,
+        that thread then describes its stop to the client.
+        """
+        print("Got connection from", sock.getpeername())
+        client = self.hub.client(sock)
+        self._request.client, self._request.private = client, True
+        try:
+            self.bootstrap(client)
+        finally:
+            self._request.client, self._request.private = None, False
+
+        with self._client_lock:
+            self.hub.add(client)
+            self.start_thread(command_buffer, self, client)
+            if self._interacting:
+                # The stopped thread will describe its stop.
+                self._thread_states[self._current_thread].commands.put((GREET, {}, client))
+            elif self.attach_on_connect and len(self.hub.clients) == 1:
+                # Nobody was watching the script; stop it.
+                self.request_attach()
+
+        # Send everything that has been profiled or counted so far.
+        if self.sampler is not None:
+            self.output_profile(joining=client)
+        if self.line_counts is not None:
+            self.output_heatmap(joining=client)
+        self.announce_control()
+
+    def bootstrap(self, client):
+        "Tell a new client about the session."
+        # Clients that understand the offer will switch to a better protocol.
+        # Large messages can go through shared memory if the client is on
+        # this machine.
+        features = FEATURES
+        if shared_memory is not None and client.socket.family == getattr(socket, 'AF_UNIX', None):
+            features = FEATURES + [SHARED_MEMORY]
+        self.output(
+            'protocol_offer', framing=FRAMINGS, codecs=CODEC_NAMES,
+            compression=COMPRESSION_NAMES, features=features
+        )
+
+        # print "Bootstrap the state of a new connection..."
+        breakpoints = []
+        for bp in bdb.Breakpoint.bpbynumber[1:]:
+            if bp:
+                # The other clients may not have been sent these stats
+                # yet, so they aren't recorded as reported.
+                stats = self.breakpoint_stats(bp)
+                bp_data = {
+                    'bpnum': bp.number,
+                    'filename': bp.file,
+                    'line': bp.line,
+                    'temporary': bp.temporary,
+                    'enabled': bp.enabled,
+                    'funcname': bp.funcname,
+                    'condition': bp.cond,
+                    'log': self.logpoints[bp.number].message if bp.number in self.logpoints else None,
+                }
+                bp_data.update(stats)
+                breakpoints.append(bp_data)
+        self.output('bootstrap', breakpoints=breakpoints, pid=os.getpid())
+        for number, watch in sorted(self.watches.items()):
+            self.output('watch_create', number=number, expression=watch.expression)
+        if self.watchpoints is not None:
+            for number, watchpoint in sorted(self.watchpoints.watchpoints.items()):
                 self.output(
-                    'bootstrap',
-                    breakpoints=[
-                        {
-                            'bpnum': bp.number,
-                            'filename': bp.file,
-                            'line': bp.line,
-                            'temporary': bp.temporary,
-                            'enabled': bp.enabled,
-                            'funcname': bp.funcname
-                        }
-                        for bp in bdb.Breakpoint.bpbynumber[1:]
-                    ]
+                    'watchpoint_create', number=number,
+                    expression=watchpoint.expression, value=watchpoint.repr
                 )
 
-                # print "Describe initial stack..."
-                self.output_stack()
+        # Tell the client about any child processes it can debug.
+        with self._client_lock:
+            children = list(self.children.items())
+        for pid, child in children:
+            self.output('process', pid=pid, **child)
+
+    def disconnect(self, client):
+        "Remove a client that has gone away from the session."
+        self.hub.remove(client)
+        with self._client_lock:
+            if not self.hub.clients and self._interacting:
+                # Nobody is watching the stopped thread any more.
+                self._thread_states[self._current_thread].commands.put(('close', {}, None))
+        self.announce_control()
+
+    def control(self, client, holder=None, request=None):
+        """Pass control of the session to the client numbered `holder`
+        (or to nobody, if it is None).
+
+        A client can take control if nobody has it; otherwise, only the
+        client in control can pass it on.
+        """
+        error = self.hub.hand_over(client, holder)
+        if error is not None:
+            self.refuse(error, request)
+            return
+        self.announce_control()
+        if request is not None:
+            self.output('done', request=request)
+
+    def announce_control(self):
+        "Tell every client which client is in control, and which client it is"
+        controller = self.hub.controller
+        clients = self.hub.clients
+        numbers = [client.number for client in clients]
+        for client in clients:
+            client.send('control', {
+                'holder': controller.number if controller is not None else None,
+                'client': client.number,
+                'clients': numbers,
+            })
+
+    def use_protocol(self, client, framing, codec='json', compression=None, level=None, threshold=None,
+                     features=(), shared_memory=None):
+        """Switch to the protocol chosen by a client.
+
+        The client sends everything after its choice in the new protocol;
+        we send everything after our acknowledgement in it. If the client
+        asks for compression, messages of at least `threshold` bytes are
+        compressed at the given level. Any of the optional `features`
+        we don't know about are ignored. If the client asks for
+        `shared_memory`, large messages are sent through a ring buffer
+        of that many bytes, which the client attaches to by name.
+        """
+        if framing not in FRAMINGS:
+            self.output('error', message='Unknown framing %s' % framing)
+            return
+        try:
+            codec = get_codec(codec)
+        except KeyError:
+            self.output('error', message='Unknown codec %s' % codec)
+            return
+        if compression is not None:
+            if framing != LENGTH_FRAMING:
+                self.output('error', message='Compression requires length-prefixed framing')
+                return
+            try:
+                compression_class = get_compression(compression)
+                compression_in, compression_out = compression_class(level), compression_class(level)
+            except Exception as e:
+                self.output('error', message='Invalid compression %s: %s' % (compression, e))
+                return
+        else:
+            compression_in = compression_out = None
+        shared_out = None
+        if shared_memory:
+            if framing != LENGTH_FRAMING:
+                self.output('error', message='Shared memory requires length-prefixed framing')
+                return
+            try:
+                shared_out = SharedRing.create(int(shared_memory))
+            except Exception as e:
+                # The session still works without it.
+                self.output('warning', message="Can't share memory with the client: %s" % e)
+
+        channel = client.channel
+        channel.framing_in = framing
+        channel.codec_in = codec
+        channel.compression_in = compression_in
+        chosen = {'framing': framing, 'codec': codec.name}
+        if compression_out is not None:
+            chosen.update(compression=compression_out.name, level=level, threshold=threshold)
+        features = set(features) & set(FEATURES)
+        if features:
+            chosen['features'] = sorted(features)
+        if shared_out is not None:
+            chosen['shared_memory'] = shared_out.name
+        # The acknowledgement is the last message sent in the old protocol.
+        changes = {
+            'framing_out': framing,
+            'codec_out': codec,
+            'compression_out': compression_out,
+            'shared_out': shared_out,
+        }
+        if threshold is not None:
+            changes['threshold'] = threshold
+        client.send('protocol', chosen, changes)
+        channel.features = features
+
+    @property
+    def address(self):
+        "Where clients connect"
+        if self.path is not None:
+            return self.path
+        return '%s:%s' % (self.host, self.port)
+
+    def listen(self):
+        """Accept clients in a background thread.
+
+        If attaching on connect, must be called from the main thread.
+        """
+        if self.attach_on_connect and ATTACH_SIGNAL is not None:
+            signal.signal(ATTACH_SIGNAL, self._on_attach_signal)
+
+        self.start_thread(self._serve)
 
-        # print "END INTERACTION LOOP"
-        self.forget()
+    def _serve(self):
+        print("Listening on %s for a bugjar client" % self.address)
+        while True:
+            client, addr = self.socket.accept()
+            self.connect(client)
+
+    # Tracing control; these are overridden by engines that don't use sys.settrace.
+
+    def request_attach(self):
+        """Ask the running script to stop at the next line.
+
+        Called from the listener thread; the script thread is interrupted
+        with a signal so that it can install tracing on itself.
+        """
+        os.kill(os.getpid(), ATTACH_SIGNAL)
+
+    def _on_attach_signal(self, signum, frame):
+        if self._interacting or self.quitting or self._thread_ident != get_ident():
+            return
+        self.set_step()
+        self.start_tracing(frame)
+
+    def start_tracing(self, frame):
+        "Trace the script thread, from `frame` down, and any new threads."
+        self.trace_stack(frame)
+        self.settrace(self.trace_dispatch)
+
+    def stop_tracing(self):
+        "Stop tracing the script thread, and any new threads."
+        self.settrace(None)
+
+    def run_detached(self, cmd, globals=None, locals=None):
+        """Run a command with no client attached.
+
+        The command runs untraced, unless there are breakpoints that might
+        be hit, until a client connects.
+        """
+        if globals is None:
+            import __main__
+            globals = __main__.__dict__
+        if locals is None:
+            locals = globals
+        self.reset()
+        if isinstance(cmd, basestring):
+            cmd = compile(cmd, '<string>', 'exec')
+
+        # This frame is the bottom of the debugged stack.
+        self.botframe = sys._getframe()
+        self._thread_ident = get_ident()
+        if self.breakpoint_index or self._trace_lines:
+            self.set_continue()
+            self.start_tracing(self.botframe)
+        try:
+            exec(cmd, globals, locals)
+        except bdb.BdbQuit:
+            pass
+        finally:
+            self.quitting = True
+            self.stop_tracing()
+
+    # Profiling
+
+    def profile(self, interval):
+        """Sample the stacks of all threads every `interval` seconds.
+
+        The samples are streamed to the client while the script runs.
+        """
+        self.sampler = Sampler(
+            interval,
+            ignore=self._unprofiled_thread,
+            debugger_files=[source_file(bdb.__file__), source_file(__file__)],
+            root_files=['<string>', source_file(threading.__file__)],
+            report=self.output_profile,
+        )
+        self.start_thread(self.sampler.run)
+
+    def _own_thread(self, ident):
+        "Does the thread with this ident belong to the debugger?"
+        return any(thread.ident == ident for thread in self._own_threads)
+
+    def _unprofiled_thread(self, ident):
+        "Threads that belong to the debugger, or are stopped, aren't sampled."
+        if ident in self._thread_states:
+            state = self._thread_states[ident]
+            return state is None or state.stopped
+        return self._own_thread(ident)
+
+    def count_lines(self):
+        """Count the number of times every line of the script is executed.
+
+        The counts are sent to the client while the script runs.
+        """
+        self.line_counts = LineCounts(
+            ignore_files=[source_file(bdb.__file__), source_file(__file__), '<string>'],
+            ignore_thread=self._own_thread,
+        )
+        if not self.line_counts.start():
+            # There is no sys.monitoring; count lines in the trace function.
+            self.observe_lines(self.line_counts.observe)
+        self.start_thread(self._report_line_counts)
+
+    def _report_line_counts(self):
+        while True:
+            time.sleep(HEATMAP_INTERVAL)
+            self.output_heatmap()
+
+    # Recording
+
+    def record(self, max_bytes):
+        """Record the lines the script executes, and how its locals change.
+
+        The oldest part of the recording is discarded once it uses more
+        than (approximately) `max_bytes` of memory. A stopped thread can
+        step back through its recording.
+        """
+        self.history = History(
+            max_bytes,
+            ignore_files=[source_file(bdb.__file__), source_file(__file__), '<string>'],
+            ignore_thread=self._own_thread,
+        )
+        if not self.history.start():
+            # There is no sys.monitoring; record lines in the trace function.
+            self.observe_lines(self.history.observe)
+
+    def start_replay(self):
+        """Start replaying the recording of the current thread, if it isn't already.
+
+        Returns False if nothing is being recorded.
+        """
+        if self.history is None:
+            self.output('error', message='Execution is not being recorded; use --record.')
+            return False
+        if self.replay is None:
+            self.replay = self.history.replay(get_ident(), self.curframe)
+        return True
+
+    def _replay_break(self, position):
+        "Is there an enabled breakpoint on the line at a position in the replay?"
+        serial, line = self.replay.events[position][:2]
+        return self.breakpoint_index.has_line(self.replay.frames[serial][3], line)
+
+    def output_replay(self):
+        """Output the stack as it was at the current position of the replay.
+
+        If the replay has reached the present, it's over, and the live
+        stack is output.
+        """
+        replay = self.replay
+        if replay.at_present:
+            self.replay = None
+            self.output('history', position=None, length=len(replay))
+            self.output_stack()
+        else:
+            self.output('history', position=replay.position, length=len(replay))
+            # The clients replace their stacks with this one, so the next
+            # live stack must be sent in full.
+            for client in self.hub.clients:
+                client.sent_stacks.pop(get_ident(), None)
+            self.output('stack', stack=replay.stack(), thread=get_ident())
+
+    # Child processes
+
+    def follow(self, registry=None):
+        """Debug any child processes that are forked or spawned.
+
+        `registry` is the address that children report to. If it isn't
+        given, this is the top process; it listens for children, and
+        tells the client how to connect to them.
+        """
+        if registry is None:
+            self._registry_socket = listen_socket('127.0.0.1', 0)
+            registry = self._registry_socket.getsockname()[:2]
+            self.start_thread(self._serve_children)
+        self.registry = tuple(registry)
+        os.register_at_fork(after_in_child=self._after_fork)
+        self._patch_spawn()
+
+    def breakpoint_table(self):
+        "Describe the breakpoints, so they can be copied into a child process."
+        return [
+            {
+                'filename': bp.file,
+                'line': bp.line,
+                'temporary': bp.temporary,
+                'enabled': bp.enabled,
+                'condition': bp.cond,
+                'log': self.logpoints[bp.number].message if bp.number in self.logpoints else None,
+            }
+            for bp in bdb.Breakpoint.bpbynumber[1:]
+            if bp
+        ]
+
+    def _serve_children(self):
+        while True:
+            connection, addr = self._registry_socket.accept()
+            self.start_thread(self._child_session, connection)
+
+    def _child_session(self, connection):
+        """Register a child process, and watch for it to exit.
+
+        The child keeps the connection open for as long as it runs.
+        """
+        try:
+            reader = connection.makefile('rb')
+            message = reader.readline()
+            if not message:
+                return
+            child = json.loads(message.decode('utf8'))
+            pid = child.pop('pid')
+
+            with self._client_lock:
+                self.children[pid] = child
+            self.output('process', pid=pid, **child)
+
+            while connection.recv(1024):
+                pass
+        except (socket.error, ValueError):
+            return
+        finally:
+            connection.close()
+
+        with self._client_lock:
+            self.children.pop(pid, None)
+        self.output('process_exit', pid=pid)
+
+    def register_child(self):
+        "Report this (child) process to the top process."
+        self._registry_connection = socket.create_connection(self.registry)
+        self._registry_connection.sendall(json.dumps({
+            'pid': os.getpid(),
+            'parent': os.getppid(),
+            'port': self.port,
+        }).encode('utf8') + b'\n')
+
+    def _after_fork(self):
+        "Re-arm the debugger in a newly forked child process."
+        # The sampling and reporting threads don't exist in the child.
+        self.sampler = None
+        if self.line_counts is not None:
+            self.line_counts.stop()
+            self.line_counts = None
+        if self.history is not None:
+            self.history.stop()
+            self.history = None
+        if self.watchpoints is not None:
+            self.watchpoints.stop()
+            self.watchpoints = None
+        self.reprs = ReprEngine(start_thread=self.start_thread)
+        self._line_observers = []
+        self._line_codes = []
+        self._trace_lines = False
+        if self.registry is None:
+            return
+
+        # The sockets belong to the parent; close our copies. Only the
+        # thread that forked survives, and any locks may be held by
+        # threads that no longer exist.
+        for sock in [client.socket for client in self.hub.clients] + [
+                self.socket, self._registry_socket, self._registry_connection]:
+            if sock is not None:
+                sock.close()
+        self.hub = Hub(self.start_thread)
+        self.commands = Queue()
+        self._registry_socket = None
+        self.children = {}
+        self._client_lock = RLock()
+        self._request = local()
+        self._stopped = []
+        self._current_thread = None
+        self._running = Event()
+        self.freeze(False)
+        self._thread_states = {get_ident(): self._thread_states.get(get_ident())}
+        self._own_threads = set()
+        self._thread_ident = get_ident()
+        self._log_ready = Event()
+        self._log_lock = Lock()
+        self._log_thread = None
+        self.forked = True
+
+        # Listen for a client of our own, and tell the top process about it.
+        # Breakpoints are inherited from the parent.
+        self.socket = listen_socket(self.host, 0)
+        self.port = self.socket.getsockname()[1]
+        self.path = None
+        self.register_child()
+        self.listen()
+
+    def _patch_spawn(self):
+        """Make multiprocessing start spawned children under the debugger.
+
+        Spawned children are new interpreters, so they start with
+        `run_child()` instead of multiprocessing's own entry point, and
+        are given a copy of the breakpoints as they are when the child
+        is started.
+        """
+        try:
+            from multiprocessing import spawn
+        except ImportError:
+            return
+        get_command_line = spawn.get_command_line
+        engine = [name for name, engine in ENGINES.items() if type(self) is engine][0]
+
+        def debugged_command_line(**kwds):
+            command = get_command_line(**kwds)
+            if '-c' in command:
+                command[command.index('-c') + 1] = (
+                    'from bugjar.net import run_child; run_child(%r, %r, %r, %r, %r, %s)' % (
+                        str(self.host), self.registry, str(engine), self.attach_on_connect,
+                        self.breakpoint_table(),
+                        ', '.join('%s=%r' % item for item in kwds.items())
+                    )
+                )
+            return command
+        spawn.get_command_line = debugged_command_line
 
     # Debugger Commands
 
@@ -298,6 +2139,7 @@ class Debugger(bdb.Bdb):
                 self.output('error', message=err)
             else:
                 bp = self.get_breaks(filename, line)[-1]
+                self.update_breakpoint(bp)
                 self.output(
                     'breakpoint_create',
                     bpnum=bp.number,
@@ -317,7 +2159,8 @@ class Debugger(bdb.Bdb):
         """
         # this method should be callable before starting debugging, so default
         # to "no globals" if there is no current frame
-        globs = self.curframe.f_globals if hasattr(self, 'curframe') else None
+        curframe = getattr(self, 'curframe', None)
+        globs = curframe.f_globals if curframe is not None else None
         code = linecache.getline(filename, line, globs)
         if not code:
             return False
@@ -327,45 +2170,143 @@ class Debugger(bdb.Bdb):
             return False
         return True
 
-    def do_enable(self, bpnum):
-        if not (0 <= bpnum < len(bdb.Breakpoint.bpbynumber)):
-            self.output('error', message='No breakpoint numbered %s' % bpnum)
-        else:
+    def breakpoint_numbered(self, bpnum):
+        """The breakpoint with the given number.
+
+        If there isn't one (or it has been cleared), reports an error,
+        and returns None.
+        """
+        bpnum = int(bpnum)
+        if 0 <= bpnum < len(bdb.Breakpoint.bpbynumber):
             bp = bdb.Breakpoint.bpbynumber[bpnum]
+            if bp is not None:
+                return bp
+        self.output('error', message='No breakpoint numbered %s' % bpnum)
+        return None
+
+    def do_enable(self, bpnum):
+        bp = self.breakpoint_numbered(bpnum)
+        if bp is not None:
             bp.enable()
-            self.output('breakpoint_enable', bpnum=bpnum)
+            self.update_breakpoint(bp)
+            self.output('breakpoint_enable', bpnum=bp.number)
 
     def do_disable(self, bpnum):
-        bpnum = int(bpnum)
-        if not (0 <= bpnum < len(bdb.Breakpoint.bpbynumber)):
-            self.output('error', message='No breakpoint numbered %s' % bpnum)
-        else:
-            bp = bdb.Breakpoint.bpbynumber[bpnum]
+        bp = self.breakpoint_numbered(bpnum)
+        if bp is not None:
             bp.disable()
-            self.output('breakpoint_disable', bpnum=bpnum)
+            self.update_breakpoint(bp)
+            self.output('breakpoint_disable', bpnum=bp.number)
 
-    # def do_condition(self, arg):
-    #     # arg is breakpoint number and condition
-    #     args = arg.split(' ', 1)
-    #     try:
-    #         bpnum = int(args[0].strip())
-    #     except ValueError:
-    #         # something went wrong
-    #         self.output('error', message='Breakpoint index %r is not a number' % args[0])
-    #         return
-    #     try:
-    #         cond = args[1]
-    #     except:
-    #         cond = None
-    #     try:
-    #         bp = bdb.Breakpoint.bpbynumber[bpnum]
-    #     except IndexError:
-    #         self.output('error', message='Breakpoint index %r is not valid' % args[0])
-    #         return
-    #     if bp:
-    #         bp.cond = cond
-    #         if not cond:
-    #             self.output('msg', message='Breakpoint %s is now unconditional' % bpnum)
+    def do_condition(self, bpnum, condition=None):
+        """Set the condition for a breakpoint.
+
+        The condition is compiled once, here; use a condition of None
+        (or an empty string) to make the breakpoint unconditional.
+        """
+        bp = self.breakpoint_numbered(bpnum)
+        if bp is None:
+            return
+        bpnum = bp.number
+        if condition:
+            try:
+                code = compile(condition, '<condition>', 'eval', 0, True)
+            except SyntaxError as e:
+                self.output('error', message='Invalid condition for breakpoint %s: %s' % (bpnum, e))
+                return
+            self.conditions[bpnum] = code
+        else:
+            condition = None
+            self.conditions.pop(bpnum, None)
+        bp.cond = condition
+        # Timings for the old condition are no longer relevant.
+        self.condition_timings.pop(bpnum, None)
+        self.output('breakpoint_condition', bpnum=bpnum, condition=condition)
+
+    def do_logpoint(self, bpnum, message=None):
+        """Make a breakpoint log a message, rather than stopping.
+
+        Use a message of None (or an empty string) to make the
+        breakpoint stop again.
+        """
+        bp = self.breakpoint_numbered(bpnum)
+        if bp is None:
+            return
+        bpnum = bp.number
+        if message:
+            try:
+                self.logpoints[bpnum] = Logpoint(message)
+            except (SyntaxError, ValueError) as e:
+                self.output('error', message='Invalid log message for breakpoint %s: %s' % (bpnum, e))
+                return
+        else:
+            message = None
+            self.logpoints.pop(bpnum, None)
+        self.output('breakpoint_log', bpnum=bpnum, message=message)
+
+    def do_watch(self, expression):
+        "Add a watch expression, and report its value in the current frame."
+        try:
+            watch = Watch(self._next_watch, expression)
+        except SyntaxError as e:
+            self.output('error', message='Invalid watch expression: %s' % e)
+            return
+        self._next_watch = self._next_watch + 1
+        self.watches[watch.number] = watch
+        self.output('watch_create', number=watch.number, expression=expression)
+        self.output_watches()
+
+    def do_unwatch(self, number):
+        if self.watches.pop(number, None) is None:
+            self.output('error', message='No watch numbered %s' % number)
+        else:
+            self.output('watch_clear', number=number)
+
+    def do_watchpoint(self, expression):
+        """Stop when a variable or attribute changes.
+
+        The expression is a name, or an attribute of a name (e.g.
+        self.state), looked up in the current frame.
+        """
+        if self.watchpoints is None:
+            if monitoring is None and not self.OBSERVES_LINES:
+                self.output('error', message='Before Python 3.12, watchpoints require the settrace engine.')
+                return
+            self.watchpoints = Watchpoints(
+                self.watchpoint_changed,
+                ignore_files=[source_file(bdb.__file__), source_file(__file__), '<string>'],
+                ignore_thread=self._own_thread,
+            )
+            if not self.watchpoints.start():
+                # There is no sys.monitoring; check in the trace function.
+                self.observe_lines(self.watchpoints.observe, self.watchpoints.watching)
+        try:
+            watchpoint = Watchpoint(self._next_watchpoint, expression, self.curframe, self.reprs.repr)
+        except Exception as e:
+            self.output('error', message='Invalid watchpoint %s: %s' % (expression, e))
+            return
+        self._next_watchpoint = self._next_watchpoint + 1
+        self.watchpoints.add(watchpoint)
+        self.output('watchpoint_create', number=watchpoint.number, expression=expression, value=watchpoint.repr)
+
+    def do_clear_watchpoint(self, number):
+        if self.watchpoints is None or self.watchpoints.remove(number) is None:
+            self.output('error', message='No watchpoint numbered %s' % number)
+        else:
+            self.output('watchpoint_clear', number=number)
+
+    def watchpoint_changed(self, watchpoint, frame, old, new):
+        "Stop the thread that has changed a watched variable."
+        if self._run_state == Debugger.STARTING or self.thread_state() is None:
+            return
+        self.output(
+            'watchpoint', number=watchpoint.number, expression=watchpoint.expression,
+            old=old, new=new, filename=self.canonic(frame.f_code.co_filename), line=frame.f_lineno
+        )
+        self.start_tracing(frame)
+        self.interaction(frame, None)
+        if self.quitting:
+            raise bdb.BdbQuit
 
     def do_ignore(self, bpnum, count):
         """arg is bp number followed by ignore count."""
@@ -374,25 +2315,29 @@ class Debugger(bdb.Bdb):
         except ValueError:
             count = 0
 
-        if not (0 <= bpnum < len(bdb.Breakpoint.bpbynumber)):
-            self.output('error', message='No breakpoint numbered %s' % bpnum)
-        else:
-            bp = bdb.Breakpoint.bpbynumber[bpnum]
+        bp = self.breakpoint_numbered(bpnum)
+        if bp is not None:
             bp.ignore = count
             if count > 0:
-                self.output('breakpoint_ignore', bpnum=bpnum, count=count)
+                self.output('breakpoint_ignore', bpnum=bp.number, count=count)
             else:
-                self.output('breakpoint_enable', bpnum=bpnum)
+                self.output('breakpoint_enable', bpnum=bp.number)
 
     def do_clear(self, bpnum):
         bpnum = int(bpnum)
         if not (0 <= bpnum < len(bdb.Breakpoint.bpbynumber)):
             self.output('error', message='No breakpoint numbered %s' % bpnum)
         else:
+            bp = bdb.Breakpoint.bpbynumber[bpnum]
             err = self.clear_bpbynumber(bpnum)
             if err:
                 self.output('error', message=err)
             else:
+                self.update_breakpoint(bp)
+                self.conditions.pop(bpnum, None)
+                self.condition_timings.pop(bpnum, None)
+                self.logpoints.pop(bpnum, None)
+                self._reported_stats.pop(bpnum, None)
                 self.output('breakpoint_clear', bpnum=bpnum)
 
     # def do_up(self, arg):
@@ -420,13 +2365,38 @@ class Debugger(bdb.Bdb):
     #     return 1
 
     def do_step(self):
+        if self.replay is not None:
+            self.replay.seek(1)
+            self.output_replay()
+            return
         self.set_step()
         return 1
 
     def do_next(self):
+        if self.replay is not None:
+            replay = self.replay
+            serial = replay.events[replay.position][0]
+            replay.seek(1, lambda position: (
+                replay.events[position][0] == serial or not replay.within(position, serial)
+            ))
+            self.output_replay()
+            return
         self.set_next(self.curframe)
         return 1
 
+    def do_step_back(self):
+        if self.start_replay():
+            if not self.replay.seek(-1):
+                self.output('info', message='Reached the start of the recording.')
+            self.output_replay()
+
+    def do_reverse_continue(self):
+        "Go back to the last recorded line with a breakpoint, or the start of the recording"
+        if self.start_replay():
+            if not self.replay.seek(-1, self._replay_break):
+                self.output('info', message='Reached the start of the recording.')
+            self.output_replay()
+
     def do_restart(self, **argv):
         """Restart program by raising an exception to be caught in the main
         debugger loop.  If arguments were given, set them in sys.argv."""
@@ -437,10 +2407,21 @@ class Debugger(bdb.Bdb):
         raise Restart
 
     def do_return(self):
+        if self.replay is not None:
+            replay = self.replay
+            serial = replay.events[replay.position][0]
+            replay.seek(1, lambda position: not replay.within(position, serial))
+            self.output_replay()
+            return
         self.set_return(self.curframe)
         return 1
 
     def do_continue(self):
+        if self.replay is not None:
+            # Replay forwards to a breakpoint, or back to the present.
+            self.replay.seek(1, self._replay_break)
+            self.output_replay()
+            return
         self.set_continue()
         return 1
 
@@ -474,24 +2455,68 @@ class Debugger(bdb.Bdb):
     #     sys.settrace(self.trace_dispatch)
     #     self.lastcmd = p.lastcmd
 
+    def do_select(self):
+        """Make this thread the current thread, and describe its stack.
+
+        The command names the thread to select, so it is always run
+        by the thread being selected.
+        """
+        with self._client_lock:
+            self._current_thread = get_ident()
+        self.describe_stop()
+
+    def do_inspect(self, node, frame=None, scope=None, ref=None, offset=0, limit=PAGE_SIZE):
+        """Describe a page of variables, or of the children of a value.
+
+        Either `frame` (an index into the stack) and `scope` ('locals',
+        'globals' or 'builtins') name a namespace, or `ref` is a reference
+        from an earlier inspection. `node` is returned, so the client can
+        tell what the inspection was for.
+        """
+        if self.replay is not None:
+            self.output('error', message="Values can't be inspected while replaying history")
+            return
+        if self.inspector is None:
+            self.inspector = Inspector(self._inspect_refs, self.reprs.repr)
+        # Every page has a budget of its own.
+        self.reprs.reset_budget()
+        if ref is None:
+            target = self.visible_stack()[frame][0]
+            if scope == 'locals':
+                namespace = self.curframe_locals if target is self.curframe else target.f_locals
+            elif scope == 'globals':
+                namespace = target.f_globals
+            elif scope == 'builtins':
+                namespace = target.f_builtins
+            else:
+                self.output('error', message='Unknown scope %s' % scope)
+                return
+            ref = self.inspector.ref(namespace, namespace=True)
+        try:
+            total, children = self.inspector.page(ref, offset, limit)
+        except KeyError:
+            # The value was from an earlier stop.
+            total, children = 0, []
+        self.output('inspection', node=node, ref=ref, offset=offset, total=total, children=children)
+
+    def do_freeze(self, frozen):
+        "Freeze (or stop freezing) the other threads while a thread is stopped."
+        with self._client_lock:
+            self.freeze_threads = frozen
+            self.freeze(frozen)
+
     def do_quit(self):
         self._user_requested_quit = True
         self.set_quit()
         return 1
 
     def do_close(self):
-        """Respond to a closed socket.
+        """Respond to the last client going away.
 
-        This isn't actually a user comman,but it's something the command
-        queue can generate in response to the socket closing; we handle
+        This isn't actually a user command, but it's something the
+        debugger queues when the last client's socket closes; we handle
         it as a user command for the sake of elegance.
         """
-        # print "Close down socket"
-        self.client = None
-        # print "Wait for command thread"
-        self.command_thread.join()
-        # print "Thread is dead"
-        self.commands = None
         raise ClientClose
 
     # def do_args(self, arg):
@@ -543,6 +2568,7 @@ class Debugger(bdb.Bdb):
         __main__.__dict__.update({
             "__name__": "__main__",
             "__file__": filename,
+            "__spec__": None,
             "__builtins__": __builtins__,
         })
 
@@ -554,29 +2580,787 @@ class Debugger(bdb.Bdb):
         self._run_state = Debugger.STARTING
         self.mainpyfile = self.canonic(filename)
         self._user_requested_quit = False
-        self.run('f = open("{filename}", "rb");'
-                 'code = compile(f.read(), "{filename}", "exec");'
-                 'exec(code);'
-                 'f.close();'.format(filename=filename))
+        cmd = ('f = open("{filename}", "rb");'
+               'code = compile(f.read(), "{filename}", "exec");'
+               'exec(code);'
+               'f.close();'.format(filename=filename))
+        if self.line_counts is not None:
+            self.line_counts.resume()
+        try:
+            if self.attach_on_connect and not self.hub.clients:
+                # Nobody is watching; run at full speed until somebody is.
+                self._run_state = Debugger.STARTED
+                self.run_detached(cmd)
+            else:
+                self.run(cmd)
+        finally:
+            if self.line_counts is not None:
+                self.line_counts.pause()
+            if self.history is not None:
+                self.history.pause()
+
+
+class MonitoringDebugger(Debugger):
+    """A debugger that uses sys.monitoring (PEP 669) instead of sys.settrace.
+
+    sys.settrace calls back into the debugger for every call and line of
+    every frame. sys.monitoring lets us be selective: LINE events are only
+    enabled on code objects that contain a breakpoint, or that are the
+    target of a next/return, and every other location returns DISABLE
+    the first time it is seen. Code that can't stop runs at full speed.
+
+    Only available on Python 3.12+.
+    """
+    TOOL_NAME = 'bugjar'
+
+    # Events that are needed to step into any line of any frame.
+    # Only enabled globally while single stepping.
+    if monitoring is not None:
+        TOOL_ID = monitoring.DEBUGGER_ID
+
+        STEP_EVENTS = (
+            monitoring.events.PY_START | monitoring.events.PY_RESUME |
+            monitoring.events.LINE |
+            monitoring.events.PY_RETURN | monitoring.events.PY_YIELD |
+            monitoring.events.RAISE
+        )
+        START_EVENTS = monitoring.events.PY_START | monitoring.events.PY_RESUME
+        RETURN_EVENTS = monitoring.events.PY_RETURN | monitoring.events.PY_YIELD
+
+    def __init__(self, *args, **kwargs):
+        if monitoring is None:
+            raise RuntimeError('The monitoring engine requires Python 3.12 or later.')
+        self._monitoring = False
+        Debugger.__init__(self, *args, **kwargs)
+
+        # Code objects that have local events enabled, and the events
+        # that are enabled on them.
+        self._local_events = {}
+        # Code objects that are known to contain a breakpoint.
+        self._break_codes = set()
+        # Is any thread single stepping?
+        self._stepping = False
+        # Code objects that a thread is stepping over with next/return.
+        self._next_codes = set()
+
+    def _start_monitoring(self):
+        "Register as a sys.monitoring tool, and enable the starting events."
+        events = monitoring.events
+        monitoring.use_tool_id(self.TOOL_ID, self.TOOL_NAME)
+        monitoring.register_callback(self.TOOL_ID, events.PY_START, self._on_start)
+        monitoring.register_callback(self.TOOL_ID, events.PY_RESUME, self._on_start)
+        monitoring.register_callback(self.TOOL_ID, events.LINE, self._on_line)
+        monitoring.register_callback(self.TOOL_ID, events.PY_RETURN, self._on_return)
+        monitoring.register_callback(self.TOOL_ID, events.PY_YIELD, self._on_yield)
+        monitoring.register_callback(self.TOOL_ID, events.RAISE, self._on_raise)
+        self._monitoring = True
+        self._update_events()
+
+    def _stop_monitoring(self):
+        "Disable all events, and release the sys.monitoring tool."
+        if not self._monitoring:
+            return
+        self._monitoring = False
+        monitoring.set_events(self.TOOL_ID, 0)
+        for code in self._local_events:
+            monitoring.set_local_events(self.TOOL_ID, code, 0)
+        self._local_events = {}
+        self._break_codes = set()
+        monitoring.free_tool_id(self.TOOL_ID)
+
+    def _update_events(self):
+        """Enable the events required by the current stop and breakpoint state.
+
+        This is called every time the program resumes, and every time the
+        set of breakpoints changes.
+        """
+        if not self._monitoring:
+            return
 
+        events = monitoring.events
+        wanted = {}
+        # Events are process wide, so they must satisfy every thread
+        # that is running. Stopped threads will update the events when
+        # they resume.
+        with self._client_lock:
+            states = [
+                state
+                for state in self._thread_states.values()
+                if state is not None and not state.stopped
+            ]
+        # While the program is frozen, every thread needs to see an event
+        # so that it can be stopped.
+        self._stepping = not self.quitting and (
+            self._frozen or any(not state.stopframe for state in states)
+        )
+        next_codes = set()
+        if self.quitting:
+            global_events = 0
+        elif self._stepping:
+            # Single stepping; we need to see everything.
+            global_events = self.STEP_EVENTS
+        else:
+            global_events = 0
+            if self.breakpoint_index:
+                # Watch for new code objects that contain breakpoints.
+                global_events |= self.START_EVENTS
+
+                # Code that is already running won't start again;
+                # check every frame that is currently on a stack.
+                for frame in sys._current_frames().values():
+                    while frame is not None:
+                        if self.breakpoint_index.has_breaks(frame.f_code):
+                            self._break_codes.add(frame.f_code)
+                        frame = frame.f_back
+
+                self._break_codes = set(code for code in self._break_codes if self.breakpoint_index.has_breaks(code))
+                for code in self._break_codes:
+                    wanted[code] = events.LINE
+
+            for state in states:
+                # A next, return or until needs to see the lines and
+                # the return of the frame being stepped over.
+                if state.stoplineno != -1:
+                    code = state.stopframe.f_code
+                    wanted[code] = wanted.get(code, 0) | events.LINE | self.RETURN_EVENTS
+                    global_events |= events.RAISE
+                    next_codes.add(code)
+                elif state.stopframe is not state.botframe:
+                    # A return from a coroutine; see coroutine_return().
+                    code = state.stopframe.f_code
+                    wanted[code] = wanted.get(code, 0) | self.RETURN_EVENTS
+                if state.returnframe is not None:
+                    code = state.returnframe.f_code
+                    wanted[code] = wanted.get(code, 0) | self.RETURN_EVENTS
+        self._next_codes = next_codes
+
+        monitoring.set_events(self.TOOL_ID, global_events)
+        for code in self._local_events:
+            if code not in wanted:
+                monitoring.set_local_events(self.TOOL_ID, code, 0)
+        for code, code_events in wanted.items():
+            if self._local_events.get(code) != code_events:
+                monitoring.set_local_events(self.TOOL_ID, code, code_events)
+        self._local_events = wanted
+
+        # Anything that was previously disabled may now be of interest.
+        monitoring.restart_events()
+
+    # sys.monitoring callbacks.
+
+    def _event_frame(self):
+        """Return the frame that generated the current event.
+
+        Returns None if the event should be ignored - because it came from
+        another thread, from the debugger itself, or after we've quit.
+        """
+        if self.quitting:
+            return None
+        state = self.thread_state()
+        if state is None:
+            return None
+        if self._frozen:
+            self.wait_while_frozen(state)
+        # The frame that generated the event is the caller of the callback.
+        frame = sys._getframe(2)
+        if frame is state.botframe:
+            return None
+        return frame
+
+    def _on_start(self, code, instruction_offset):
+        frame = self._event_frame()
+        if frame is None:
+            return
+        if self.stop_here(frame):
+            # Ignore call events in generator except when stepping.
+            if not (self.stopframe and code.co_flags & bdb.GENERATOR_AND_COROUTINE_FLAGS):
+                self.user_call(frame, None)
+                if self.quitting:
+                    raise bdb.BdbQuit
+
+        if self._stepping:
+            # A thread is single stepping; keep receiving events.
+            return
 
-def run(hostname, port, filename, *args):
-    # Hide "debugger.py" from argument list
-    sys.argv[0] = filename
-    sys.argv[1:] = args
+        if self.breakpoint_index.has_breaks(code) and code not in self._break_codes:
+            self._break_codes.add(code)
+            events = self._local_events.get(code, 0) | monitoring.events.LINE
+            monitoring.set_local_events(self.TOOL_ID, code, events)
+            self._local_events[code] = events
 
-    # Replace debugger's dir with script's dir in front of module search path.
-    sys.path[0] = os.path.dirname(filename)
+        return monitoring.DISABLE
 
-    # Create a socket and listen on it for a client debugger
+    def _on_line(self, code, line_number):
+        frame = self._event_frame()
+        if frame is None:
+            return
+        if self.stop_here(frame) or self.break_here(frame):
+            self.user_line(frame)
+            if self.quitting:
+                raise bdb.BdbQuit
+        elif not self._stepping and code not in self._next_codes:
+            # No thread is stepping through this code, so the only
+            # reason to be here is a breakpoint. If this isn't a
+            # breakpoint line, we never need to see it again.
+            if not self.breakpoint_index.has_line(code.co_filename, line_number):
+                return monitoring.DISABLE
+
+    def _on_return(self, code, instruction_offset, retval):
+        frame = self._event_frame()
+        if frame is None:
+            return
+        if code.co_flags & CO_ASYNC:
+            if self.coroutine_return(frame, retval):
+                # The step carries on in a different frame.
+                self._update_events()
+        else:
+            self._returning(frame, code, retval)
+
+    def _on_yield(self, code, instruction_offset, retval):
+        frame = self._event_frame()
+        if frame is None:
+            return
+        if code.co_flags & CO_ASYNC:
+            if self.coroutine_suspend(frame):
+                # The step carries on when the coroutine resumes.
+                self._update_events()
+        else:
+            self._returning(frame, code, retval)
+
+    def _returning(self, frame, code, retval):
+        if self.stop_here(frame) or frame is self.returnframe:
+            # Ignore return events in generator except when stepping.
+            if self.stopframe and code.co_flags & bdb.GENERATOR_AND_COROUTINE_FLAGS:
+                return
+            try:
+                self.frame_returning = frame
+                self.user_return(frame, retval)
+            finally:
+                self.frame_returning = None
+            if self.quitting:
+                raise bdb.BdbQuit
+            # The user issued a 'next'; stop in the caller.
+            if self.stopframe is frame and self.stoplineno != -1:
+                self._set_stopinfo(None, None)
+
+    def _on_raise(self, code, instruction_offset, exception):
+        frame = self._event_frame()
+        if frame is None:
+            return
+        if self.stop_here(frame):
+            # When stepping with next/return in a generator frame, skip
+            # the internal StopIteration raised by 'yield from'.
+            if not (code.co_flags & bdb.GENERATOR_AND_COROUTINE_FLAGS and
+                    isinstance(exception, StopIteration) and exception.__traceback__ is None):
+                self.user_exception(frame, (type(exception), exception, exception.__traceback__))
+                if self.quitting:
+                    raise bdb.BdbQuit
+
+    # Override Bdb methods that manipulate sys.settrace.
+
+    def run(self, cmd, globals=None, locals=None):
+        if globals is None:
+            import __main__
+            globals = __main__.__dict__
+        if locals is None:
+            locals = globals
+        self.reset()
+        if isinstance(cmd, basestring):
+            cmd = compile(cmd, '<string>', 'exec')
+
+        # This frame is the bottom of the debugged stack.
+        self.botframe = sys._getframe()
+        self._thread_ident = get_ident()
+        self._start_monitoring()
+        try:
+            exec(cmd, globals, locals)
+        except bdb.BdbQuit:
+            pass
+        finally:
+            self.quitting = True
+            self._stop_monitoring()
+
+    def _set_stopinfo(self, *args, **kwargs):
+        bdb.Bdb._set_stopinfo(self, *args, **kwargs)
+        self._update_events()
+
+    def set_continue(self):
+        # Unlike Bdb, there's no trace function to remove;
+        # if there are no breakpoints, no events will be enabled.
+        self._set_stopinfo(self.botframe, None, -1)
+
+    def set_quit(self):
+        self.stopframe = self.botframe
+        self.returnframe = None
+        self.quitting = True
+        self._update_events()
+
+    def update_breakpoint(self, bp):
+        Debugger.update_breakpoint(self, bp)
+        self._update_events()
+
+    def trace_stack(self, frame):
+        # There are no frame trace functions to install.
+        pass
+
+    def interaction(self, frame, tb):
+        Debugger.interaction(self, frame, tb)
+        # This thread is running again.
+        self._update_events()
+
+    def freeze(self, frozen):
+        Debugger.freeze(self, frozen)
+        self._update_events()
+
+    def request_attach(self):
+        # Events are process wide, so they can be enabled from any thread.
+        # This is called from the listener thread; stop the script thread.
+        state = self._thread_states[self._thread_ident]
+        state.stopframe = None
+        state.returnframe = None
+        state.stoplineno = 0
+        self.start_tracing(None)
+
+    def start_tracing(self, frame):
+        if self._monitoring:
+            self._update_events()
+        else:
+            self._start_monitoring()
+
+    def stop_tracing(self):
+        self._stop_monitoring()
+
+
+def _is_docstring(stmt):
+    "Is a statement a bare string (and so, potentially, a docstring)?"
+    if not isinstance(stmt, ast.Expr):
+        return False
+    if isinstance(stmt.value, getattr(ast, 'Constant', ())):
+        return isinstance(stmt.value.value, basestring)
+    return isinstance(stmt.value, getattr(ast, 'Str', ()))
+
+
+def _trap_statements(tree, lines):
+    """Insert a call to the breakpoint trap before every statement in
+    `tree` that starts on one of `lines`.
+
+    The header of a loop (or a with statement) runs again after the
+    statement has started, which a trap in front of it would miss; those
+    lines are left to tracing.
+
+    Returns the set of lines that were trapped, and the set of lines
+    that can't be.
+    """
+    trapped = set()
+    untrappable = set()
+    for node in ast.walk(tree):
+        for field in ('body', 'orelse', 'finalbody'):
+            stmts = getattr(node, field, None)
+            if not isinstance(stmts, list):
+                continue
+            new_stmts = []
+            for index, stmt in enumerate(stmts):
+                lineno = getattr(stmt, 'lineno', None)
+                if lineno in lines and isinstance(stmt, RERUN_STATEMENTS):
+                    untrappable.add(lineno)
+                # Docstrings and __future__ imports must stay first.
+                elif lineno in lines and not (index == 0 and _is_docstring(stmt)) and not (
+                        isinstance(stmt, ast.ImportFrom) and stmt.module == '__future__'):
+                    trap = ast.parse('%s()' % TRAP_NAME).body[0]
+                    for trap_node in ast.walk(trap):
+                        ast.copy_location(trap_node, stmt)
+                    new_stmts.append(trap)
+                    trapped.add(lineno)
+                new_stmts.append(stmt)
+            setattr(node, field, new_stmts)
+    return trapped - untrappable, untrappable
+
+
+def _code_lines(code):
+    "Return the set of lines that start a statement in a code object."
+    return set(line for _, line in dis.findlinestarts(code) if line is not None)
+
+
+def _nested_codes(code):
+    "Iterate over a code object, and every code object nested inside it."
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            for nested in _nested_codes(const):
+                yield nested
+
+
+class PatchingDebugger(Debugger):
+    """A debugger that patches breakpoints into the code being debugged.
+
+    When the program is continued, every function containing an enabled
+    breakpoint has its code object replaced with a copy, recompiled from
+    source, that calls a trap at the start of each breakpoint line. If
+    every breakpoint can be patched, no trace function is installed at
+    all while the program runs freely. Stepping uses the normal bdb
+    tracing.
+
+    Code that can't be patched - code that is already running (such as
+    the body of the main script), or functions that haven't been defined
+    yet - falls back to tracing until the next time the debugger stops.
+    """
+    # Patched code isn't traced, so lines can't be observed.
+    OBSERVES_LINES = False
+
+    def __init__(self, *args, **kwargs):
+        Debugger.__init__(self, *args, **kwargs)
+
+        # Canonical filename -> (patched lines, [(function, original code)])
+        self._patched = {}
+        # Every patched code object ever created -> the original code
+        self._originals = {}
+        # The patched code objects that are currently in use.
+        self._trapped = set()
+        # Canonical filename -> the breakpoint lines that are patched.
+        self._covered = {}
+        # Frames running unpatched code that contains a breakpoint.
+        self._blocking = set()
+
+    def _trap(self):
+        "The trap that is called at the start of a patched breakpoint line."
+        frame = sys._getframe(1)
+        # If the frame is being traced, bdb will deal with the breakpoint.
+        if frame.f_trace is not None or self.quitting:
+            return
+        state = self.thread_state()
+        if state is None:
+            return
+        if self._frozen:
+            self.wait_while_frozen(state)
+        if self.break_here(frame):
+            self.user_line(frame)
+            if self.quitting:
+                raise bdb.BdbQuit
+            if self.stopframe is not self.botframe or self.stoplineno != -1:
+                # Stepping from the breakpoint; fall back to tracing.
+                self.trace_stack(frame)
+                sys.settrace(self.trace_dispatch)
+
+    def _restore(self, filename):
+        "Put back the original code for every function patched in a file."
+        lines, functions = self._patched.pop(filename, (None, []))
+        for function, original in functions:
+            self._trapped.discard(function.__code__)
+            if self._originals.get(function.__code__) is original:
+                function.__code__ = original
+
+    def _patch(self, filename, lines, functions, running):
+        """Patch the given lines of a file into the functions from that file.
+
+        `running` is the set of code objects that are currently executing.
+
+        Returns the set of lines that are covered by the patched functions.
+        """
+        source = ''.join(linecache.getlines(filename))
+        if not source or not functions:
+            return set()
+        co_filename = functions[0].__code__.co_filename
+        flags = functions[0].__code__.co_flags & FUTURE_FLAGS
+        try:
+            tree = ast.parse(source, co_filename)
+            trapped_lines, untrappable_lines = _trap_statements(tree, lines)
+            module_code = compile(tree, co_filename, 'exec', flags, True)
+        except (SyntaxError, ValueError):
+            return set()
+
+        # Index the recompiled code by name and first line. Anything
+        # that is ambiguous (e.g., two lambdas on one line) is skipped.
+        trapped_codes = {}
+        for code in _nested_codes(module_code):
+            key = code.co_name, code.co_firstlineno
+            trapped_codes[key] = None if key in trapped_codes else code
+
+        patched_lines = set()
+        patched = []
+        for function in functions:
+            original = self._originals.get(function.__code__, function.__code__)
+            all_lines = set()
+            for code in _nested_codes(original):
+                all_lines.update(_code_lines(code))
+            if all_lines.isdisjoint(trapped_lines):
+                continue
+            # A function with a breakpoint that can't be trapped is traced.
+            if not all_lines.isdisjoint(untrappable_lines):
+                continue
+            trapped = trapped_codes.get((original.co_name, original.co_firstlineno))
+            # Make sure the source still matches the code that is running.
+            if (trapped is None or trapped.co_freevars != original.co_freevars or
+                    _code_lines(trapped) != _code_lines(original)):
+                continue
+            # Map each nested code to its own original. Code objects compare
+            # by value, so an untrapped nested function (e.g., in the body of
+            # a script) is equal to its original, and must map back to it.
+            nested = dict(
+                ((code.co_name, code.co_firstlineno), code)
+                for code in _nested_codes(original)
+            )
+            for code in _nested_codes(trapped):
+                key = code.co_name, code.co_firstlineno
+                self._originals[code] = self._originals.get(code, nested.get(key, original))
+            self._originals[trapped] = original
+            function.__code__ = trapped
+            self._trapped.add(trapped)
+            patched.append((function, original))
+            # If the original code is running, any nested functions it
+            # creates will be made from the original, unpatched code.
+            if original not in running:
+                patched_lines.update(all_lines & trapped_lines)
+
+        self._patched[filename] = (frozenset(lines), patched)
+        return patched_lines
+
+    def _running_frames(self, returning=None):
+        "Iterate over every frame that is executing, in every thread."
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                if frame is not returning:
+                    yield frame
+                frame = frame.f_back
+
+    def patch_breakpoints(self, returning=None):
+        """Patch every enabled breakpoint into the functions that contain it.
+
+        `returning` is a frame that is about to return, and so can be
+        ignored.
+
+        Returns True if every enabled breakpoint is patched, and it is safe
+        to run without a trace function.
+        """
+        # Code that is already running can't be patched.
+        running = set(
+            self._originals.get(frame.f_code, frame.f_code)
+            for frame in self._running_frames(returning)
+        )
+
+        wanted = dict(
+            (filename, frozenset(lines))
+            for filename, lines in self.breakpoint_index.files.items()
+            if lines
+        )
+        # Patch any file where the breakpoints have changed, or where
+        # there are breakpoints that we couldn't patch last time.
+        changed = [
+            filename
+            for filename in set(wanted) | set(self._patched)
+            if self._patched.get(filename, (None,))[0] != wanted.get(filename) or
+            not wanted[filename] <= self._covered.get(filename, set())
+        ]
+        if changed:
+            functions = {}
+            for obj in gc.get_objects():
+                if isinstance(obj, types.FunctionType):
+                    filename = self.canonic(obj.__code__.co_filename)
+                    if filename in changed:
+                        functions.setdefault(filename, []).append(obj)
+
+            for filename in changed:
+                self._restore(filename)
+                self._covered.pop(filename, None)
+                if filename in wanted:
+                    self._covered[filename] = self._patch(
+                        filename, wanted[filename], functions.get(filename, []), running
+                    )
+
+        # A frame that is running unpatched code will miss its breakpoints
+        # unless it is traced. Once they have all returned, we can try again.
+        self._blocking = set()
+        for frame in self._running_frames(returning):
+            if frame.f_code not in self._trapped and self.breakpoint_index.has_breaks(frame.f_code):
+                lines = wanted.get(self.canonic(frame.f_code.co_filename), ())
+                if not _code_lines(frame.f_code).isdisjoint(lines):
+                    self._blocking.add(frame)
+
+        if self._blocking:
+            return False
+        for filename, lines in wanted.items():
+            if not lines <= self._covered.get(filename, set()):
+                return False
+        return True
+
+    def untrace(self):
+        "Remove the trace function, and all frame tracing."
+        self.settrace(None)
+        frame = sys._getframe().f_back
+        while frame and frame is not self.botframe:
+            del frame.f_trace
+            frame = frame.f_back
+
+    # Override Bdb methods
+
+    def run(self, cmd, globals=None, locals=None):
+        setattr(builtins, TRAP_NAME, self._trap)
+        try:
+            Debugger.run(self, cmd, globals, locals)
+        finally:
+            delattr(builtins, TRAP_NAME)
+
+    def run_detached(self, cmd, globals=None, locals=None):
+        setattr(builtins, TRAP_NAME, self._trap)
+        try:
+            Debugger.run_detached(self, cmd, globals, locals)
+        finally:
+            delattr(builtins, TRAP_NAME)
+
+    def break_anywhere(self, frame):
+        # Patched code will trap its own breakpoints.
+        if frame.f_code in self._trapped:
+            return False
+        return Debugger.break_anywhere(self, frame)
+
+    def dispatch_return(self, frame, arg):
+        result = Debugger.dispatch_return(self, frame, arg)
+        if frame in self._blocking:
+            # If this was the last frame that needed tracing, and we're
+            # still running freely, try to drop the trace function.
+            self._blocking.discard(frame)
+            if not self._blocking and self.stopframe is self.botframe and self.stoplineno == -1:
+                if self.patch_breakpoints(returning=frame):
+                    self.untrace()
+                    return None
+        return result
+
+    def start_tracing(self, frame):
+        # When continuing, set_continue() has already installed
+        # tracing if (and only if) it is needed.
+        if self.stopframe is not self.botframe or self.stoplineno != -1:
+            Debugger.start_tracing(self, frame)
+
+    def set_continue(self):
+        if self.patch_breakpoints():
+            # Every breakpoint will trap; run without a trace function.
+            self._set_stopinfo(self.botframe, None, -1)
+            self.untrace()
+        else:
+            Debugger.set_continue(self)
+            # If we stopped at a trap, there may not be a trace function.
+            self.settrace(self.trace_dispatch)
+
+
+# The tracing engines that can be used to run a script.
+ENGINES = {
+    'settrace': Debugger,
+    'monitoring': MonitoringDebugger,
+    'patch': PatchingDebugger,
+}
+
+
+def listen_socket(hostname, port):
+    "Create a socket, listening for a client debugger."
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
     s.bind((hostname, port))
-    s.listen(1)
+    s.listen(LISTEN_BACKLOG)
+    return s
 
-    debugger = Debugger(s, hostname, port)
 
+def listen_unix_socket(path):
+    """Create a Unix domain socket at `path`, listening for a client
+    debugger. Only the current user can connect to it.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        s.bind(path)
+    finally:
+        os.umask(umask)
+    s.listen(LISTEN_BACKLOG)
+    return s
+
+
+def signal_ready(address, ready_fd=None, ready_file=None):
+    """Tell whoever started the net that it is listening for a client.
+
+    The address clients connect to is written, as a line, to an inherited
+    file descriptor (which is then closed), and/or to a file, which
+    appears all at once.
+    """
+    line = ('%s\n' % address).encode('utf8')
+    if ready_fd is not None:
+        try:
+            os.write(ready_fd, line)
+        except OSError:
+            pass
+        finally:
+            os.close(ready_fd)
+    if ready_file is not None:
+        partial = ready_file + '.partial'
+        with open(partial, 'wb') as f:
+            f.write(line)
+        os.rename(partial, ready_file)
+
+
+def run_child(hostname, registry, engine, attach_on_connect, breakpoints, **kwds):
+    """Debug a child process started by multiprocessing's spawn method.
+
+    The child listens for its own client on any free port, sets the
+    breakpoints of its parent, and then runs until it hits one.
+    """
+    from multiprocessing.spawn import spawn_main
+
+    s = listen_socket(hostname, 0)
+    debugger = ENGINES[engine](
+        s, hostname, s.getsockname()[1],
+        attach_on_connect=attach_on_connect
+    )
+    debugger.follow(registry)
+    debugger.register_child()
+    for bp_data in breakpoints:
+        debugger.set_break(bp_data['filename'], bp_data['line'], bp_data['temporary'], bp_data['condition'])
+        bp = debugger.get_breaks(bp_data['filename'], bp_data['line'])[-1]
+        if not bp_data['enabled']:
+            bp.disable()
+        if bp_data['log']:
+            debugger.logpoints[bp.number] = Logpoint(bp_data['log'])
+        debugger.update_breakpoint(bp)
+    debugger.listen()
+
+    debugger._run_state = Debugger.STARTED
+    debugger.run_detached('spawn_main(**kwds)', {'spawn_main': spawn_main, 'kwds': kwds})
+
+
+def run(hostname, port, filename, *args, **options):
+    # Hide "debugger.py" from argument list
+    sys.argv[0] = filename
+    sys.argv[1:] = args
+
+    # Replace debugger's dir with script's dir in front of module search path.
+    sys.path[0] = os.path.dirname(filename)
+
+    # Create a socket and listen on it for a client debugger
+    path = options.get('socket_path')
+    if path:
+        s = listen_unix_socket(path)
+    else:
+        s = listen_socket(hostname, port)
+
+    debugger = ENGINES[options.get('engine', 'settrace')](
+        s, hostname, port,
+        attach_on_connect=options.get('attach_on_connect', False),
+        path=path
+    )
+    debugger.listen()
+    if options.get('follow_children', False):
+        debugger.follow()
+    if options.get('profile'):
+        debugger.profile(options['profile'])
+    if options.get('heatmap'):
+        debugger.count_lines()
+    if options.get('record'):
+        debugger.record(options['record'])
+
+    # Clients can connect as soon as the socket is listening.
+    if options.get('ready_fd') is not None or options.get('ready_file'):
+        signal_ready(debugger.address, options.get('ready_fd'), options.get('ready_file'))
+
+    # Anything still queued for the clients is sent before they are
+    # disconnected, unless the session ended abruptly.
+    flush = True
     while True:
         try:
             # print 'Start the script'
@@ -586,21 +3370,30 @@ def run(hostname, port, filename, *args):
                 # print 'user requested exit'
                 break
 
+            if debugger.forked:
+                # A forked child doesn't restart the parent's script.
+                break
+
+            debugger.flush_log()
+            if debugger.sampler is not None:
+                debugger.output_profile()
+            if debugger.line_counts is not None:
+                debugger.output_heatmap()
             debugger.output('restart')
         except Restart:
             print("Restarting", filename, "with arguments:")
             print("\t" + " ".join(sys.argv[1:]))
         except KeyboardInterrupt:
             print("Keyboard interrupt")
-            debugger.client = None
+            flush = False
             break
         except SystemExit:
             print("System exit")
-            debugger.client = None
+            flush = False
             break
         except socket.error:
             print("Controller client disappeared; can't recover")
-            debugger.client = None
+            flush = False
             break
         except:
             traceback.print_exc()
@@ -608,6 +3401,28 @@ def run(hostname, port, filename, *args):
             t = sys.exc_info()[2]
             debugger.interaction(None, t)
 
-    if debugger.client:
-        # print "closing connection"
-        debugger.client.shutdown(socket.SHUT_WR)
+    if debugger.sampler is not None:
+        debugger.sampler.stop()
+        if options.get('profile_output'):
+            debugger.sampler.save(options['profile_output'])
+            print("Profile written to", options['profile_output'])
+
+    if debugger.line_counts is not None:
+        debugger.line_counts.stop()
+        if options.get('heatmap_output'):
+            debugger.line_counts.save_coverage(options['heatmap_output'])
+            print("Line counts written to", options['heatmap_output'])
+
+    if debugger.history is not None:
+        debugger.history.stop()
+
+    if debugger.watchpoints is not None:
+        debugger.watchpoints.stop()
+
+    # print "closing connections"
+    debugger.hub.close(flush)
+    if debugger.path is not None:
+        try:
+            os.remove(debugger.path)
+        except OSError:
+            pass
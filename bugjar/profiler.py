@@ -0,0 +1,276 @@
+"""A sampling profiler for a program running under bugjar-net.
+
+A background thread looks at the stack of every thread in the program
+using sys._current_frames(), at a regular interval. No trace function is
+needed, so the program runs at (nearly) full speed.
+
+Samples are aggregated as a folded stack table: every distinct stack
+(a tuple of frame ids, outermost first) maps to the number of times it
+was seen. The table is shared by the net and the GUI; the net streams
+the parts of the table that have changed, and the GUI adds them to its
+own copy.
+"""
+from __future__ import print_function, unicode_literals
+import io
+import json
+import sys
+import threading
+from threading import Lock
+import time
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident  # python 2.x
+
+from bugjar import VERSION
+
+
+# The pseudo-frame that represents time spent inside the debugger.
+DEBUGGER_FRAME = ('[debugger]', '', 0)
+
+
+class Profile(object):
+    """A table of stack samples.
+
+    `frames` is a list of (name, filename, line) tuples; a stack is
+    a tuple of indices into that list. `stacks` maps a (thread name,
+    stack) pair to the number of samples of that stack.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.frames = []
+        self.stacks = {}
+        self.samples = 0
+        self.lock = Lock()
+
+    def update(self, frames, stacks):
+        "Add a snapshot (as produced by Sampler.snapshot()) to the table"
+        with self.lock:
+            self.frames.extend(tuple(frame) for frame in frames)
+            for thread, stack, count in stacks:
+                key = (thread, tuple(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + count
+                self.samples += count
+
+    def frame_name(self, frame_id):
+        "The display name of a frame"
+        name, filename, line = self.frames[frame_id]
+        if filename:
+            return '%s (%s:%s)' % (name, filename, line)
+        return name
+
+    def call_tree(self):
+        """Merge all the stacks into a tree.
+
+        Each node is a [count, children] pair; children maps a key to
+        a child node. The children of the root are keyed by thread
+        name; all other nodes are keyed by frame id.
+        """
+        root = [0, {}]
+        with self.lock:
+            for (thread, stack), count in self.stacks.items():
+                root[0] += count
+                node = root[1].setdefault(thread, [0, {}])
+                node[0] += count
+                for frame_id in stack:
+                    node = node[1].setdefault(frame_id, [0, {}])
+                    node[0] += count
+        return root
+
+    def collapsed(self):
+        """The profile in the "collapsed stack" format.
+
+        This is the format used by flamegraph.pl (and many other tools):
+        one line per stack, with the frames separated by semicolons,
+        followed by the number of samples.
+        """
+        with self.lock:
+            lines = sorted(
+                '%s %s' % (
+                    ';'.join([thread] + [self.frame_name(frame_id) for frame_id in stack]),
+                    count
+                )
+                for (thread, stack), count in self.stacks.items()
+            )
+        return ''.join('%s\n' % line for line in lines)
+
+    def speedscope(self):
+        "The profile in speedscope's file format, with a profile for each thread."
+        profiles = {}
+        with self.lock:
+            for (thread, stack), count in sorted(self.stacks.items()):
+                profile = profiles.setdefault(thread, {
+                    'type': 'sampled',
+                    'name': thread,
+                    'unit': 'seconds',
+                    'startValue': 0,
+                    'endValue': 0,
+                    'samples': [],
+                    'weights': [],
+                })
+                profile['samples'].append(list(stack))
+                profile['weights'].append(count * self.interval)
+                profile['endValue'] += count * self.interval
+            frames = [
+                {'name': name, 'file': filename, 'line': line}
+                for name, filename, line in self.frames
+            ]
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': frames},
+            'profiles': [profiles[thread] for thread in sorted(profiles)],
+            'name': 'bugjar profile',
+            'activeProfileIndex': 0,
+            'exporter': 'bugjar %s' % VERSION,
+        }
+
+    def save(self, filename):
+        """Write the profile to a file.
+
+        A filename ending in .json is written in speedscope's format;
+        anything else is written as collapsed stacks.
+        """
+        if filename.endswith('.json'):
+            content = json.dumps(self.speedscope())
+        else:
+            content = self.collapsed()
+        with io.open(filename, 'w', encoding='utf8') as f:
+            f.write(content)
+
+
+class Sampler(Profile):
+    """A profile that is filled by sampling the threads of this process.
+
+    `ignore` is called with a thread ident, and should return True if
+    that thread shouldn't be sampled (e.g., it belongs to the debugger,
+    or it's stopped at a breakpoint). Frames in any of `debugger_files`
+    are treated as debugger overhead. Frames in any of `root_files`
+    (the code that starts the program or a thread) are left out when
+    they are at the root of a stack.
+
+    `report` is called (on the sampling thread) every `report_interval`
+    seconds.
+    """
+    def __init__(self, interval, ignore, debugger_files, root_files=(),
+                 report=None, report_interval=1.0):
+        super(Sampler, self).__init__(interval)
+        self.ignore = ignore
+        self.debugger_files = set(debugger_files)
+        self.root_files = self.debugger_files.union(root_files)
+        self.report = report
+        self.report_interval = report_interval
+
+        # The code objects on the stack of the thread that creates the
+        # sampler (the code that starts the debugger) are never sampled.
+        self.root_codes = set()
+        frame = sys._getframe()
+        while frame is not None:
+            self.root_codes.add(frame.f_code)
+            frame = frame.f_back
+
+        self._frame_ids = {}
+        self._thread_names = {}
+        self._changed = {}
+        self._sent_frames = 0
+        self._stopped = False
+
+    def run(self):
+        "Take samples until stopped. Call this in a thread of its own."
+        ident = get_ident()
+        last_report = time.time()
+        while True:
+            time.sleep(self.interval)
+            if self._stopped:
+                break
+            self.sample(ident)
+            if self.report and time.time() - last_report >= self.report_interval:
+                last_report = time.time()
+                self.report()
+
+    def stop(self):
+        self._stopped = True
+
+    def frame_id(self, key, frame):
+        "Return the frame id for a code object (or pseudo-frame), allocating it if needed"
+        try:
+            return self._frame_ids[key]
+        except KeyError:
+            with self.lock:
+                frame_id = len(self.frames)
+                self.frames.append(frame)
+                self._frame_ids[key] = frame_id
+            return frame_id
+
+    def thread_name(self, ident):
+        try:
+            return self._thread_names[ident]
+        except KeyError:
+            # Thread names are cached, so only look for new threads.
+            self._thread_names = dict(
+                (thread.ident, thread.name) for thread in threading.enumerate()
+            )
+            return self._thread_names.get(ident, 'Thread-%s' % ident)
+
+    def sample(self, own_ident):
+        "Take a sample of the stack of every thread"
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident or self.ignore(ident):
+                continue
+
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.reverse()
+
+            # Skip the frames that start the program (or the thread).
+            start = 0
+            while start < len(codes) and (
+                    codes[start] in self.root_codes or
+                    codes[start].co_filename in self.root_files):
+                start = start + 1
+
+            # Any time spent inside the debugger is shown as a single frame.
+            end = len(codes)
+            while end > start and codes[end - 1].co_filename in self.debugger_files:
+                end = end - 1
+
+            stack = [
+                self.frame_id(code, (code.co_name, code.co_filename, code.co_firstlineno))
+                for code in codes[start:end]
+            ]
+            if end < len(codes):
+                stack.append(self.frame_id(DEBUGGER_FRAME, DEBUGGER_FRAME))
+            if not stack:
+                continue
+
+            key = (self.thread_name(ident), tuple(stack))
+            with self.lock:
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self._changed[key] = self._changed.get(key, 0) + 1
+                self.samples += 1
+
+    def snapshot(self, full=False):
+        """Return the changes to the profile since the last snapshot.
+
+        The result can be passed to Profile.update(). If `full` is True,
+        the whole profile is returned, for a new Profile.
+        """
+        with self.lock:
+            if full:
+                first = 0
+                changed = self.stacks
+            else:
+                first = self._sent_frames
+                changed = self._changed
+            snapshot = {
+                'frames': self.frames[first:],
+                'stacks': [
+                    [thread, list(stack), count]
+                    for (thread, stack), count in changed.items()
+                ],
+            }
+            self._sent_frames = len(self.frames)
+            self._changed = {}
+        return snapshot
@@ -0,0 +1,557 @@
+"""The wire protocol spoken between bugjar-net and its clients.
+
+Every message is an (event, data) pair - or (command, args), from the
+client. Originally, messages were encoded as JSON, and terminated by an ETX
+byte; a reader had to scan everything it received for the terminator.
+Messages can now be framed with a 4 byte (big endian) length prefix
+instead, so a reader knows how much to expect, and can receive a large
+message (such as a stack with thousands of variables) straight into a
+buffer of the right size. They can also be encoded with a faster codec:
+msgpack (if it is installed at both ends) or, between two Python 3
+processes, marshal. With length-prefixed framing, messages over a size
+threshold can also be compressed, with zlib or (if zstandard is installed
+at both ends) zstd; the top bit of the length says whether a message is
+compressed. Between two processes on the same machine, connected by a Unix
+domain socket, large messages from the net can be written to a ring buffer
+in shared memory instead (see SharedRing); the message on the socket just
+says where to find it, and the next bit of the length marks it.
+
+Both ends start out speaking the original protocol, so old clients and
+old nets keep working. When a client connects, the net offers the
+framings, codecs and compressions it supports in a `protocol_offer` event. A client
+that understands the offer replies with a `protocol` command naming its
+choices, and sends everything after that command in the new framing. The net
+acknowledges with a `protocol` event, and everything it sends after that
+event uses the new framing. A client that doesn't understand the offer
+ignores it, and the net never switches.
+
+The offer also lists optional features of the protocol; the client names
+the ones it wants in its `protocol` command. With `stack_delta`, the net
+only sends the first stack of each thread in full. After that, a stop
+is described by the frames on the stack (identified by the ids the client
+was given) and what has changed in each of them since the last stop
+(see diff_frame() and patch_frame()). With `inspect`, stacks only
+describe the current frame's locals by name and type; the client asks
+for the values it wants with `inspect` commands (see bugjar.inspector).
+With `namespaces`, a stack that does describe every variable sends each
+module's globals (and the builtins) once, in a `namespace` event, and
+frames refer to them by id; when a namespace changes, only the changes
+are sent. With `requests`, the client can give any command a `request`
+id; every event sent while the command is being run carries the same
+id, and a `done` event with that id says the command has finished.
+
+A net can have several clients at once (see bugjar.hub); each of them
+chooses its own protocol. Every client is sent a `control` event when it
+connects, and whenever control of the session changes hands, naming the
+client in control (`holder`), the client being told (`client`), and
+every client connected. A client takes or passes on control with a
+`control` command naming the new holder.
+"""
+from __future__ import print_function, unicode_literals
+import json
+import marshal
+import os
+import struct
+import sys
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None  # python < 3.8
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time  # python 2.x
+
+
+# The original framing: a message followed by an ETX byte.
+ETX_FRAMING = 'etx'
+# A message preceded by its length.
+LENGTH_FRAMING = 'length'
+
+# The framings that can be negotiated, in order of preference.
+FRAMINGS = [LENGTH_FRAMING]
+
+# Stacks after the first are sent as changes to the last one.
+STACK_DELTA = 'stack_delta'
+
+# Variables are sent when the client asks for them, rather than at every stop.
+INSPECT = 'inspect'
+
+# Globals and builtins are sent once, and shared by every frame that uses them.
+NAMESPACES = 'namespaces'
+
+# Commands can carry an id, which is echoed in the events they cause.
+REQUESTS = 'requests'
+
+# The optional features that can be negotiated.
+FEATURES = [STACK_DELTA, INSPECT, NAMESPACES, REQUESTS]
+
+# Offered (as a feature) to clients on the same machine: large messages go
+# through shared memory. A client asks for it with the size of the ring.
+SHARED_MEMORY = 'shared_memory'
+
+ETX = b'\x03'
+HEADER = struct.Struct(str('!I'))
+# The bits of the length in the header that mark a compressed message,
+# and a message that is in shared memory.
+COMPRESSED = 0x80000000
+SHARED = 0x40000000
+LENGTH_MASK = ~(COMPRESSED | SHARED)
+
+# Where a message in shared memory starts, and its length.
+SHARED_LOCATION = struct.Struct(str('!QQ'))
+
+# Messages smaller than this (in bytes) aren't worth compressing.
+COMPRESS_THRESHOLD = 1024
+
+# The smallest read buffer; it grows to fit the largest message received.
+BUFFER_SIZE = 64 * 1024
+
+# Messages smaller than this (in bytes) are sent on the socket, even if
+# there is shared memory.
+SHARED_THRESHOLD = 64 * 1024
+
+
+class JSONCodec(object):
+    "The original encoding, which every client and net understands."
+    name = 'json'
+
+    @staticmethod
+    def encode(message):
+        payload = json.dumps(message)
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf8')
+        return payload
+
+    @staticmethod
+    def decode(payload):
+        return json.loads(payload.decode('utf8'))
+
+
+class MsgpackCodec(object):
+    "A compact binary encoding; requires msgpack 1.0 or later."
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def decode(payload):
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+class MarshalCodec(object):
+    """The interpreter's own (very fast) encoding.
+
+    Version 2 of the format can be read by every Python 3. Python 2 writes
+    its strings as bytes, so it is never offered or chosen there.
+    """
+    name = 'marshal'
+
+    @staticmethod
+    def encode(message):
+        return marshal.dumps(message, 2)
+
+    @staticmethod
+    def decode(payload):
+        return marshal.loads(payload)
+
+
+# The codecs that are available here, in order of preference.
+CODECS = []
+if msgpack is not None:
+    CODECS.append(MsgpackCodec)
+if sys.version_info[0] >= 3:
+    CODECS.append(MarshalCodec)
+CODECS.append(JSONCodec)
+
+CODEC_NAMES = [codec.name for codec in CODECS]
+
+
+def get_codec(name):
+    "The codec with the given name; raises KeyError if it isn't available"
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    raise KeyError(name)
+
+
+class ZlibCompression(object):
+    "Compression that is always available."
+    name = 'zlib'
+
+    def __init__(self, level=None):
+        self.level = 6 if level is None else level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCompression(object):
+    "Faster than zlib, for a similar ratio; requires zstandard."
+    name = 'zstd'
+
+    def __init__(self, level=None):
+        self.compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+# The compressions that are available here, in order of preference.
+COMPRESSIONS = []
+if zstandard is not None:
+    COMPRESSIONS.append(ZstdCompression)
+COMPRESSIONS.append(ZlibCompression)
+
+COMPRESSION_NAMES = [compression.name for compression in COMPRESSIONS]
+
+
+def get_compression(name):
+    "The compression with the given name; raises KeyError if it isn't available"
+    for compression in COMPRESSIONS:
+        if compression.name == name:
+            return compression
+    raise KeyError(name)
+
+
+class SharedRing(object):
+    """A ring buffer in shared memory, that carries messages one way.
+
+    The writer (which creates the ring) copies each message into the ring
+    and tells the reader where it is; the reader copies it out, and
+    records how far it has read in the first 8 bytes of the ring, so the
+    writer knows what it can overwrite. Positions only ever increase, and
+    are taken modulo the size of the ring. A message is never split
+    across the end of the ring; if it won't fit before the end, it starts
+    at the beginning (as does any message written once the reader has
+    caught up). If there isn't room for a message (the reader is
+    behind, or the message is bigger than the ring), write() returns None
+    and the message should be sent on the socket instead.
+    """
+    HEADER = struct.Struct(str('!Q'))
+
+    def __init__(self, memory, owner=False):
+        self.memory = memory
+        self.name = memory.name
+        self.size = memory.size - self.HEADER.size
+        self.buffer = memory.buf[self.HEADER.size:self.HEADER.size + self.size]
+        # Only the process that created the ring removes it.
+        self.owner = os.getpid() if owner else None
+        self.written = 0
+
+    @classmethod
+    def create(cls, size):
+        return cls(shared_memory.SharedMemory(create=True, size=size + cls.HEADER.size), owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        try:
+            memory = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13, every process that attaches to shared
+            # memory removes it when it exits; only the writer should.
+            memory = shared_memory.SharedMemory(name)
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(memory._name, 'shared_memory')
+            except Exception:
+                pass
+        return cls(memory)
+
+    def write(self, payload):
+        "Copy a message into the ring; returns its location, or None if there's no room"
+        size = len(payload)
+        start = self.written
+        offset = start % self.size
+        read = self.HEADER.unpack_from(self.memory.buf, 0)[0]
+        if offset + size > self.size or (offset and read == start):
+            # Start at the beginning of the ring: the message won't fit
+            # before the end, or the reader has read everything, and the
+            # pages at the beginning are already mapped.
+            start = start + self.size - offset
+            offset = 0
+        if start + size - read > self.size:
+            return None
+        self.buffer[offset:offset + size] = payload
+        self.written = start + size
+        return SHARED_LOCATION.pack(start, size)
+
+    def read(self, location):
+        "Copy a message out of the ring, given the location write() returned"
+        start, size = SHARED_LOCATION.unpack(location)
+        offset = start % self.size
+        payload = self.buffer[offset:offset + size].tobytes()
+        self.HEADER.pack_into(self.memory.buf, 0, start + size)
+        return payload
+
+    def close(self):
+        "Detach from the ring (and remove it, if it was created here)"
+        self.buffer.release()
+        self.buffer = None
+        self.memory.close()
+        if self.owner == os.getpid():
+            try:
+                self.memory.unlink()
+            except OSError:
+                pass
+
+
+def choose(offered, supported):
+    "Pick the first of our supported options that the other end offered."
+    for option in supported:
+        if option in offered:
+            return option
+    return None
+
+
+def diff_namespace(old, new):
+    "The [changed, removed] names that turn a namespace `old` into `new` (or None)"
+    changed = dict(
+        (name, item) for name, item in new.items()
+        if name not in old or old[name] != item
+    )
+    removed = [name for name in old if name not in new]
+    if changed or removed:
+        return [changed, removed]
+    return None
+
+
+def patch_namespace(namespace, changes):
+    "Apply changes from diff_namespace(), returning a new namespace"
+    changed, removed = changes
+    namespace = dict(namespace)
+    namespace.update(changed)
+    for name in removed:
+        namespace.pop(name, None)
+    return namespace
+
+
+def diff_frame(old, new):
+    """The changes that turn the description of a frame `old` into `new`.
+
+    A namespace (a dictionary of reprs) that has changed is described by
+    a [changed, removed] pair: the names whose reprs are new or different,
+    and the names that have gone. Any other value that has changed is
+    sent as is (including a namespace that has been replaced by None, or
+    vice versa).
+    """
+    changes = {}
+    for key, value in new.items():
+        previous = old.get(key)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            namespace_changes = diff_namespace(previous, value)
+            if namespace_changes:
+                changes[key] = namespace_changes
+        elif value != previous:
+            changes[key] = value
+    return changes
+
+
+def patch_frame(frame, changes):
+    """Apply changes from diff_frame() to the description of a frame.
+
+    Returns a new description; `frame` (which the view may still be
+    showing) isn't modified.
+    """
+    frame = dict(frame)
+    for key, change in changes.items():
+        if isinstance(frame.get(key), dict) and isinstance(change, (list, tuple)):
+            frame[key] = patch_namespace(frame[key], change)
+        else:
+            frame[key] = change
+    return frame
+
+
+class Channel(object):
+    """The messages sent and received on one connection.
+
+    The framing, codec and compression are tracked separately for each
+    direction, as each end switches its outgoing protocol at a different
+    point in the stream. The number of messages in each direction, their
+    size (before compression, and on the wire), and the time spent encoding
+    and decoding them, are counted for the session.
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self.framing_in = ETX_FRAMING
+        self.framing_out = ETX_FRAMING
+        self.codec_in = JSONCodec
+        self.codec_out = JSONCodec
+        # Compression objects, if compressing.
+        self.compression_in = None
+        self.compression_out = None
+        self.threshold = COMPRESS_THRESHOLD
+        # SharedRings, if large messages go through shared memory.
+        self.shared_in = None
+        self.shared_out = None
+        self.shared_threshold = SHARED_THRESHOLD
+        # The optional features both ends have agreed to use.
+        self.features = set()
+
+        self.sent = 0
+        self.sent_bytes = 0
+        self.sent_wire_bytes = 0
+        self.encode_time = 0.0
+        self.received = 0
+        self.received_bytes = 0
+        self.received_wire_bytes = 0
+        self.decode_time = 0.0
+
+        # Received data is read into a reusable buffer; the bytes from
+        # _start to _end haven't been handled yet.
+        self._buffer = bytearray(BUFFER_SIZE)
+        self._start = 0
+        self._end = 0
+        # Where to resume looking for an ETX in the unhandled data.
+        self._scan = 0
+
+    def pack(self, event, data):
+        "Encode (and maybe compress) a message, framed for sending"
+        start = timer()
+        payload = self.codec_out.encode((event, data))
+        self.sent += 1
+        self.sent_bytes += len(payload)
+        header = len(payload)
+        if self.compression_out is not None and len(payload) >= self.threshold:
+            compressed = self.compression_out.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                header = len(payload) | COMPRESSED
+        if self.shared_out is not None and len(payload) >= self.shared_threshold:
+            location = self.shared_out.write(payload)
+            if location is not None:
+                payload = location
+                header = (header & COMPRESSED) | len(location) | SHARED
+        self.encode_time += timer() - start
+
+        if self.framing_out == LENGTH_FRAMING:
+            message = HEADER.pack(header) + payload
+        else:
+            message = payload + ETX
+        self.sent_wire_bytes += len(message)
+        return message
+
+    def unpack(self, payload):
+        "Decode a received message into an (event, data) pair"
+        start = timer()
+        message = self.codec_in.decode(payload)
+        self.decode_time += timer() - start
+        self.received += 1
+        self.received_bytes += len(payload)
+        return message
+
+    def payloads(self):
+        """Iterate over the payloads of the messages received, until the
+        socket is closed.
+
+        The framing is checked before each message is read, so it can
+        be switched between messages.
+        """
+        while True:
+            if self.framing_in == LENGTH_FRAMING:
+                payload = self._read_length_framed()
+            else:
+                payload = self._read_etx_framed()
+            if payload is None:
+                return
+            yield payload
+
+    def _read_etx_framed(self):
+        while True:
+            index = self._buffer.find(ETX, self._scan, self._end)
+            if index >= 0:
+                payload = self._take(index)
+                # Skip the ETX.
+                self._start = self._scan = index + 1
+                self.received_wire_bytes += len(payload) + 1
+                return payload
+            self._scan = self._end
+            if not self._fill(self._end - self._start + 1):
+                return None
+
+    def _read_length_framed(self):
+        while self._end - self._start < HEADER.size:
+            if not self._fill(HEADER.size):
+                return None
+        header = HEADER.unpack_from(self._buffer, self._start)[0]
+        size = header & LENGTH_MASK
+        while self._end - self._start < HEADER.size + size:
+            if not self._fill(HEADER.size + size):
+                return None
+        self._start = self._start + HEADER.size
+        payload = self._take(self._start + size)
+        self._start = self._scan = self._start + size
+        self.received_wire_bytes += HEADER.size + size
+
+        if header & SHARED:
+            if self.shared_in is None:
+                raise ValueError('Received a message in shared memory, but none was agreed')
+            payload = self.shared_in.read(payload)
+        if header & COMPRESSED:
+            if self.compression_in is None:
+                raise ValueError('Received a compressed message, but no compression was chosen')
+            start = timer()
+            payload = self.compression_in.decompress(payload)
+            self.decode_time += timer() - start
+        return payload
+
+    def close(self):
+        "Release any shared memory"
+        for ring in (self.shared_in, self.shared_out):
+            if ring is not None:
+                ring.close()
+        self.shared_in = self.shared_out = None
+
+    def _take(self, end):
+        "The unhandled data up to `end`, as bytes"
+        return memoryview(self._buffer)[self._start:end].tobytes()
+
+    def _fill(self, needed):
+        """Receive more data, making sure there is room in the buffer for
+        at least `needed` bytes of unhandled data.
+
+        Returns False if the socket has been closed.
+        """
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        if len(self._buffer) - self._start < needed:
+            # Move the unhandled data to the start of the buffer, and
+            # make the buffer bigger if that isn't enough.
+            pending = self._end - self._start
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._scan = self._scan - self._start
+            self._start, self._end = 0, pending
+            if len(self._buffer) < needed:
+                self._buffer.extend(bytearray(max(needed, 2 * len(self._buffer)) - len(self._buffer)))
+        elif self._end == len(self._buffer):
+            # Make room to receive more.
+            self._buffer.extend(bytearray(len(self._buffer)))
+
+        received = self.socket.recv_into(memoryview(self._buffer)[self._end:])
+        if not received:
+            return False
+        self._end = self._end + received
+        return True
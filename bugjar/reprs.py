@@ -0,0 +1,422 @@
+"""Reprs of the values in a program, within a budget.
+
+A plain repr() of a value can be huge (a 2GB array), slow (a lazy
+query that hits a database), or never finish (a __repr__ that waits for
+a lock held by the stopped thread). A ReprEngine limits all three:
+
+* Values of some types are described by a cheap summarizer rather than
+  their repr (see register_summarizer()). Summarizers are registered by
+  the full name of the type, so numpy, pandas and friends needn't be
+  imported to recognize their values.
+
+* Long strings, bytes and containers (including subclasses of the
+  builtin containers, such as OrderedDict and defaultdict, that use a
+  builtin repr) are abbreviated, reprlib style, and every repr is cut to
+  at most `max_chars` characters.
+
+* A __repr__ written in Python is run in a separate thread, which is
+  abandoned if it takes longer than `timeout` seconds; values of that
+  type are summarized from then on. Once the reprs since the last call
+  to reset_budget() have taken `budget` seconds, the remaining values
+  are summarized too.
+"""
+from __future__ import print_function, unicode_literals
+from collections import Counter, OrderedDict, defaultdict, deque
+from itertools import islice
+from threading import Event, Lock, local
+import sys
+import time
+import types
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    from reprlib import Repr
+except ImportError:
+    from repr import Repr  # python 2.x
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time  # python 2.x
+
+try:
+    unicode
+except NameError:
+    unicode = str  # python 3
+
+
+# The most characters in a repr.
+MAX_CHARS = 1000
+# The longest (in seconds) any one repr may take.
+TIMEOUT = 0.5
+# The longest (in seconds) the reprs between resets may take.
+BUDGET = 2.0
+
+# Arrays with more elements than this aren't scanned for their min and max.
+SUMMARY_MAX_ELEMENTS = 1000000
+# The most columns of a DataFrame that are named.
+SUMMARY_MAX_COLUMNS = 10
+
+
+# Types whose (short enough) values are always cheap to repr.
+SCALAR_TYPES = (type(None), bool, int, float, complex, str, unicode, bytes)
+
+# The type of every instance of an old-style class (python 2.x).
+INSTANCE_TYPE = getattr(types, 'InstanceType', None)
+
+# Full type name -> function that describes a value of that type.
+SUMMARIZERS = {}
+
+# The brackets around the items in the repr of a set.
+SET_BRACKETS = ('{', '}') if sys.version_info[0] >= 3 else ('set([', '])')
+
+# Containers whose reprs (which are written in C, or are as slow as the
+# container is long) are abbreviated, even in subclasses.
+CONTAINER_TYPES = (
+    dict, list, tuple, set, frozenset, deque, OrderedDict, defaultdict, Counter, bytearray, bytes
+)
+
+
+def register_summarizer(type_name, summarizer):
+    """Describe values of a type (or its subclasses) with `summarizer`,
+    rather than their repr.
+
+    `type_name` is the module and name of the type, e.g.
+    'numpy.ndarray'. The summarizer is called with the value, and must
+    return a (short) string quickly.
+    """
+    SUMMARIZERS[type_name] = summarizer
+
+
+def type_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def class_of(value):
+    "The class of a value (which, for an old-style instance, isn't its type)"
+    return value.__class__ if type(value) is INSTANCE_TYPE else type(value)
+
+
+def describe(value):
+    "A description of a value that doesn't involve its repr"
+    return '<%s object at %#x>' % (type_name(class_of(value)), id(value))
+
+
+def summarize_ndarray(value):
+    description = 'ndarray(shape=%s, dtype=%s' % (value.shape, value.dtype)
+    if 0 < value.size <= SUMMARY_MAX_ELEMENTS and value.dtype.kind in 'biuf':
+        description += ', min=%s, max=%s' % (value.min(), value.max())
+    return description + ')'
+
+
+def summarize_dataframe(value):
+    columns = [str(column) for column in value.columns[:SUMMARY_MAX_COLUMNS]]
+    if len(value.columns) > SUMMARY_MAX_COLUMNS:
+        columns.append('...')
+    return '%s(shape=%s, columns=[%s])' % (type(value).__name__, value.shape, ', '.join(columns))
+
+
+def summarize_series(value):
+    return 'Series(name=%r, length=%s, dtype=%s)' % (value.name, len(value), value.dtype)
+
+
+def summarize_queryset(value):
+    # Evaluating a queryset would run its query.
+    model = getattr(value, 'model', None)
+    name = model.__name__ if model is not None else '?'
+    if getattr(value, '_result_cache', None) is None:
+        return '<QuerySet of %s (not evaluated)>' % name
+    return '<QuerySet of %s: %s results>' % (name, len(value._result_cache))
+
+
+register_summarizer('numpy.ndarray', summarize_ndarray)
+register_summarizer('pandas.core.frame.DataFrame', summarize_dataframe)
+register_summarizer('pandas.core.series.Series', summarize_series)
+register_summarizer('django.db.models.query.QuerySet', summarize_queryset)
+
+
+class _Reply(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class ReprThread(object):
+    "A thread that runs reprs, so the thread asking can give up waiting."
+    def __init__(self, start_thread):
+        self.requests = Queue()
+        start_thread(self.run)
+
+    def run(self):
+        while True:
+            function, value, reply = self.requests.get()
+            if function is None:
+                return
+            try:
+                reply.result = function(value)
+            except Exception as e:
+                reply.error = e
+            reply.done.set()
+
+    def call(self, function, value, timeout):
+        """Call function(value) in the thread; returns (True, result), or
+        (False, None) if it didn't finish in time.
+        """
+        reply = _Reply()
+        self.requests.put((function, value, reply))
+        if not reply.done.wait(timeout):
+            return False, None
+        if reply.error is not None:
+            raise reply.error
+        return True, reply.result
+
+    def stop(self):
+        self.requests.put((None, None, None))
+
+
+class _Repr(Repr):
+    "reprlib's abbreviations, with other objects' reprs left to the engine"
+    def __init__(self, engine):
+        Repr.__init__(self)
+        self.engine = engine
+        self.maxlevel = 3
+        self.maxlist = self.maxtuple = self.maxset = self.maxfrozenset = self.maxdeque = self.maxarray = 50
+        self.maxdict = 25
+        self.maxstring = self.maxother = self.maxlong = engine.max_chars
+
+    def repr1(self, x, level):
+        summary = self.engine.summary(x)
+        if summary is not None:
+            return summary
+        if sys.version_info[0] < 3 and not hasattr(self, 'repr_' + '_'.join(type(x).__name__.split())):
+            # Python 2's repr module calls repr() itself for types it has
+            # no method for, rather than repr_instance().
+            return self.repr_instance(x, level)
+        return Repr.repr1(self, x, level)
+
+    if sys.version_info[0] < 3:
+        repr_unicode = Repr.repr_str
+
+    # reprlib sorts the items of a dict or set before taking the first
+    # few; they are taken in their own order instead, as repr() does.
+
+    def repr_dict(self, x, level):
+        if not x:
+            return '{}'
+        if level <= 0:
+            return '{...}'
+        # On Python 2, items() would make a list of every item.
+        items = getattr(x, 'iteritems', x.items)
+        pieces = [
+            '%s: %s' % (self.repr1(key, level - 1), self.repr1(value, level - 1))
+            for key, value in islice(items(), self.maxdict)
+        ]
+        if len(x) > self.maxdict:
+            pieces.append('...')
+        return '{%s}' % ', '.join(pieces)
+
+    def repr_set(self, x, level):
+        if not x:
+            return 'set()'
+        return self._repr_iterable(x, level, SET_BRACKETS[0], SET_BRACKETS[1], self.maxset)
+
+    def repr_frozenset(self, x, level):
+        if not x:
+            return 'frozenset()'
+        return self._repr_iterable(x, level, 'frozenset(%s' % SET_BRACKETS[0], '%s)' % SET_BRACKETS[1],
+                                   self.maxfrozenset)
+
+    def repr_instance(self, x, level):
+        container = repr_owner(type(x))
+        if container in CONTAINER_TYPES:
+            return self.repr_container(container, x, level)
+        try:
+            s = self.engine.call_repr(x)
+        except Exception as e:
+            return '<repr failed: %s>' % e
+        if len(s) > self.maxother:
+            i = max(0, (self.maxother - 3) // 2)
+            j = max(0, self.maxother - 3 - i)
+            s = s[:i] + '...' + s[len(s) - j:]
+        return s
+
+
+    def repr_container(self, container, x, level):
+        "An abbreviated repr of a container that uses a builtin container's repr"
+        name = type(x).__name__
+        if container in (bytes, bytearray):
+            return self.repr_bytes(x, level, name if container is bytearray else None)
+        if container in (dict, OrderedDict, Counter, defaultdict):
+            items = self.repr_dict(x, level)
+            if container is dict:
+                return items
+            if container is defaultdict:
+                return '%s(%s, %s)' % (name, self.repr1(x.default_factory, level - 1), items)
+            return '%s(%s)' % (name, items)
+        if container is list:
+            return self.repr_list(x, level)
+        if container is tuple:
+            return self.repr_tuple(x, level)
+        if container is deque:
+            return name + self.repr_deque(x, level)[len('deque'):]
+        if not x:
+            return '%s()' % name
+        return '%s(%s)' % (name, self.repr_set(x, level))
+
+    def repr_bytes(self, x, level, name=None):
+        if len(x) > self.maxstring:
+            i = max(0, (self.maxstring - 3) // 2)
+            j = max(0, self.maxstring - 3 - i)
+            s = repr(bytes(x[:i] + x[len(x) - j:]))
+            s = s[:i] + '...' + s[len(s) - j:]
+        else:
+            s = repr(bytes(x))
+        return s if name is None else '%s(%s)' % (name, s)
+
+
+def repr_owner(cls):
+    "The class that defines the __repr__ of a type"
+    for base in getattr(cls, '__mro__', (cls,)):
+        if '__repr__' in getattr(base, '__dict__', {}):
+            return base
+    return None
+
+
+class ReprEngine(object):
+    """Produces reprs within a budget of characters and time.
+
+    `start_thread` starts a thread that won't be traced (see
+    Debugger.start_thread()); if it isn't given, every repr is run in
+    the thread that asks for it, and can't time out. If `run_python` is
+    False, a __repr__ written in Python is never run at all; the value is
+    described by its type and id instead.
+
+    The number of reprs, the time they took, and the number of values
+    that were summarized because their repr was too slow (or the budget
+    had run out) are counted.
+    """
+    def __init__(self, max_chars=MAX_CHARS, timeout=TIMEOUT, budget=BUDGET, start_thread=None, run_python=True):
+        self.max_chars = max_chars
+        self.timeout = timeout
+        self.budget = budget
+        self.start_thread = start_thread
+        self.run_python = run_python
+        self._repr = _Repr(self)
+        self._thread = None
+        self._lock = Lock()
+        # Only one repr runs in the thread at a time.
+        self._call_lock = Lock()
+        # Per thread: the time left in the budget.
+        self._local = local()
+
+        # Type -> summarizer (or None), by the type's MRO.
+        self._summarizers = {}
+        # Types whose reprs have timed out.
+        self.slow_types = set()
+
+        self.reprs = 0
+        self.repr_time = 0.0
+        self.skipped = 0
+
+    def reset_budget(self):
+        "Start a new budget for reprs in this thread (e.g., at a stop)"
+        self._local.remaining = self.budget
+
+    def repr(self, value):
+        "The (abbreviated) repr of a value, or a summary of it"
+        if type(value) in SCALAR_TYPES and not (
+                isinstance(value, (str, unicode, bytes)) and len(value) > self.max_chars):
+            # Most values are small scalars; don't time them.
+            self.reprs += 1
+            try:
+                s = repr(value)
+            except ValueError as e:
+                # Python 3.11+ won't convert a (very) big int to a string.
+                return '<repr failed: %s>' % e
+            if len(s) > self.max_chars:
+                s = s[:self.max_chars - 3] + '...'
+            return s
+
+        start = timer()
+        try:
+            s = self._repr.repr(value)
+        except Exception as e:
+            s = '<repr failed: %s>' % e
+        if len(s) > self.max_chars:
+            s = s[:self.max_chars - 3] + '...'
+        elapsed = timer() - start
+        self.reprs += 1
+        self.repr_time += elapsed
+        self._local.remaining = getattr(self._local, 'remaining', self.budget) - elapsed
+        return s
+
+    def summary(self, value):
+        "A summary of a value from a registered summarizer, if there is one"
+        cls = type(value)
+        try:
+            summarizer = self._summarizers[cls]
+        except KeyError:
+            summarizer = None
+            try:
+                mro = cls.__mro__
+            except AttributeError:
+                mro = (cls,)  # python 2.x old-style classes
+            for base in mro:
+                summarizer = SUMMARIZERS.get(type_name(base))
+                if summarizer is not None:
+                    break
+            self._summarizers[cls] = summarizer
+        if summarizer is None:
+            return None
+        try:
+            return summarizer(value)
+        except Exception:
+            return describe(value)
+
+    def call_repr(self, value):
+        "The repr of a value that isn't a builtin, within the budget"
+        cls = class_of(value)
+        if cls in self.slow_types or getattr(self._local, 'remaining', self.budget) <= 0:
+            self.skipped += 1
+            return describe(value)
+        method = getattr(cls, '__repr__', None)
+        # On Python 2, a method of a class is an unbound method.
+        method = getattr(method, '__func__', method)
+        if not isinstance(method, types.FunctionType):
+            # Reprs written in C (including object's) are left alone.
+            return repr(value)
+        if not self.run_python:
+            self.skipped += 1
+            return describe(value)
+        if self.start_thread is None:
+            return repr(value)
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = ReprThread(self.start_thread)
+            thread = self._thread
+        with self._call_lock:
+            finished, result = thread.call(repr, value, self.timeout)
+        if not finished:
+            # Leave the thread to finish (if it ever does), and don't try
+            # that type again.
+            with self._lock:
+                if self._thread is thread:
+                    self._thread = None
+                    thread.stop()
+            self.slow_types.add(cls)
+            self.skipped += 1
+            return '%s (repr timed out)' % describe(value)
+        return result
+
+    def stop(self):
+        "Stop the repr thread"
+        with self._lock:
+            if self._thread is not None:
+                self._thread.stop()
+                self._thread = None
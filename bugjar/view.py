@@ -5,20 +5,24 @@ This is the "View" of the MVC world.
 
 from __future__ import unicode_literals
 import os
+from threading import Thread
+import time
 import webbrowser
 try:
-    from Tkinter import Menu, StringVar, N, S, E, W, HORIZONTAL, VERTICAL
+    from Tkinter import BooleanVar, Menu, StringVar, N, S, E, W, HORIZONTAL, VERTICAL
     from ttk import Button, Frame, Label, Notebook, PanedWindow, Scrollbar, Sizegrip
     import tkMessageBox
     import tkFileDialog
 except ImportError:
-    from tkinter import Menu, StringVar, N, S, E, W, HORIZONTAL, VERTICAL
+    from tkinter import BooleanVar, Menu, StringVar, N, S, E, W, HORIZONTAL, VERTICAL
     from tkinter.ttk import Button, Frame, Label, Notebook, PanedWindow, Scrollbar, Sizegrip
     from tkinter import messagebox as tkMessageBox, filedialog as tkFileDialog
 
 
 from bugjar import VERSION, NUM_VERSION
-from bugjar.widgets import DebuggerCode, BreakpointView, StackView, InspectorView
+from bugjar.widgets import (
+    DebuggerCode, BreakpointView, StackView, TaskView, InspectorView, WatchView, LogView, FlameGraph
+)
 
 
 def filename_normalizer(base_path):
@@ -36,6 +40,31 @@ def filename_normalizer(base_path):
     return _normalizer
 
 
+class ProcessView(object):
+    """The view for a single debugged process.
+
+    Events from the process that is currently displayed are passed
+    on to the main window; for any other process, the window is only
+    told that the process has stopped.
+    """
+    # Events that are shown regardless of the process that is displayed.
+    PROCESS_EVENTS = ('on_process', 'on_process_exit', 'on_log', 'on_info', 'on_warning', 'on_error')
+
+    def __init__(self, window, debugger):
+        self.window = window
+        self.debugger = debugger
+
+    def __getattr__(self, name):
+        handler = getattr(self.window, name)
+
+        def _handler(*args, **kwargs):
+            if self.debugger is self.window.debugger or name in self.PROCESS_EVENTS:
+                handler(*args, **kwargs)
+            elif name == 'on_stack':
+                self.window.on_process_stopped(self.debugger)
+        return _handler
+
+
 class MainWindow(object):
     def __init__(self, root, debugger):
         '''
@@ -50,6 +79,8 @@ class MainWindow(object):
         |            |                        |             |
         |            |                        |             |
         -----------------------------------------------------
+        |     log messages (or profile)                     |
+        -----------------------------------------------------
         |     status bar area                               |
         -----------------------------------------------------
 
@@ -64,7 +95,12 @@ class MainWindow(object):
 
         self.debugger = debugger
         # Associate the debugger with this view.
-        self.debugger.view = self
+        self.debugger.view = ProcessView(self, debugger)
+
+        # If child processes are followed, every process that can be
+        # debugged, and those that have stopped while not displayed.
+        self.processes = [debugger]
+        self.stopped_processes = set()
 
         # Root window
         self.root = root
@@ -94,6 +130,10 @@ class MainWindow(object):
 
         debugger.start()
 
+        # Start polling for log messages and profile updates
+        self.root.after(self.LOG_REFRESH, self.refresh_log)
+        self.root.after(self.PROFILE_REFRESH, self.refresh_profile)
+
     ######################################################
     # Internal GUI layout methods.
     ######################################################
@@ -119,6 +159,7 @@ class MainWindow(object):
         # self.menu_file.add_command(label='New', command=self.cmd_dummy, accelerator="Command-N")
         self.menu_file.add_command(label='Open...', command=self.cmd_open_file, accelerator="Command-O")
         self.root.bind('<Command-o>', self.cmd_open_file)
+        self.menu_file.add_command(label='Export profile...', command=self.cmd_export_profile)
         # self.menu_file.add_command(label='Close', command=self.cmd_dummy)
 
         self.menu_program.add_command(label='Run', command=self.cmd_run, accelerator="R")
@@ -129,6 +170,23 @@ class MainWindow(object):
         self.root.bind('<n>', self.cmd_next)
         self.menu_program.add_command(label='Return', command=self.cmd_return, accelerator="BackSpace")
         self.root.bind('<BackSpace>', self.cmd_return)
+        self.menu_program.add_command(label='Step back', command=self.cmd_step_back, accelerator="B")
+        self.root.bind('<b>', self.cmd_step_back)
+        self.menu_program.add_command(label='Reverse run', command=self.cmd_reverse_run, accelerator="Shift-R")
+        self.root.bind('<R>', self.cmd_reverse_run)
+        self.menu_program.add_separator()
+        self.menu_program.add_command(label='Add watch...', command=self.cmd_add_watch)
+        self.menu_program.add_command(label='Add watchpoint...', command=self.cmd_add_watchpoint)
+        self.menu_program.add_separator()
+        self.menu_program.add_command(label='Take control', command=self.cmd_take_control)
+        self.menu_program.add_command(label='Give up control', command=self.cmd_give_up_control)
+        self.menu_program.add_separator()
+        self.freeze_threads = BooleanVar()
+        self.menu_program.add_checkbutton(
+            label='Freeze other threads',
+            variable=self.freeze_threads,
+            command=self.cmd_freeze_threads
+        )
 
         self.menu_help.add_command(label='Open Documentation', command=self.cmd_bugjar_docs)
         self.menu_help.add_command(label='Open Bugjar project page', command=self.cmd_bugjar_page)
@@ -161,6 +219,12 @@ class MainWindow(object):
         self.return_button = Button(self.toolbar, text='Return', command=self.cmd_return)
         self.return_button.grid(column=3, row=0)
 
+        self.step_back_button = Button(self.toolbar, text='Step back', command=self.cmd_step_back)
+        self.step_back_button.grid(column=4, row=0)
+
+        self.reverse_run_button = Button(self.toolbar, text='Reverse run', command=self.cmd_reverse_run)
+        self.reverse_run_button.grid(column=5, row=0)
+
         self.toolbar.columnconfigure(0, weight=0)
         self.toolbar.rowconfigure(0, weight=0)
 
@@ -169,9 +233,13 @@ class MainWindow(object):
         Sets up the main content area. It is a persistent GUI component
         '''
 
+        # The main content sits above the log messages.
+        self.main_pane = PanedWindow(self.root, orient=VERTICAL)
+        self.main_pane.grid(column=0, row=1, sticky=(N, S, E, W))
+
         # Main content area
-        self.content = PanedWindow(self.root, orient=HORIZONTAL)
-        self.content.grid(column=0, row=1, sticky=(N, S, E, W))
+        self.content = PanedWindow(self.main_pane, orient=HORIZONTAL)
+        self.main_pane.add(self.content)
 
         # Create subregions of the content
         self._setup_file_lists()
@@ -186,12 +254,18 @@ class MainWindow(object):
         self.content.pane(1, weight=2)
         self.content.pane(2, weight=1)
 
+        self._setup_output()
+
+        self.main_pane.pane(0, weight=4)
+        self.main_pane.pane(1, weight=1)
+
     def _setup_file_lists(self):
 
         self.file_notebook = Notebook(self.content, padding=(0, 5, 0, 5))
         self.content.add(self.file_notebook)
 
         self._setup_stack_frame_list()
+        self._setup_task_list()
         self._setup_breakpoint_list()
 
     def _setup_stack_frame_list(self):
@@ -219,6 +293,31 @@ class MainWindow(object):
         # Handlers for GUI events
         self.stack.bind('<<TreeviewSelect>>', self.on_stack_frame_selected)
 
+    def _setup_task_list(self):
+        self.tasks_frame = Frame(self.content)
+        self.tasks_frame.grid(column=0, row=0, sticky=(N, S, E, W))
+        self.file_notebook.add(self.tasks_frame, text='Tasks')
+
+        self.tasks = TaskView(self.tasks_frame, normalizer=self.filename_normalizer)
+        self.tasks.grid(column=0, row=0, sticky=(N, S, E, W))
+
+        # The tree's vertical scrollbar
+        self.tasks_scrollbar = Scrollbar(self.tasks_frame, orient=VERTICAL)
+        self.tasks_scrollbar.grid(column=1, row=0, sticky=(N, S))
+
+        # Tie the scrollbar to the text views, and the text views
+        # to each other.
+        self.tasks.config(yscrollcommand=self.tasks_scrollbar.set)
+        self.tasks_scrollbar.config(command=self.tasks.yview)
+
+        # Setup weights for the "tasks" tree
+        self.tasks_frame.columnconfigure(0, weight=1)
+        self.tasks_frame.columnconfigure(1, weight=0)
+        self.tasks_frame.rowconfigure(0, weight=1)
+
+        # Handlers for GUI events
+        self.tasks.bind('<<TreeviewSelect>>', self.on_task_frame_selected)
+
     def _setup_breakpoint_list(self):
         self.breakpoints_frame = Frame(self.content)
         self.breakpoints_frame.grid(column=0, row=0, sticky=(N, S, E, W))
@@ -244,6 +343,14 @@ class MainWindow(object):
         # Handlers for GUI events
         self.breakpoints.tag_bind('breakpoint', '<Double-Button-1>', self.on_breakpoint_double_clicked)
         self.breakpoints.tag_bind('breakpoint', '<<TreeviewSelect>>', self.on_breakpoint_selected)
+        self.breakpoints.tag_bind('breakpoint', '<Button-2>', self.on_breakpoint_menu_clicked)
+        self.breakpoints.tag_bind('breakpoint', '<Button-3>', self.on_breakpoint_menu_clicked)
+
+        # Context menu for a single breakpoint
+        self.breakpoint_menu = Menu(self.breakpoints)
+        self.breakpoint_menu.add_command(label='Condition...', command=self.cmd_edit_condition)
+        self.breakpoint_menu.add_command(label='Log message...', command=self.cmd_edit_log)
+        self.menu_breakpoint = None
         self.breakpoints.tag_bind('file', '<<TreeviewSelect>>', self.on_breakpoint_file_selected)
 
     def _setup_code_area(self):
@@ -267,10 +374,13 @@ class MainWindow(object):
         self.content.add(self.code_frame)
 
     def _setup_inspector(self):
-        self.inspector_frame = Frame(self.content)
+        # The inspector sits above the watch expressions.
+        self.inspector_pane = PanedWindow(self.content, orient=VERTICAL)
+
+        self.inspector_frame = Frame(self.inspector_pane)
         self.inspector_frame.grid(column=2, row=0, sticky=(N, S, E, W))
 
-        self.inspector = InspectorView(self.inspector_frame)
+        self.inspector = InspectorView(self.inspector_frame, debugger=self.debugger)
         self.inspector.grid(column=0, row=0, sticky=(N, S, E, W))
 
         # The tree's vertical scrollbar
@@ -287,7 +397,80 @@ class MainWindow(object):
         self.inspector_frame.columnconfigure(1, weight=0)
         self.inspector_frame.rowconfigure(0, weight=1)
 
-        self.content.add(self.inspector_frame)
+        self.inspector_pane.add(self.inspector_frame)
+        self._setup_watches()
+
+        self.inspector_pane.pane(0, weight=3)
+        self.inspector_pane.pane(1, weight=1)
+
+        self.content.add(self.inspector_pane)
+
+    def _setup_watches(self):
+        self.watch_frame = Frame(self.inspector_pane)
+        self.watch_frame.grid(column=0, row=0, sticky=(N, S, E, W))
+
+        self.watches = WatchView(self.watch_frame)
+        self.watches.grid(column=0, row=0, sticky=(N, S, E, W))
+        self.watches.bind('<Double-1>', self.cmd_add_watch)
+        self.watches.bind('<Delete>', self.cmd_remove_watch)
+
+        self.watch_scrollbar = Scrollbar(self.watch_frame, orient=VERTICAL)
+        self.watch_scrollbar.grid(column=1, row=0, sticky=(N, S))
+
+        self.watches.config(yscrollcommand=self.watch_scrollbar.set)
+        self.watch_scrollbar.config(command=self.watches.yview)
+
+        self.watch_frame.columnconfigure(0, weight=1)
+        self.watch_frame.columnconfigure(1, weight=0)
+        self.watch_frame.rowconfigure(0, weight=1)
+
+        self.inspector_pane.add(self.watch_frame)
+
+    def _setup_output(self):
+        # Log messages and the profile share the bottom of the window.
+        self.output_notebook = Notebook(self.main_pane, padding=(0, 5, 0, 5))
+        self.main_pane.add(self.output_notebook)
+
+        self._setup_log()
+        self._setup_profile()
+
+    def _setup_log(self):
+        self.log_frame = Frame(self.output_notebook)
+
+        self.log = LogView(self.log_frame)
+        self.log.grid(column=0, row=0, sticky=(N, S, E, W))
+
+        # The log's vertical scrollbar
+        self.log_scrollbar = Scrollbar(self.log_frame, orient=VERTICAL)
+        self.log_scrollbar.grid(column=1, row=0, sticky=(N, S))
+
+        self.log.config(yscrollcommand=self.log_scrollbar.set)
+        self.log_scrollbar.config(command=self.log.yview)
+
+        self.log_frame.columnconfigure(0, weight=1)
+        self.log_frame.columnconfigure(1, weight=0)
+        self.log_frame.rowconfigure(0, weight=1)
+
+        self.output_notebook.add(self.log_frame, text='Log')
+
+    def _setup_profile(self):
+        self.profile_frame = Frame(self.output_notebook)
+
+        self.flame = FlameGraph(self.profile_frame, frame_selected=self.on_profile_frame_selected)
+        self.flame.grid(column=0, row=0, sticky=(N, S, E, W))
+
+        # The flame graph's vertical scrollbar
+        self.profile_scrollbar = Scrollbar(self.profile_frame, orient=VERTICAL)
+        self.profile_scrollbar.grid(column=1, row=0, sticky=(N, S))
+
+        self.flame.config(yscrollcommand=self.profile_scrollbar.set)
+        self.profile_scrollbar.config(command=self.flame.yview)
+
+        self.profile_frame.columnconfigure(0, weight=1)
+        self.profile_frame.columnconfigure(1, weight=0)
+        self.profile_frame.rowconfigure(0, weight=1)
+
+        self.output_notebook.add(self.profile_frame, text='Profile')
 
     def _setup_status_bar(self):
         # Status bar
@@ -300,13 +483,19 @@ class MainWindow(object):
         self.run_status_label.grid(column=0, row=0, sticky=(W, E))
         self.run_status.set('Not running')
 
+        # What the last stop cost to send
+        self.protocol_status = StringVar()
+        self.protocol_status_label = Label(self.statusbar, textvariable=self.protocol_status)
+        self.protocol_status_label.grid(column=1, row=0, sticky=(E,))
+
         # Main window resize handle
         self.grip = Sizegrip(self.statusbar)
-        self.grip.grid(column=1, row=0, sticky=(S, E))
+        self.grip.grid(column=2, row=0, sticky=(S, E))
 
         # Set up weights for status bar frame
         self.statusbar.columnconfigure(0, weight=1)
         self.statusbar.columnconfigure(1, weight=0)
+        self.statusbar.columnconfigure(2, weight=0)
         self.statusbar.rowconfigure(0, weight=0)
 
     ######################################################
@@ -335,9 +524,57 @@ class MainWindow(object):
                     self.code.enable_breakpoint(bp.line)
                 else:
                     self.code.disable_breakpoint(bp.line)
+            self.code.show_heatmap(self.debugger.heatmap.get(filename))
 
         self.code.line = line
 
+    def show_processes(self):
+        "Update the list of debugged processes"
+        self.stack.update_processes(
+            [
+                (
+                    debugger.pid,
+                    'Process %s' % debugger.pid,
+                    debugger is self.debugger or debugger.pid in self.stopped_processes
+                )
+                for debugger in self.processes
+            ],
+            current=self.debugger.pid
+        )
+
+    def select_process(self, debugger):
+        "Display the breakpoints, threads and stack of a different process"
+        # Remove the breakpoints of the old process from the display...
+        if self.code.filename:
+            for bp in self.debugger.breakpoints(self.code.filename).values():
+                self.code.clear_breakpoint(bp.line)
+        self.breakpoints.delete(*self.breakpoints.get_children(''))
+
+        self.debugger = debugger
+        self.code.debugger = debugger
+        self.inspector.debugger = debugger
+        self.stopped_processes.discard(debugger.pid)
+        self.show_processes()
+
+        # ... and show those of the new process.
+        for filename in debugger.bp_index:
+            for bp in debugger.breakpoints(filename).values():
+                self.breakpoints.update_breakpoint(bp)
+                if filename == self.code.filename:
+                    if bp.enabled:
+                        self.code.enable_breakpoint(bp.line, temporary=bp.temporary)
+                    else:
+                        self.code.disable_breakpoint(bp.line)
+
+        if getattr(debugger, 'threads', None):
+            self.on_threads(debugger.threads)
+        self.on_tasks(getattr(debugger, 'tasks', []))
+        self.flame.show_profile(debugger.profile)
+        self.watches.show_watches(debugger)
+        if self.code.filename:
+            self.code.show_heatmap(debugger.heatmap.get(self.code.filename))
+        self.on_stack(getattr(debugger, 'stack', []), thread=getattr(debugger, 'thread', None))
+
     ######################################################
     # TK Main loop
     ######################################################
@@ -345,30 +582,95 @@ class MainWindow(object):
     def mainloop(self):
         self.root.mainloop()
 
+    # How often (in ms) queued log messages are displayed.
+    LOG_REFRESH = 100
+
+    def refresh_log(self):
+        "Display any log messages that have arrived since the last refresh"
+        self.log.flush()
+        self.root.after(self.LOG_REFRESH, self.refresh_log)
+
+    # How often (in ms) the flame graph is redrawn, if the profile has changed.
+    PROFILE_REFRESH = 1000
+
+    def refresh_profile(self):
+        "Redraw the flame graph if the profile has changed"
+        if self.flame.dirty:
+            self.flame.redraw()
+        self.root.after(self.PROFILE_REFRESH, self.refresh_profile)
+
     ######################################################
     # TK Command handlers
     ######################################################
 
     def cmd_quit(self):
         "Quit the debugger"
-        self.debugger.stop()
+        for debugger in self.processes[1:]:
+            # Children that never connected have no session to stop.
+            if hasattr(debugger, 'bp_index'):
+                debugger.stop()
+        self.processes[0].stop()
         self.root.quit()
 
     def cmd_run(self, event=None):
         "Run until the next breakpoint, or end of execution"
-        self.debugger.do_run()
+        self.debugger.do_run(thread=getattr(self.debugger, 'thread', None))
 
     def cmd_step(self, event=None):
         "Step into the next line of code"
-        self.debugger.do_step()
+        self.debugger.do_step(thread=getattr(self.debugger, 'thread', None))
 
     def cmd_next(self, event=None):
         "Run the next line of code in the current frame"
-        self.debugger.do_next()
+        self.debugger.do_next(thread=getattr(self.debugger, 'thread', None))
 
     def cmd_return(self, event=None):
         "Return to the previous frame"
-        self.debugger.do_return()
+        self.debugger.do_return(thread=getattr(self.debugger, 'thread', None))
+
+    def cmd_step_back(self, event=None):
+        "Go back to the previous line that was recorded"
+        self.debugger.do_step_back(thread=getattr(self.debugger, 'thread', None))
+
+    def cmd_reverse_run(self, event=None):
+        "Go back to the last breakpoint that was recorded"
+        self.debugger.do_reverse_continue(thread=getattr(self.debugger, 'thread', None))
+
+    def cmd_add_watch(self, event=None):
+        "Watch the value of an expression"
+        expression = self.watches.ask_expression()
+        if expression and expression.strip():
+            self.debugger.create_watch(expression.strip())
+
+    def cmd_add_watchpoint(self, event=None):
+        "Stop when a variable or attribute changes"
+        expression = self.watches.ask_watchpoint()
+        if expression and expression.strip():
+            self.debugger.create_watchpoint(expression.strip())
+
+    def cmd_remove_watch(self, event=None):
+        "Stop watching the selected expression (or variable)"
+        watch = self.watches.selected_watch(self.debugger)
+        if watch is None:
+            pass
+        elif watch.KIND == 'watchpoint':
+            self.debugger.clear_watchpoint(watch)
+        else:
+            self.debugger.clear_watch(watch)
+        return 'break'
+
+    def cmd_freeze_threads(self, event=None):
+        "Toggle whether other threads run while a thread is stopped"
+        self.debugger.freeze_threads(self.freeze_threads.get())
+
+    def cmd_take_control(self, event=None):
+        "Take control of the session, if nobody has it"
+        self.debugger.take_control()
+
+    def cmd_give_up_control(self, event=None):
+        "Let another client take control of the session"
+        if self.debugger.in_control:
+            self.debugger.give_control()
 
     def cmd_open_file(self, event=None):
         "Open a file in the breakpoint pane"
@@ -381,6 +683,7 @@ class MainWindow(object):
 
             # Show the file contents
             self.code.filename = filename
+            self.code.show_heatmap(self.debugger.heatmap.get(filename))
 
             # Ensure the file appears on the breakpoint list
             self.breakpoints.insert_filename(filename)
@@ -394,6 +697,23 @@ class MainWindow(object):
             # .. and clear any currently selected item on the stack tree
             self.stack.selection_remove(self.stack.selection())
 
+    def cmd_export_profile(self):
+        "Save the profile of the current process"
+        if self.debugger.profile is None:
+            tkMessageBox.showinfo(message='There is no profile to export. Use --profile to collect one.')
+            return
+
+        filename = tkFileDialog.asksaveasfilename(
+            initialdir=os.path.abspath(os.getcwd()),
+            defaultextension='.json',
+            filetypes=[
+                ('Speedscope profile', '*.json'),
+                ('Collapsed stacks', '*.txt'),
+            ]
+        )
+        if filename:
+            self.debugger.profile.save(filename)
+
     def cmd_bugjar_page(self):
         "Show the Bugjar project page"
         webbrowser.open_new('http://pybee.org/bugjar')
@@ -422,14 +742,42 @@ class MainWindow(object):
     def on_stack_frame_selected(self, event):
         "When a stack frame is selected, highlight the file and line"
         if event.widget.selection():
-            _, index = event.widget.selection()[0].split(':')
+            kind, index = event.widget.selection()[0].split(':')
+            if kind == 'process':
+                # Show a different process, once it has connected.
+                for debugger in self.processes:
+                    if debugger.pid == int(index) and debugger is not self.debugger:
+                        if hasattr(debugger, 'bp_index'):
+                            self.select_process(debugger)
+                return
+            if kind == 'thread':
+                # Show the stack of a different thread
+                if int(index) != getattr(self.debugger, 'thread', None):
+                    for thread in self.debugger.threads:
+                        if thread['ident'] == int(index) and thread['stopped']:
+                            self.debugger.select_thread(int(index))
+                return
             line, frame = self.debugger.stack[int(index)]
 
             # Display the file in the code view
             self.show_file(filename=frame['filename'], line=line)
 
             # Display the contents of the selected frame in the inspector
-            self.inspector.show_frame(frame)
+            self.inspector.show_frame(frame, index=int(index))
+
+            # Clear any currently selected item on the breakpoint tree
+            self.breakpoints.selection_remove(self.breakpoints.selection())
+
+    def on_task_frame_selected(self, event):
+        "When a coroutine of a task is selected, show where it is waiting"
+        if event.widget.selection():
+            parts = event.widget.selection()[0].split(':')
+            if parts[0] != 'taskframe':
+                return
+            for task in self.debugger.tasks:
+                if task['id'] == int(parts[1]):
+                    line, filename, function = task['stack'][int(parts[2])]
+                    self.show_file(filename=filename, line=line)
 
             # Clear any currently selected item on the breakpoint tree
             self.breakpoints.selection_remove(self.breakpoints.selection())
@@ -466,17 +814,39 @@ class MainWindow(object):
             # Clear any currently selected item on the stack tree
             self.stack.selection_remove(self.stack.selection())
 
+    def on_breakpoint_menu_clicked(self, event):
+        "When a breakpoint on the tree is right clicked, show the breakpoint menu"
+        node = event.widget.identify_row(event.y)
+        if node:
+            parts = node.split(':')
+            self.menu_breakpoint = self.debugger.breakpoint((parts[0], int(parts[1])))
+            self.breakpoint_menu.tk_popup(event.x_root, event.y_root)
+
+    def cmd_edit_condition(self):
+        "Edit the condition of the breakpoint that was right clicked"
+        bp = self.menu_breakpoint
+        condition = self.breakpoints.edit_condition(bp)
+        if condition is not None:
+            self.debugger.condition_breakpoint(bp, condition.strip() or None)
+
+    def cmd_edit_log(self):
+        "Edit the log message of the breakpoint that was right clicked"
+        bp = self.menu_breakpoint
+        message = self.breakpoints.edit_log(bp)
+        if message is not None:
+            self.debugger.log_breakpoint(bp, message.strip() or None)
+
     ######################################################
     # Handlers for debugger responses
     ######################################################
 
-    def on_stack(self, stack):
+    def on_stack(self, stack, thread=None):
         "A report of a new stack"
         # Make sure the stack frame list is displayed
         self.file_notebook.select(self.stack_frame)
 
         # Update the stack list
-        self.stack.update_stack(stack)
+        self.stack.update_stack(stack, thread=thread)
 
         if len(stack) > 0:
             # Update the display of the current file
@@ -491,6 +861,58 @@ class MainWindow(object):
             # so clear the current line marker
             self.code.line = None
 
+    def on_watchpoint(self, watchpoint, old, new):
+        "The program has stopped because a watched variable changed"
+        self.watches.update_watch(watchpoint)
+        self.run_status.set('Watchpoint: %s changed from %s to %s' % (watchpoint.expression, old, new))
+
+    def on_watch_create(self, watch):
+        "A watch expression has been added"
+        self.watches.update_watch(watch)
+
+    def on_watch_clear(self, watch):
+        "A watch expression has been removed"
+        self.watches.clear_watch(watch)
+
+    def on_watches(self, watches):
+        "The values of some watch expressions have changed"
+        for watch in watches:
+            self.watches.update_watch(watch)
+
+    def on_threads(self, threads):
+        "A report of the threads in the program"
+        self.stack.update_threads(threads)
+
+    def on_tasks(self, tasks):
+        "A report of the asyncio tasks in the current thread"
+        self.tasks.update_tasks(tasks)
+
+    def on_process(self, debugger, parent=None):
+        "A child process is available for debugging"
+        debugger.view = ProcessView(self, debugger)
+        self.processes.append(debugger)
+        self.show_processes()
+
+        # Connect to the child in the background; it may still be starting.
+        t = Thread(target=debugger.start)
+        t.daemon = True
+        t.start()
+
+    def on_process_exit(self, pid):
+        "A child process has finished"
+        for debugger in self.processes[1:]:
+            if debugger.pid == pid:
+                self.processes.remove(debugger)
+                self.stopped_processes.discard(pid)
+                if debugger is self.debugger:
+                    self.select_process(self.processes[0])
+        self.show_processes()
+
+    def on_process_stopped(self, debugger):
+        "A process that isn't being displayed has stopped"
+        self.stopped_processes.add(debugger.pid)
+        self.show_processes()
+
     def on_line(self, filename, line):
         "A single line of code has been executed"
         self.run_status.set('Line (%s:%s)' % (filename, line))
@@ -508,6 +930,51 @@ class MainWindow(object):
         self.run_status.set('Exception: %s - %s' % (name, value))
         tkMessageBox.showwarning(message='%s: %s' % (name, value))
 
+    def on_inspection(self, node, ref, offset, total, children):
+        "A page of variables, or of the children of a value"
+        self.inspector.show_children(node, ref, offset, total, children)
+
+    def on_history(self, position, length):
+        "The stack being shown is (or is no longer) from the recorded history"
+        if position is None:
+            self.run_status.set('Back at the present')
+        else:
+            self.run_status.set('Replaying history (%s of %s)' % (position + 1, length))
+
+    def on_control(self, holder, client, clients):
+        "The client in control of the session has changed"
+        if len(clients) < 2 and holder == client:
+            return
+        if holder == client:
+            self.run_status.set('In control; %s observing' % (len(clients) - 1))
+        elif holder is None:
+            self.run_status.set('Observing; nobody is in control')
+        else:
+            self.run_status.set('Observing; client %s is in control' % holder)
+
+    def on_protocol_stats(self, codec, compression, messages, bytes, wire_bytes,
+                          encode_time, decode_time, session_bytes, session_wire_bytes,
+                          reprs=None, repr_time=None, reprs_skipped=None):
+        "Show what it cost to send everything since the last stop"
+        if compression:
+            status = (
+                '%s+%s: %s messages, %.1fkB sent as %.1fkB; encoded in %.1fms, decoded in %.1fms; '
+                'session %.1fMB sent as %.1fMB' % (
+                    codec, compression, messages, bytes / 1024.0, wire_bytes / 1024.0,
+                    encode_time * 1000, decode_time * 1000,
+                    session_bytes / 1048576.0, session_wire_bytes / 1048576.0,
+                )
+            )
+        else:
+            status = '%s: %s messages, %.1fkB; encoded in %.1fms, decoded in %.1fms' % (
+                codec, messages, bytes / 1024.0, encode_time * 1000, decode_time * 1000
+            )
+        if reprs is not None:
+            status += '; %s reprs in %.1fms' % (reprs, repr_time * 1000)
+            if reprs_skipped:
+                status += ' (%s too slow)' % reprs_skipped
+        self.protocol_status.set(status)
+
     def on_postmortem(self):
         "An exception has been raised"
         self.run_status.set('Post mortem mode')
@@ -569,3 +1036,47 @@ class MainWindow(object):
 
         # ... then update the display of the breakpoint on the tree
         self.breakpoints.update_breakpoint(bp)
+
+    def on_breakpoint_condition(self, bp):
+        "The condition on a breakpoint has been changed"
+        self.breakpoints.update_breakpoint(bp)
+
+    def on_profile_frame_selected(self, filename, line):
+        "When a function in the flame graph is clicked, show its code"
+        self.show_file(filename=filename, line=line)
+
+    def on_heatmap(self, filenames):
+        "The line counts of some files have changed"
+        if self.code.filename in filenames:
+            self.code.show_heatmap(self.debugger.heatmap[self.code.filename])
+
+    def on_profile(self, profile):
+        "New samples have been added to the profile"
+        self.flame.show_profile(profile)
+
+    def on_breakpoint_log(self, bp):
+        "The log message on a breakpoint has been changed"
+        self.breakpoints.update_breakpoint(bp)
+
+    def on_log(self, entries, dropped=0):
+        """Some logpoints have been hit.
+
+        This is called on the connection's thread, so the messages are
+        only queued; they are displayed by the next refresh.
+        """
+        lines = []
+        if dropped:
+            lines.append('... %s messages dropped ...' % dropped)
+        for timestamp, bp, message in entries:
+            lines.append('%s %s:%s %s' % (
+                time.strftime('%H:%M:%S', time.localtime(timestamp)),
+                self.filename_normalizer(bp.filename),
+                bp.line,
+                message
+            ))
+        self.log.append(lines)
+
+    def on_breakpoint_stats(self, breakpoints):
+        "The debugger has reported new hit counts for some breakpoints"
+        for bp in breakpoints:
+            self.breakpoints.update_breakpoint(bp)
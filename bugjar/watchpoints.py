@@ -0,0 +1,321 @@
+"""Data watchpoints: stop when a variable or an attribute changes.
+
+A watchpoint watches a name in a namespace: a global of a module, a local
+of a frame, or an attribute of an object (for `self.state`, `self` is
+evaluated once, when the watchpoint is set). Rather than comparing the
+value itself, a cheap fingerprint is compared: the identity of the value
+(or the value, for immutable scalars) and the length of a builtin
+container. Rebinding the name, or adding to or removing from a list or
+dict, changes the fingerprint; changing an element in place doesn't.
+
+Fingerprints are only checked in code that can change the name. Python
+code can only store to a global or an attribute named in its co_names,
+and to a local of its own frame (or of an enclosing one, via a cell), so
+everything else is left alone. Changes made by C code, setattr() or
+through a namespace dictionary are seen the next time code that uses the
+name runs a line.
+
+On Python 3.12+, the checks are done by a sys.monitoring tool of their
+own, which only enables line events in code that can change a watched
+name; on older versions, the debugger's trace function does the checks.
+"""
+from __future__ import print_function, unicode_literals
+import ast
+from collections import deque
+import sys
+from threading import Lock
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident  # python 2.x
+
+try:
+    monitoring = sys.monitoring
+except AttributeError:
+    monitoring = None  # python < 3.12
+
+from bugjar.history import STABLE_TYPES
+
+
+# The builtin containers whose length is part of their fingerprint.
+SIZED_TYPES = (list, dict, set, frozenset, bytearray, deque)
+
+# The value of a name that isn't bound.
+MISSING = object()
+
+
+def fingerprint(value):
+    "A cheap summary of a value, that changes when the value (probably) has"
+    if isinstance(value, STABLE_TYPES):
+        return (type(value), value)
+    if isinstance(value, SIZED_TYPES):
+        return (id(value), len(value))
+    return (id(value), None)
+
+
+def unchanged(old, new):
+    "Are two fingerprints the same?"
+    # Compare identity first; a value (e.g., NaN) needn't equal itself.
+    return old[0] == new[0] and (old[1] is new[1] or old[1] == new[1])
+
+
+def dotted_names(expression):
+    """Split an expression like "self.state" into its names.
+
+    Raises ValueError if the expression isn't a name, or a chain of
+    attributes of a name.
+    """
+    try:
+        node = ast.parse(expression.strip(), '<watchpoint>', 'eval').body
+    except SyntaxError as e:
+        raise ValueError(str(e))
+    names = []
+    while isinstance(node, ast.Attribute):
+        names.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        raise ValueError('A watchpoint must be a name, or an attribute of one (e.g., self.state)')
+    names.append(node.id)
+    names.reverse()
+    return names
+
+
+class Watchpoint(object):
+    """A name to watch, in the namespace it belongs to.
+
+    `frame` is the frame the watchpoint is set in; the first name is
+    looked up in it the way Python would (locals, then globals).
+    `describe` gives the repr of a value (it is called in the thread
+    that changes the value, so it should be quick; see bugjar.reprs).
+    """
+    def __init__(self, number, expression, frame, describe):
+        self.number = number
+        self.expression = expression
+        self.describe = describe
+        names = dotted_names(expression)
+        self.name = names[-1]
+
+        # The frame whose locals are watched, if watching a local.
+        self.frame = None
+        # The globals, or the object whose attribute is watched.
+        self.namespace = None
+
+        if len(names) > 1:
+            self.namespace = eval('.'.join(names[:-1]), frame.f_globals, frame.f_locals)
+        elif frame.f_locals is not frame.f_globals and (
+                names[0] in frame.f_code.co_varnames or
+                names[0] in frame.f_code.co_cellvars or
+                names[0] in frame.f_code.co_freevars):
+            self.frame = frame
+        else:
+            self.namespace = frame.f_globals
+
+        value = self.value()
+        self.fingerprint = fingerprint(value)
+        self.repr = self.describe_value(value)
+
+    @property
+    def is_attribute(self):
+        return self.namespace is not None and not isinstance(self.namespace, dict)
+
+    def value(self):
+        "The current value of the watched name (MISSING if it isn't bound)"
+        if self.frame is not None:
+            return self.frame.f_locals.get(self.name, MISSING)
+        if self.is_attribute:
+            return getattr(self.namespace, self.name, MISSING)
+        return self.namespace.get(self.name, MISSING)
+
+    def can_change(self, code):
+        "Could code in this code object change the watched name?"
+        if self.frame is not None:
+            return (
+                code is self.frame.f_code or
+                (self.name in code.co_freevars and self.name in self.frame.f_code.co_cellvars)
+            )
+        return self.name in code.co_names
+
+    def describe_value(self, value):
+        if value is MISSING:
+            return '<not defined>'
+        return self.describe(value)
+
+
+class Watchpoints(object):
+    """The watchpoints of a debugger, and the machinery to check them.
+
+    `on_change` is called with the watchpoint, the frame that noticed the
+    change, and the old and new reprs, in the thread that changed it.
+    Code from any of `ignore_files` (i.e., the debugger) is never checked;
+    when checking with sys.monitoring, neither are threads for which
+    `ignore_thread` returns True.
+    """
+    TOOL_NAME = 'bugjar watchpoints'
+    # sys.monitoring has no reserved tool id for watchpoints.
+    TOOL_ID = 4
+
+    def __init__(self, on_change, ignore_files=(), ignore_thread=None):
+        self.on_change = on_change
+        self.ignore_files = set(ignore_files)
+        # Never check the code that does the checking.
+        self.ignore_files.add(sys._getframe().f_code.co_filename)
+        self.ignore_thread = ignore_thread
+        self._ignored_threads = {}
+
+        # Number -> Watchpoint. Replaced (never changed) when watchpoints
+        # are added or removed, as other threads may be checking it.
+        self.watchpoints = {}
+        # Code object -> the watchpoints it could change
+        self._codes = {}
+        # The code objects that have events enabled.
+        self._local_codes = set()
+        self.lock = Lock()
+        self.monitoring = False
+
+    def __len__(self):
+        return len(self.watchpoints)
+
+    def start(self):
+        """Start checking with sys.monitoring, if it's available.
+
+        Returns False if the checks have to be made by calling observe().
+        """
+        if monitoring is None:
+            return False
+        events = monitoring.events
+        monitoring.use_tool_id(self.TOOL_ID, self.TOOL_NAME)
+        monitoring.register_callback(self.TOOL_ID, events.PY_START, self._on_start)
+        monitoring.register_callback(self.TOOL_ID, events.PY_RESUME, self._on_start)
+        monitoring.register_callback(self.TOOL_ID, events.LINE, self._on_line)
+        monitoring.register_callback(self.TOOL_ID, events.PY_RETURN, self._on_return)
+        monitoring.register_callback(self.TOOL_ID, events.PY_YIELD, self._on_return)
+        monitoring.set_events(self.TOOL_ID, events.PY_START | events.PY_RESUME)
+        self.monitoring = True
+        return True
+
+    def stop(self):
+        if self.monitoring:
+            self.monitoring = False
+            monitoring.set_events(self.TOOL_ID, 0)
+            for code in self._local_codes:
+                monitoring.set_local_events(self.TOOL_ID, code, 0)
+            self._local_codes = set()
+            monitoring.free_tool_id(self.TOOL_ID)
+
+    def forget_threads(self):
+        "Forget which threads are ignored (see LineCounts.forget_threads())"
+        self._ignored_threads = {}
+
+    def add(self, watchpoint):
+        watchpoints = dict(self.watchpoints)
+        watchpoints[watchpoint.number] = watchpoint
+        self._update(watchpoints)
+
+    def remove(self, number):
+        "Remove a watchpoint; returns None if there is no such watchpoint"
+        watchpoints = dict(self.watchpoints)
+        watchpoint = watchpoints.pop(number, None)
+        self._update(watchpoints)
+        return watchpoint
+
+    def _update(self, watchpoints):
+        self.watchpoints = watchpoints
+        self._codes = {}
+        if not self.monitoring:
+            return
+        # Code that has already started won't see another start event;
+        # check the code of every frame that is running now.
+        running = set()
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                running.add(frame.f_code)
+                frame = frame.f_back
+        for code in self._local_codes - running:
+            if not self.watching(code):
+                monitoring.set_local_events(self.TOOL_ID, code, 0)
+                self._local_codes.discard(code)
+        for code in running:
+            self._enable(code)
+        # Let every other code object be looked at again when it starts.
+        monitoring.restart_events()
+
+    def watching(self, code):
+        "The watchpoints that code in this code object could change"
+        try:
+            return self._codes[code]
+        except KeyError:
+            if code.co_filename in self.ignore_files:
+                found = ()
+            else:
+                found = tuple(
+                    watchpoint for number, watchpoint in sorted(self.watchpoints.items())
+                    if watchpoint.can_change(code)
+                )
+            self._codes[code] = found
+            return found
+
+    def _enable(self, code):
+        events = monitoring.events.LINE | monitoring.events.PY_RETURN | monitoring.events.PY_YIELD
+        if self.watching(code):
+            monitoring.set_local_events(self.TOOL_ID, code, events)
+            self._local_codes.add(code)
+        elif code in self._local_codes:
+            monitoring.set_local_events(self.TOOL_ID, code, 0)
+            self._local_codes.discard(code)
+
+    def _ignored(self):
+        ident = get_ident()
+        try:
+            return self._ignored_threads[ident]
+        except KeyError:
+            ignored = bool(self.ignore_thread and self.ignore_thread(ident))
+            self._ignored_threads[ident] = ignored
+            return ignored
+
+    def _on_start(self, code, instruction_offset):
+        self._enable(code)
+        return monitoring.DISABLE
+
+    def _on_line(self, code, line):
+        watchpoints = self.watching(code)
+        if watchpoints and not self._ignored():
+            self.check(watchpoints, sys._getframe(1))
+
+    def _on_return(self, code, instruction_offset, retval):
+        watchpoints = self.watching(code)
+        if watchpoints and not self._ignored():
+            self.check(watchpoints, sys._getframe(1))
+
+    def observe(self, frame, event):
+        """Check the watchpoints after an event seen by a trace function.
+
+        Returns True if a watchpoint was hit (and the thread has stopped).
+        """
+        if event == 'line' or event == 'return':
+            watchpoints = self.watching(frame.f_code)
+            if watchpoints:
+                return self.check(watchpoints, frame)
+        return False
+
+    def check(self, watchpoints, frame):
+        """Check whether any of the watchpoints has changed.
+
+        Returns True if one has (and `on_change` has been called).
+        """
+        hit = False
+        for watchpoint in watchpoints:
+            value = watchpoint.value()
+            new = fingerprint(value)
+            if unchanged(watchpoint.fingerprint, new):
+                continue
+            with self.lock:
+                if unchanged(watchpoint.fingerprint, new):
+                    continue
+                old_repr = watchpoint.repr
+                watchpoint.fingerprint = new
+                watchpoint.repr = watchpoint.describe_value(value)
+            if watchpoint.number in self.watchpoints:
+                hit = True
+                self.on_change(watchpoint, frame, old_repr, watchpoint.repr)
+        return hit
@@ -1,9 +1,16 @@
 from __future__ import print_function, unicode_literals
 
+from collections import deque
+import math
+
 try:
+    from Tkinter import Canvas, Text, END
     from ttk import Treeview
+    import tkSimpleDialog
 except ImportError:
+    from tkinter import Canvas, Text, END
     from tkinter.ttk import Treeview
+    from tkinter import simpledialog as tkSimpleDialog
 
 from tkreadonly import ReadOnlyCode
 
@@ -18,6 +25,9 @@ except NameError:
 
 
 class DebuggerCode(ReadOnlyCode):
+    # Line number backgrounds for the heatmap, from least to most executed.
+    HEAT_COLORS = ('#fff7d6', '#ffe9a8', '#ffd780', '#ffc15c', '#ffa53d', '#ff8426', '#f55f1a', '#e03a12')
+
     def __init__(self, *args, **kwargs):
         self.debugger = kwargs.pop('debugger')
         kwargs['lexer'] = PythonLexer(stripnl=False)
@@ -29,6 +39,11 @@ class DebuggerCode(ReadOnlyCode):
         self.lines.tag_configure('ignored', background='green')
         self.lines.tag_configure('temporary', background='pink')
 
+        # Heatmap shading is shown beneath any breakpoint.
+        for level, color in enumerate(self.HEAT_COLORS):
+            self.lines.tag_configure('heat%s' % level, background=color)
+            self.lines.tag_lower('heat%s' % level)
+
         self.line_bind('<Double-1>', self.on_line_double_click)
         self.name_bind('<Double-1>', self.on_name_double_click)
 
@@ -110,6 +125,29 @@ class DebuggerCode(ReadOnlyCode):
             '%s.0' % (line + 1)
         )
 
+    def show_heatmap(self, heatmap):
+        """Shade the line numbers by how often each line has been executed.
+
+        `heatmap` is a (first line, [count, ...]) pair, or None to remove
+        the shading. Counts are shaded on a log scale, relative to the
+        most executed line in the file.
+        """
+        for level in range(len(self.HEAT_COLORS)):
+            self.lines.tag_remove('heat%s' % level, '1.0', 'end')
+        if not heatmap:
+            return
+
+        first, counts = heatmap
+        scale = math.log(max(counts) + 1)
+        for offset, count in enumerate(counts):
+            if count:
+                level = int(round(math.log(count + 1) / scale * (len(self.HEAT_COLORS) - 1)))
+                self.lines.tag_add(
+                    'heat%s' % level,
+                    '%s.0' % (first + offset),
+                    '%s.0' % (first + offset + 1)
+                )
+
     def on_line_double_click(self, event):
         "When a line number is double clicked, set a breakpoint"
         try:
@@ -143,11 +181,22 @@ class BreakpointView(Treeview):
         self.heading('#0', text='File')
         # self.heading('line', text='Line')
 
+        self['columns'] = ('condition', 'log', 'hits', 'cost')
+        self.column('condition', width=100, anchor='w')
+        self.column('log', width=100, anchor='w')
+        self.column('hits', width=50, anchor='e')
+        self.column('cost', width=60, anchor='e')
+        self.heading('condition', text='Condition')
+        self.heading('log', text='Log message')
+        self.heading('hits', text='Hits')
+        self.heading('cost', text='Cost (ms)')
+
         # Set up styles for line numbers
         self.tag_configure('enabled', foreground='red')
         self.tag_configure('disabled', foreground='gray')
         self.tag_configure('ignored', foreground='green')
         self.tag_configure('temporary', foreground='pink')
+        self.tag_configure('logpoint', foreground='blue')
 
     def insert_filename(self, filename):
         "Ensure that a specific filename exists in the breakpoint tree"
@@ -178,15 +227,25 @@ class BreakpointView(Treeview):
         if bp.enabled:
             if bp.temporary:
                 tag = 'temporary'
+            elif bp.log:
+                tag = 'logpoint'
             else:
                 tag = 'enabled'
         else:
             tag = 'disabled'
 
+        # The cost of a breakpoint is the total time that has been
+        # spent evaluating its condition.
+        if bp.evaluations:
+            cost = '%.1f' % (bp.eval_time * 1000)
+        else:
+            cost = ''
+        values = (bp.condition or '', bp.log or '', bp.hits, cost)
+
         # Update the display for the line number,
         # adding a new tree node if necessary.
         if self.exists(unicode(bp)):
-            self.item(unicode(bp), tags=['breakpoint', tag])
+            self.item(unicode(bp), tags=['breakpoint', tag], values=values)
         else:
             # First, establish the index at which to insert this child.
             # Do this by getting a list of children, sorting the list by name
@@ -200,9 +259,36 @@ class BreakpointView(Treeview):
                 self._nodify(bp.filename), index, unicode(bp),
                 text=unicode(bp.line),
                 open=True,
-                tags=['breakpoint', tag]
+                tags=['breakpoint', tag],
+                values=values
             )
 
+    def edit_condition(self, bp):
+        """Ask the user for a new condition for a breakpoint.
+
+        Returns None if the edit was cancelled; an empty string
+        means the breakpoint should be unconditional.
+        """
+        return tkSimpleDialog.askstring(
+            'Breakpoint condition',
+            'Stop at %s when:' % self.normalizer(unicode(bp)),
+            initialvalue=bp.condition or '',
+            parent=self
+        )
+
+    def edit_log(self, bp):
+        """Ask the user for a message to log when a breakpoint is hit.
+
+        Returns None if the edit was cancelled; an empty string
+        means the breakpoint should stop rather than log.
+        """
+        return tkSimpleDialog.askstring(
+            'Log message',
+            'At %s, log (use {expression} for values):' % self.normalizer(unicode(bp)),
+            initialvalue=bp.log or '',
+            parent=self
+        )
+
     def _nodify(self, node):
         "Escape any problem characters in a node name"
         return node.replace('\\', '/')
@@ -217,6 +303,15 @@ class BreakpointView(Treeview):
 
 
 class StackView(Treeview):
+    """The stack of the current thread.
+
+    If the program has multiple threads, every thread is listed; the
+    frames of the current thread are shown underneath it. Selecting
+    another thread that is stopped will show its frames.
+
+    If child processes are being debugged, every process is listed,
+    and the threads of the current process are shown underneath it.
+    """
     def __init__(self, *args, **kwargs):
         # Only a single stack frame can be selected at a time.
         kwargs['selectmode'] = 'browse'
@@ -228,10 +323,85 @@ class StackView(Treeview):
         self.heading('#0', text='File')
         self.heading('line', text='Line')
 
-    def update_stack(self, stack):
+        self.tag_configure('running', foreground='gray')
+
+        # The node that holds the threads of the current process,
+        # and the node that holds the frames of the current thread
+        self.threads = ''
+        self.frames = ''
+
+    def update_processes(self, processes, current):
+        """Update the list of processes.
+
+        `processes` is a list of (pid, text, stopped) tuples; `current`
+        is the pid of the process whose threads should be shown.
+        """
+        displayed = set(node for node in self.get_children('') if node.startswith('process:'))
+        for index, (pid, text, stopped) in enumerate(processes):
+            node = 'process:%s' % pid
+            tags = ['process'] if stopped else ['process', 'running']
+            if self.exists(node):
+                self.item(node, text=text, tags=tags)
+                self.move(node, '', index)
+                displayed.discard(node)
+            else:
+                self.insert('', index, node, text=text, open=True, tags=tags)
+
+        # Remove any processes that have exited.
+        for node in displayed:
+            if node == self.threads:
+                self.threads = self.frames = ''
+            self.delete(node)
+
+        # The threads and frames of any other process will be replaced
+        # by those of the current process.
+        parent = 'process:%s' % current
+        if parent != self.threads:
+            for node in self.get_children(self.threads):
+                if not node.startswith('process:'):
+                    self.delete(node)
+            self.threads = self.frames = parent
+
+    def update_threads(self, threads):
+        "Update the list of threads"
+        displayed = set(self.get_children(self.threads))
+        for index, thread in enumerate(threads):
+            node = 'thread:%s' % thread['ident']
+            if thread['stopped']:
+                text = '%s (stopped)' % thread['name']
+                tags = ['thread']
+            else:
+                text = '%s (running)' % thread['name']
+                tags = ['thread', 'running']
+
+            if self.exists(node):
+                self.item(node, text=text, tags=tags)
+                self.move(node, self.threads, index)
+                displayed.discard(node)
+            else:
+                self.insert(self.threads, index, node, text=text, open=True, tags=tags)
+
+        # Remove any threads that have finished (and the frames they hold).
+        for node in displayed:
+            if node.startswith('thread:'):
+                if node == self.frames:
+                    self.frames = self.threads
+                self.delete(node)
+
+    def update_stack(self, stack, thread=None):
         "Update the display of the stack"
+        # Show the frames under the thread they belong to.
+        parent = 'thread:%s' % thread
+        if thread is None or not self.exists(parent):
+            parent = self.threads
+        if parent != self.frames:
+            for node in self.get_children(self.frames):
+                if node.startswith('frame:'):
+                    self.delete(node)
+            self.frames = parent
+
         # Retrieve the current stack list
-        displayed = self.get_children()
+        displayed = [node for node in self.get_children(parent) if node.startswith('frame:')]
 
         # Iterate over the entire stack. Update each entry
         # in the stack to match the current frame description.
@@ -246,7 +416,7 @@ class StackView(Treeview):
                 )
             else:
                 self.insert(
-                    '', index, 'frame:%s' % index,
+                    parent, 'end', 'frame:%s' % index,
                     text=self.normalizer(frame['filename']),
                     open=True,
                     values=(line,)
@@ -260,8 +430,136 @@ class StackView(Treeview):
             self.delete(displayed[i])
 
 
+class TaskView(Treeview):
+    """The asyncio tasks of the current thread.
+
+    Each task shows the chain of coroutines it is awaiting, so it's
+    possible to see where every task is waiting.
+    """
+    def __init__(self, *args, **kwargs):
+        # Only a single stack frame can be selected at a time.
+        kwargs['selectmode'] = 'browse'
+        self.normalizer = kwargs.pop('normalizer')
+        Treeview.__init__(self, *args, **kwargs)
+
+        self['columns'] = ('function', 'line')
+        self.column('function', width=100, anchor='w')
+        self.column('line', width=50, anchor='center')
+        self.heading('#0', text='Task')
+        self.heading('function', text='Function')
+        self.heading('line', text='Line')
+
+        self.tag_configure('current', foreground='red')
+
+    def update_tasks(self, tasks):
+        "Update the list of tasks"
+        displayed = set(self.get_children(''))
+        for index, task in enumerate(tasks):
+            node = 'task:%s' % task['id']
+            tags = ['task', 'current'] if task['current'] else ['task']
+            if self.exists(node):
+                self.item(node, text=task['name'], tags=tags)
+                self.move(node, '', index)
+                self.delete(*self.get_children(node))
+                displayed.discard(node)
+            else:
+                # There may be thousands of tasks; only the running
+                # task is expanded.
+                self.insert('', index, node, text=task['name'], open=task['current'], tags=tags)
+
+            # The innermost coroutine is the one that is waiting.
+            for depth, (line, filename, function) in enumerate(task['stack']):
+                self.insert(
+                    node, 'end', 'taskframe:%s:%s' % (task['id'], depth),
+                    text=self.normalizer(filename),
+                    values=(function, line)
+                )
+
+        # Remove any tasks that have finished.
+        for node in displayed:
+            self.delete(node)
+
+
+class WatchView(Treeview):
+    def __init__(self, *args, **kwargs):
+        kwargs['selectmode'] = 'browse'
+        Treeview.__init__(self, *args, **kwargs)
+
+        self['columns'] = ('value',)
+        self.column('#0', width=150, anchor='w')
+        self.column('value', width=200, anchor='w')
+        self.heading('#0', text='Watch')
+        self.heading('value', text='Value')
+
+        # Watchpoints (which stop the program) stand out from watches.
+        self.tag_configure('watchpoint', foreground='red')
+
+    def update_watch(self, watch):
+        "Add a watch (or watchpoint) to the display, or update its value"
+        node = '%s:%s' % (watch.KIND, watch.number)
+        value = '' if watch.value is None else watch.value
+        if self.exists(node):
+            self.item(node, text=watch.expression, values=(value,))
+        else:
+            self.insert('', 'end', node, text=watch.expression, values=(value,), tags=(watch.KIND,))
+
+    def clear_watch(self, watch):
+        "Remove a watch (or watchpoint) from the display"
+        node = '%s:%s' % (watch.KIND, watch.number)
+        if self.exists(node):
+            self.delete(node)
+
+    def show_watches(self, debugger):
+        "Display the watches and watchpoints of a different debugger"
+        self.delete(*self.get_children(''))
+        for number, watch in sorted(debugger.watches.items()):
+            self.update_watch(watch)
+        for number, watchpoint in sorted(debugger.watchpoints.items()):
+            self.update_watch(watchpoint)
+
+    def selected_watch(self, debugger):
+        "The watch (or watchpoint) that is selected, if any"
+        for node in self.selection():
+            kind, number = node.split(':')
+            if kind == 'watchpoint':
+                return debugger.watchpoints.get(int(number))
+            return debugger.watches.get(int(number))
+
+    def ask_expression(self):
+        """Ask the user for an expression to watch.
+
+        Returns None if the user cancelled.
+        """
+        return tkSimpleDialog.askstring(
+            'Watch expression',
+            'Whenever the program stops, show the value of:',
+            parent=self
+        )
+
+    def ask_watchpoint(self):
+        """Ask the user for a variable or attribute to watch for changes.
+
+        Returns None if the user cancelled.
+        """
+        return tkSimpleDialog.askstring(
+            'Watchpoint',
+            'Stop when this variable or attribute (e.g., self.state) changes:',
+            parent=self
+        )
+
+
 class InspectorView(Treeview):
+    """The variables of a stack frame.
+
+    If the debugger sends the values of every variable with the stack,
+    they are all shown at once. Otherwise (for a 'lazy' frame), the
+    values of a scope are asked for when it is opened, a page at a time,
+    and the children of a value when the value is opened.
+    """
+    SCOPES = ('builtins', 'globals', 'locals')
+
     def __init__(self, *args, **kwargs):
+        self.debugger = kwargs.pop('debugger')
         # Only a single stack frame can be selected at a time.
         kwargs['selectmode'] = 'browse'
         Treeview.__init__(self, *args, **kwargs)
@@ -290,11 +588,119 @@ class InspectorView(Treeview):
         self.heading('#0', text='Name')
         self.heading('value', text='Value')
 
-    def show_frame(self, frame):
+        self.tag_configure('more', foreground='gray')
+
+        # Is a lazy frame being shown? If so, its index in the stack,
+        # and how many lazy frames have been shown (so answers about
+        # an earlier frame can be ignored).
+        self.lazy = False
+        self.frame_index = None
+        self.generation = 0
+        # Node -> the reference to the value it shows
+        self.refs = {}
+        # The nodes whose children haven't been asked for yet.
+        self.unloaded = set()
+        # "More" node -> (the node it belongs to, offset of the next page)
+        self.more = {}
+
+        self.bind('<<TreeviewOpen>>', self.on_open)
+        self.bind('<<TreeviewSelect>>', self.on_select)
+
+    def show_frame(self, frame, index=None):
         "Update the display of the stack frame"
-        self.update_node(':builtins:', frame['builtins'])
-        self.update_node(':globals:', frame['globals'])
-        self.update_node(':locals:', frame['locals'])
+        if frame.get('lazy'):
+            self.show_lazy_frame(frame, index)
+            return
+        if self.lazy:
+            self.clear()
+        self.update_node(':builtins:', self.resolve(frame['builtins']))
+        self.update_node(':globals:', self.resolve(frame['globals']))
+        self.update_node(':locals:', self.resolve(frame['locals']))
+
+    def resolve(self, namespace):
+        "A namespace, given either its variables, or the id of a shared namespace"
+        if isinstance(namespace, dict):
+            return namespace
+        return self.debugger.namespaces.get(namespace, {})
+
+    def clear(self):
+        "Remove the variables of the frame being shown"
+        self.lazy = False
+        self.generation = self.generation + 1
+        self.refs = {}
+        self.unloaded = set()
+        self.more = {}
+        for scope in self.SCOPES:
+            self.delete(*self.get_children(':%s:' % scope))
+
+    def show_lazy_frame(self, frame, index):
+        "Show a frame whose values are asked for when they are needed"
+        self.clear()
+        self.lazy = True
+        self.frame_index = index
+        for scope in self.SCOPES:
+            node = ':%s:' % scope
+            if scope == 'locals' and frame['locals']:
+                # Until their values arrive, show the locals by type.
+                for name, summary in sorted(frame['locals'].items()):
+                    self.insert(node, 'end', text=name, values=(summary,))
+            if self.item(node, 'open'):
+                self.load(node)
+            else:
+                self.unloaded.add(node)
+                if not self.get_children(node):
+                    # Something to open.
+                    self.insert(node, 'end', text='...')
+
+    def load(self, node, offset=0):
+        "Ask for a page of the children of a node"
+        key = '%s:%s' % (self.generation, node)
+        ref = self.refs.get(node)
+        if ref is None:
+            self.debugger.inspect(key, frame=self.frame_index, scope=node.strip(':'), offset=offset)
+        else:
+            self.debugger.inspect(key, ref=ref, offset=offset)
+
+    def show_children(self, key, ref, offset, total, children):
+        "Show a page of the children of a node"
+        generation, node = key.split(':', 1)
+        if int(generation) != self.generation or not self.exists(node):
+            # The answer is about a frame that is no longer shown.
+            return
+        self.refs[node] = ref
+        for child in self.get_children(node):
+            if offset == 0 or child in self.more:
+                self.more.pop(child, None)
+                self.delete(child)
+
+        for child in children:
+            item = self.insert(node, 'end', text=child['name'], values=(child['value'],))
+            if child['ref'] is not None:
+                self.refs[item] = child['ref']
+                self.unloaded.add(item)
+                self.insert(item, 'end', text='...')
+
+        loaded = offset + len(children)
+        if loaded < total:
+            more = self.insert(node, 'end', text='(%s more)' % (total - loaded), tags=('more',))
+            self.more[more] = (node, loaded)
+
+    def on_open(self, event):
+        "When a node is opened, ask for its children (if we haven't already)"
+        node = self.focus()
+        if node in self.unloaded:
+            self.unloaded.discard(node)
+            self.load(node)
+
+    def on_select(self, event):
+        "When a \"more\" node is selected, ask for the next page"
+        for node in self.selection():
+            if self.more.get(node) is not None:
+                parent, offset = self.more[node]
+                # Only ask once.
+                self.more[node] = None
+                self.item(node, text='Loading...')
+                self.load(parent, offset)
 
     def update_node(self, parent, frame):
         # Retrieve the current stack list
@@ -356,3 +762,153 @@ class InspectorView(Treeview):
         # them, because they are stale.
         for i in range(display, len(displayed)):
             self.delete(displayed[i])
+
+
+class LogView(Text):
+    """A read-only view of the messages produced by logpoints.
+
+    Messages can arrive faster than Tk can display them, so they are
+    queued by append() (which can be called from any thread), and
+    added to the text in a single batch each time flush() is called.
+    """
+    def __init__(self, *args, **kwargs):
+        self.max_lines = kwargs.pop('max_lines', 10000)
+        kwargs.setdefault('height', 8)
+        kwargs.setdefault('wrap', 'none')
+        kwargs.setdefault('state', 'disabled')
+        Text.__init__(self, *args, **kwargs)
+        self.pending = deque()
+
+    def append(self, lines):
+        "Queue lines of text to be displayed"
+        self.pending.extend(lines)
+
+    def flush(self):
+        "Display all the queued lines"
+        lines = []
+        try:
+            while True:
+                lines.append(self.pending.popleft())
+        except IndexError:
+            pass
+        if not lines:
+            return
+
+        # Only follow the new messages if the view is already showing
+        # the end of the log; otherwise, leave the user where they are.
+        at_end = self.yview()[1] >= 1.0
+
+        self.config(state='normal')
+        self.insert(END, ''.join('%s\n' % line for line in lines))
+        # Discard the oldest messages once the log is too long.
+        excess = int(self.index('end-1c').split('.')[0]) - 1 - self.max_lines
+        if excess > 0:
+            self.delete('1.0', '%s.0' % (excess + 1))
+        self.config(state='disabled')
+
+        if at_end:
+            self.see(END)
+
+
+class FlameGraph(Canvas):
+    """A flame graph of the samples in a profile.
+
+    Each bar is a function; its width is the share of the samples in
+    which it was on the stack, and the bars below it are the functions
+    it called. The top row has a bar for each thread.
+    """
+    ROW_HEIGHT = 18
+    # The approximate width of a character in a bar's label.
+    CHAR_WIDTH = 7
+
+    def __init__(self, *args, **kwargs):
+        self.frame_selected = kwargs.pop('frame_selected', None)
+        kwargs.setdefault('background', 'white')
+        kwargs.setdefault('height', 100)
+        Canvas.__init__(self, *args, **kwargs)
+
+        self.profile = None
+        # True if the profile has changed since it was last drawn.
+        self.dirty = False
+
+        self.bind('<Configure>', self.on_resize)
+        self.tag_bind('frame', '<Button-1>', self.on_frame_click)
+
+    def show_profile(self, profile):
+        """Display a profile.
+
+        The graph isn't redrawn until redraw() is called, so that a
+        profile that updates often can be redrawn at a sensible rate.
+        """
+        self.profile = profile
+        self.dirty = True
+
+    def redraw(self):
+        "Draw the current profile"
+        self.dirty = False
+        self.delete('all')
+        if self.profile is None:
+            return
+
+        root = self.profile.call_tree()
+        if not root[0]:
+            return
+        scale = float(self.winfo_width()) / root[0]
+
+        depth = 0
+        pending = [(0.0, 0, root[1])]
+        while pending:
+            x, row, children = pending.pop()
+            y = row * self.ROW_HEIGHT
+            for key in sorted(children, key=lambda key: self._label(row, key)):
+                count, grandchildren = children[key]
+                width = count * scale
+                if width >= 1:
+                    self._draw_bar(row, key, x, y, width, count)
+                    depth = max(depth, row + 1)
+                    pending.append((x, row + 1, grandchildren))
+                x = x + width
+
+        self.config(scrollregion=(0, 0, self.winfo_width(), depth * self.ROW_HEIGHT))
+
+    def _label(self, row, key):
+        "The label for a bar; the top row is labelled with thread names"
+        if row == 0:
+            return key
+        return self.profile.frames[key][0]
+
+    def _draw_bar(self, row, key, x, y, width, count):
+        label = self._label(row, key)
+        if row == 0:
+            tags = ('thread',)
+            fill = '#c0c0c0'
+        else:
+            tags = ('frame', 'frame:%s' % key)
+            # Colour each function consistently, in warm colours.
+            shade = sum(ord(c) for c in label)
+            fill = '#%02x%02x%02x' % (200 + shade % 56, 80 + (shade * 7) % 140, 40 + (shade * 13) % 50)
+
+        self.create_rectangle(
+            x, y, x + width, y + self.ROW_HEIGHT,
+            fill=fill, outline='white', tags=tags
+        )
+        chars = int(width / self.CHAR_WIDTH)
+        if chars >= 3:
+            text = '%s (%.1f%%)' % (label, 100.0 * count / self.profile.samples)
+            if len(text) > chars:
+                text = text[:chars - 2] + '..'
+            self.create_text(
+                x + 2, y + self.ROW_HEIGHT / 2,
+                text=text, anchor='w', tags=tags
+            )
+
+    def on_resize(self, event):
+        self.redraw()
+
+    def on_frame_click(self, event):
+        "When a bar is clicked, show the code for that function"
+        for tag in self.gettags('current'):
+            if tag.startswith('frame:') and self.frame_selected:
+                name, filename, line = self.profile.frames[int(tag[6:])]
+                if filename:
+                    self.frame_selected(filename, line)
@@ -0,0 +1,99 @@
+from __future__ import unicode_literals
+import bdb
+import os
+import unittest
+
+from bugjar.net import BreakpointIndex
+
+
+def outer():
+    x = 1
+
+    def inner():
+        return x
+
+    return inner
+
+
+FILENAME = os.path.abspath(outer.__code__.co_filename)
+FIRST = outer.__code__.co_firstlineno
+INNER = outer().__code__
+
+
+class BreakpointIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = BreakpointIndex(os.path.abspath)
+
+    def breakpoint(self, line, filename=FILENAME):
+        "Create a breakpoint, and tell the index about it"
+        bp = bdb.Breakpoint(filename, line)
+        self.addCleanup(self.clear, bp)
+        self.index.update(bp)
+        return bp
+
+    def clear(self, bp):
+        if bdb.Breakpoint.bpbynumber[bp.number] is bp:
+            bp.deleteMe()
+            self.index.update(bp)
+
+    def test_empty(self):
+        self.assertEqual(len(self.index), 0)
+        self.assertFalse(self.index.has_breaks(outer.__code__))
+        self.assertFalse(self.index.has_line(FILENAME, FIRST + 1))
+
+    def test_lines(self):
+        self.breakpoint(FIRST + 1)
+        self.assertEqual(len(self.index), 1)
+        self.assertTrue(self.index.has_line(FILENAME, FIRST + 1))
+        self.assertFalse(self.index.has_line(FILENAME, FIRST + 2))
+        self.assertFalse(self.index.has_line('elsewhere.py', FIRST + 1))
+
+    def test_code_ranges(self):
+        # A breakpoint is in the code objects whose lines surround it.
+        self.breakpoint(FIRST + 1)
+        self.assertTrue(self.index.has_breaks(outer.__code__))
+        self.assertFalse(self.index.has_breaks(INNER))
+        bp = self.breakpoint(FIRST + 4)
+        self.assertTrue(self.index.has_breaks(INNER))
+        self.clear(bp)
+        self.assertFalse(self.index.has_breaks(INNER))
+        self.assertFalse(self.index.has_breaks(self.test_code_ranges.__code__))
+
+    def test_enable_disable(self):
+        bp = self.breakpoint(FIRST + 1)
+        bp.disable()
+        self.index.update(bp)
+        self.assertEqual(len(self.index), 0)
+        self.assertFalse(self.index.has_breaks(outer.__code__))
+        bp.enable()
+        self.index.update(bp)
+        self.assertEqual(len(self.index), 1)
+        self.assertTrue(self.index.has_breaks(outer.__code__))
+
+    def test_shared_line(self):
+        # A line stays in the index until every breakpoint on it has gone.
+        first = self.breakpoint(FIRST + 1)
+        self.breakpoint(FIRST + 1)
+        self.assertEqual(len(self.index), 2)
+        self.clear(first)
+        self.assertEqual(len(self.index), 1)
+        self.assertTrue(self.index.has_line(FILENAME, FIRST + 1))
+
+    def test_raw_filename(self):
+        # Code filenames are canonicalized before they're looked up.
+        self.breakpoint(FIRST + 1)
+        relative = os.path.relpath(FILENAME)
+        self.assertTrue(self.index.has_line(relative, FIRST + 1))
+
+    def test_generation(self):
+        generation = self.index.generation
+        bp = self.breakpoint(FIRST + 1)
+        self.assertTrue(self.index.generation > generation)
+        generation = self.index.generation
+        # Recording a breakpoint that hasn't changed isn't a change.
+        self.index.update(bp)
+        self.assertEqual(self.index.generation, generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""Every tracing engine should stop at a breakpoint as often as bdb does.
+
+Each test runs a script under bugjar-net, with each engine, and counts
+the stops at a breakpoint until the script finishes.
+"""
+from __future__ import unicode_literals
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty  # python 2.x
+
+from bugjar.connection import Debugger
+from bugjar.net import ENGINES, monitoring
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The longest (in seconds) to wait for the net to stop.
+TIMEOUT = 30
+
+
+class Stops(object):
+    "A view that queues the line of every stop, and ignores everything else."
+    def __init__(self):
+        self.stops = Queue()
+
+    def on_stack(self, stack, thread=None):
+        self.stops.put(stack[-1][0])
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def engines():
+    "The engines that can run on this version of Python"
+    return sorted(name for name in ENGINES if name != 'monitoring' or monitoring is not None)
+
+
+@unittest.skipUnless(hasattr(os, 'pipe') and sys.version_info >= (3, 3), 'needs Unix domain sockets and pass_fds')
+class EngineParityTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='bugjar-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stops(self, engine, source, line):
+        """Run `source` with an engine and a breakpoint on `line`; returns
+        the number of times it stopped there before the script finished.
+        """
+        script = os.path.realpath(os.path.join(self.directory, 'script.py'))
+        with open(script, 'w') as f:
+            f.write(source)
+        path = os.path.join(self.directory, 'net-%s.sock' % engine)
+        ready_fd, write_fd = os.pipe()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+        proc = subprocess.Popen([
+            sys.executable, '-c', 'from bugjar.main import net; net()',
+            '--socket', path, '--ready-fd', str(write_fd), '--engine', engine, script
+        ], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, pass_fds=(write_fd,))
+        os.close(write_fd)
+
+        debugger = Debugger(None, None, proc=proc, path=path, ready_fd=ready_fd, timeout=TIMEOUT)
+        view = debugger.view = Stops()
+        try:
+            debugger.start()
+            # The script stops at its first line, and again when it
+            # finishes, and is restarted.
+            first = view.stops.get(timeout=TIMEOUT)
+            debugger.create_breakpoint(script, line).wait(TIMEOUT)
+            count = 0
+            while True:
+                debugger.do_run()
+                stop = view.stops.get(timeout=TIMEOUT)
+                if stop != line:
+                    self.assertEqual(stop, first)
+                    return count
+                count += 1
+        except Empty:
+            self.fail('%s engine did not stop' % engine)
+        finally:
+            debugger.output('quit')
+            proc.wait()
+
+    def assertParity(self, source, line, expected):
+        for engine in engines():
+            self.assertEqual(self.stops(engine, source, line), expected, '%s engine' % engine)
+
+    def test_function(self):
+        self.assertParity(
+            'def add(a, b):\n'
+            '    total = a + b\n'
+            '    return total\n'
+            '\n'
+            'for i in range(3):\n'
+            '    add(i, 1)\n',
+            2, 3
+        )
+
+    def test_for_loop(self):
+        # A loop's header runs once more than its body.
+        self.assertParity(
+            'def count(n):\n'
+            '    total = 0\n'
+            '    for i in range(n):\n'
+            '        total += i\n'
+            '    return total\n'
+            '\n'
+            'for j in range(3):\n'
+            '    count(4)\n',
+            3, 15
+        )
+
+    def test_while_loop(self):
+        self.assertParity(
+            'def count(n):\n'
+            '    i = 0\n'
+            '    while i < n:\n'
+            '        i += 1\n'
+            '    return i\n'
+            '\n'
+            'for j in range(3):\n'
+            '    count(2)\n',
+            3, 9
+        )
+
+    def test_with(self):
+        # A with statement's line runs again as the block is left.
+        self.assertParity(
+            'import threading\n'
+            '\n'
+            'def locked(lock):\n'
+            '    with lock:\n'
+            '        pass\n'
+            '\n'
+            'for j in range(3):\n'
+            '    locked(threading.Lock())\n',
+            4, 6 if sys.version_info >= (3, 10) else 3
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
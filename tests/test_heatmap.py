@@ -0,0 +1,98 @@
+from __future__ import unicode_literals
+import sys
+import unittest
+
+from bugjar.heatmap import LineCounts, decode_counts, encode_counts
+
+
+def square(x):
+    y = x * x
+    return y
+
+
+def outer(n):
+    def inner(i):
+        return i + 1
+    total = 0
+    for i in range(n):
+        total = inner(total)
+    return total
+
+
+FILENAME = square.__code__.co_filename
+
+
+def run(counts, function, *args):
+    "Call a function, counting its lines"
+    def trace(frame, event, arg):
+        counts.observe(frame, event)
+        return trace
+    previous = sys.gettrace()
+    sys.settrace(trace)
+    try:
+        return function(*args)
+    finally:
+        sys.settrace(previous)
+
+
+class LineCountsTest(unittest.TestCase):
+    def line_counts(self, counts, function):
+        "The counts of each line of a function, relative to its first line"
+        first, file_counts = counts.files()[FILENAME]
+        start = function.__code__.co_firstlineno
+        return dict(
+            (first + offset - start, count) for offset, count in enumerate(file_counts)
+            if count and start <= first + offset
+        )
+
+    def test_count(self):
+        counts = LineCounts()
+        for i in range(3):
+            run(counts, square, i)
+        self.assertEqual(self.line_counts(counts, square), {1: 3, 2: 3})
+
+    def test_files(self):
+        # The counts of the code objects in a file are combined, from
+        # the file's first counted line to its last.
+        counts = LineCounts()
+        run(counts, square, 2)
+        run(counts, outer, 4)
+        first, file_counts = counts.files()[FILENAME]
+        self.assertEqual(first, square.__code__.co_firstlineno)
+        self.assertEqual(first + len(file_counts) - 1, outer.__code__.co_firstlineno + 6)
+        # inner() is nested in outer(), so their lines interleave.
+        self.assertEqual(self.line_counts(counts, outer), {1: 1, 2: 4, 3: 1, 4: 5, 5: 4, 6: 1})
+
+    def test_count_code(self):
+        counts = LineCounts()
+        code = square.__code__
+        counts.count(code, code.co_firstlineno + 2)
+        counts.count(code, code.co_firstlineno + 2)
+        self.assertEqual(self.line_counts(counts, square), {2: 2})
+        self.assertEqual(list(counts.files()), [FILENAME])
+
+    def test_ignore_files(self):
+        counts = LineCounts(ignore_files=[FILENAME])
+        run(counts, square, 2)
+        self.assertEqual(counts.files(), {})
+
+    def test_changes(self):
+        counts = LineCounts()
+        run(counts, square, 2)
+        changes = counts.changes()
+        first, file_counts = counts.files()[FILENAME]
+        self.assertEqual(changes[FILENAME]['first'], first)
+        self.assertEqual(decode_counts(changes[FILENAME]['counts']), file_counts)
+        # Only files whose counts have changed are sent again.
+        self.assertEqual(counts.changes(), {})
+        self.assertEqual(list(counts.changes(full=True)), [FILENAME])
+        run(counts, square, 3)
+        self.assertEqual(list(counts.changes()), [FILENAME])
+
+    def test_encoding(self):
+        for values in [[], [0, 1, 2], [10 ** 12] * 1000]:
+            self.assertEqual(decode_counts(encode_counts(values)), values)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+from __future__ import unicode_literals
+import sys
+import unittest
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident  # python 2.x
+
+from bugjar.history import History
+
+
+def add(a, b):
+    c = a + b
+    return c
+
+
+def work(n):
+    total = 0
+    for i in range(n):
+        total = add(total, i)
+    del i
+    return total
+
+
+def record(history, function, *args):
+    "Call a function, recording what it does"
+    def trace(frame, event, arg):
+        history.observe(frame, event)
+        return trace
+    previous = sys.gettrace()
+    sys.settrace(trace)
+    try:
+        return function(*args)
+    finally:
+        sys.settrace(previous)
+
+
+class HistoryTest(unittest.TestCase):
+    def replay(self, max_bytes, n=5):
+        history = History(max_bytes)
+        record(history, work, n)
+        return history, history.replay(get_ident(), sys._getframe())
+
+    def test_record(self):
+        history, replay = self.replay(10 ** 7)
+        serials = [event[0] for event in replay.events]
+        work_serial = serials[0]
+        last = max(replay.positions[work_serial])
+        self.assertEqual(replay.local_vars(work_serial, last), {'n': '5', 'total': '10'})
+        # Before the loop had started.
+        first = replay.positions[work_serial][1]
+        self.assertEqual(replay.local_vars(work_serial, first), {'n': '5', 'total': '0'})
+        # Five calls to add(), each a child of work().
+        self.assertEqual(len(set(serials)), 6)
+        self.assertEqual(history.frames[work_serial][6], 5)
+
+    def test_stack(self):
+        history, replay = self.replay(10 ** 7)
+        position = [p for p, event in enumerate(replay.events) if history.frames[event[0]][4] == 'add'][-1]
+        replay.position = position
+        stack = replay.stack()
+        self.assertEqual([frame['current'] for line, frame in stack], [False, True])
+        self.assertEqual(stack[1][1]['locals'], {'a': '6', 'b': '4', 'c': '10'})
+        self.assertEqual(stack[0][0], work.__code__.co_firstlineno + 3)
+
+    def test_discard(self):
+        # A recording that has discarded its oldest events still knows
+        # the locals as they were at every event it has kept.
+        history, full = self.replay(10 ** 7)
+        history, partial = self.replay(history.size // 2)
+        self.assertTrue(0 < len(partial.events) < len(full.events))
+        self.assertTrue(history.size <= history.max_bytes)
+        offset = len(full.events) - len(partial.events)
+        self.assertEqual(partial.events, full.events[offset:])
+        for position, event in enumerate(partial.events):
+            for serial in partial.parents(event[0]):
+                self.assertEqual(
+                    partial.local_vars(serial, position),
+                    full.local_vars(serial, position + offset)
+                )
+
+    def test_forget(self):
+        # Frames with no events left are forgotten, as are their bases.
+        history, replay = self.replay(history_size(5) // 4, n=20)
+        for serial in history.frames:
+            frame = history.frames[serial]
+            self.assertTrue(frame[5] or frame[6])
+        self.assertTrue(set(history.bases) <= set(history.frames))
+
+    def test_discard_everything(self):
+        history, replay = self.replay(0)
+        self.assertEqual(len(replay.events), 0)
+        self.assertEqual(history.frames, {})
+        self.assertEqual(history.bases, {})
+        self.assertEqual(history.size, 0)
+
+    def test_clear(self):
+        history, replay = self.replay(10 ** 7)
+        history.clear()
+        self.assertEqual(history.size, 0)
+        self.assertEqual(len(history.events), 0)
+
+
+def history_size(n):
+    "The size of a full recording of work(n)"
+    history = History(10 ** 7)
+    record(history, work, n)
+    return history.size
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+from __future__ import unicode_literals
+from threading import Thread
+import socket
+import unittest
+
+from bugjar import hub
+from bugjar.hub import Hub
+from bugjar.protocol import Channel
+
+
+def start_thread(target):
+    thread = Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class HubTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = Hub(start_thread)
+        self.addCleanup(self.hub.close, False)
+        self.peers = {}
+
+    def connect(self, started=True):
+        "A new client (which sends nothing until it is started)"
+        near, far = socket.socketpair()
+        self.addCleanup(near.close)
+        self.addCleanup(far.close)
+        client = hub.Client(len(self.peers) + 1, near)
+        self.addCleanup(client.close)
+        if started:
+            client.start(start_thread)
+        self.peers[client] = far
+        return client
+
+    def received(self, client):
+        "Everything sent to a client, once it has been flushed"
+        client.flush()
+        client.socket.shutdown(socket.SHUT_WR)
+        channel = Channel(self.peers[client])
+        return [tuple(channel.unpack(payload)) for payload in channel.payloads()]
+
+    def queued(self, client):
+        return [tuple(entry[:2]) for entry in client._queue if entry[0] is not None]
+
+    def patch_max_queued(self, limit):
+        original = hub.MAX_QUEUED
+        hub.MAX_QUEUED = limit
+        self.addCleanup(setattr, hub, 'MAX_QUEUED', original)
+
+    def test_send(self):
+        client = self.connect()
+        client.send('stack', {'thread': 1, 'n': 1})
+        client.send('output', {'text': 'hello'})
+        self.assertEqual(self.received(client), [('stack', {'thread': 1, 'n': 1}), ('output', {'text': 'hello'})])
+
+    def test_coalesce(self):
+        client = self.connect(started=False)
+        client.send('stack', {'thread': 1, 'n': 1})
+        client.send('output', {'text': 'hello'})
+        client.send('stack', {'thread': 2, 'n': 2})
+        client.send('line', {'thread': 1, 'n': 3})
+        client.send('stack', {'thread': 1, 'n': 4})
+        client.send('call', {'thread': 1, 'n': 5})
+        # The newest of each kind of event for each thread is sent, in
+        # the order in which they were sent.
+        self.assertEqual(self.queued(client), [
+            ('output', {'text': 'hello'}),
+            ('stack', {'thread': 2, 'n': 2}),
+            ('stack', {'thread': 1, 'n': 4}),
+            ('call', {'thread': 1, 'n': 5}),
+        ])
+        self.assertEqual(client.coalesced, 2)
+        client.start(start_thread)
+        self.assertEqual([data['n'] for event, data in self.received(client) if 'n' in data], [2, 4, 5])
+
+    def test_controller_not_coalesced(self):
+        client = self.connect(started=False)
+        client.observer = False
+        for n in range(3):
+            client.send('stack', {'thread': 1, 'n': n})
+        self.assertEqual(len(self.queued(client)), 3)
+        self.assertEqual(client.coalesced, 0)
+
+    def test_compact(self):
+        # Coalesced entries don't pile up in the queue.
+        client = self.connect(started=False)
+        for n in range(1000):
+            client.send('stack', {'thread': 1, 'n': n})
+        self.assertTrue(len(client._queue) < 10)
+        self.assertEqual(self.queued(client), [('stack', {'thread': 1, 'n': 999})])
+
+    def test_max_queued(self):
+        self.patch_max_queued(10)
+        client = self.connect(started=False)
+        for n in range(9):
+            client.send('output', {'n': n})
+        # Events that replace queued ones don't count.
+        for n in range(100):
+            client.send('stack', {'thread': 1, 'n': n})
+        self.assertFalse(client.closed)
+        client.send('output', {'n': 10})
+        # A client that falls too far behind is disconnected.
+        self.assertTrue(client.closed)
+        self.assertEqual(len(client._queue), 0)
+        self.assertEqual(self.peers[client].recv(1), b'')
+        client.send('output', {'n': 11})
+        self.assertEqual(len(client._queue), 0)
+
+    def test_control(self):
+        first = self.connect()
+        second = self.connect()
+        self.hub.add(first)
+        self.hub.add(second)
+        self.assertTrue(self.hub.controls(first))
+        self.assertFalse(first.observer)
+        self.assertTrue(second.observer)
+
+        self.assertIsNotNone(self.hub.hand_over(second, second.number))
+        self.assertIsNotNone(self.hub.hand_over(first, 99))
+        self.assertIsNone(self.hub.hand_over(first, second.number))
+        self.assertTrue(self.hub.controls(second))
+        self.assertTrue(first.observer)
+
+        # Control can be given up, for anyone to take for themselves.
+        self.assertIsNone(self.hub.hand_over(second, None))
+        self.assertIsNotNone(self.hub.hand_over(first, second.number))
+        self.assertIsNone(self.hub.hand_over(first, first.number))
+
+        # When the controller goes, the longest connected client takes over.
+        third = self.connect()
+        self.hub.add(third)
+        self.hub.remove(first)
+        self.assertTrue(self.hub.controls(second))
+        self.assertEqual(self.hub.clients, [second, third])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+from collections import deque
+from itertools import count
+import unittest
+
+from bugjar.inspector import Inspector, summarize
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class InspectorTest(unittest.TestCase):
+    def setUp(self):
+        self.inspector = Inspector(count(1), repr)
+
+    def names(self, value, offset=0, limit=3):
+        total, children = self.inspector.page(self.inspector.ref(value), offset, limit)
+        return total, [child['name'] for child in children]
+
+    def test_summarize(self):
+        self.assertEqual(summarize([1, 2]), 'list (2)')
+        self.assertEqual(summarize(Point(1, 2)), 'Point')
+
+    def test_sequences(self):
+        for value in [list(range(10)), tuple(range(10)), deque(range(10))]:
+            self.assertEqual(self.names(value), (10, ['[0]', '[1]', '[2]']))
+            self.assertEqual(self.names(value, 8), (10, ['[8]', '[9]']))
+            self.assertEqual(self.names(value, 20), (10, []))
+
+    def test_deque_values(self):
+        total, children = self.inspector.page(self.inspector.ref(deque('abcde')), 3, 5)
+        self.assertEqual([child['value'] for child in children], [repr('d'), repr('e')])
+
+    def test_large_sequence(self):
+        # The indices of a sequence aren't listed up front.
+        value = [0] * 10 ** 6
+        self.assertEqual(self.names(value, 10 ** 6 - 1), (10 ** 6, ['[999999]']))
+        self.assertNotIsInstance(self.inspector.values[self.inspector.ref(value)][1], list)
+
+    def test_mappings_and_objects(self):
+        value = {'b': 1, 'a': 2}
+        self.assertEqual(self.names(value), (2, [repr(key) for key in value]))
+        self.assertEqual(self.names(Point(1, [2])), (2, ['x', 'y']))
+        self.assertEqual(self.names(Point(1, 2), 1), (2, ['y']))
+
+    def test_children(self):
+        total, children = self.inspector.page(self.inspector.ref(Point(1, [2])))
+        self.assertIsNone(children[0]['ref'])
+        self.assertEqual(self.inspector.page(children[1]['ref'])[1][0]['name'], '[0]')
+
+    def test_namespace(self):
+        ref = self.inspector.ref({'b': 1, 'a': 2}, namespace=True)
+        total, children = self.inspector.page(ref)
+        self.assertEqual([child['name'] for child in children], ['a', 'b'])
+
+    def test_unknown_ref(self):
+        with self.assertRaises(KeyError):
+            self.inspector.page(12345)
+
+
+if __name__ == '__main__':
+    unittest.main()
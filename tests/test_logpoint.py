@@ -0,0 +1,42 @@
+from __future__ import unicode_literals
+import sys
+import unittest
+
+from bugjar.net import Logpoint
+
+
+def log(message):
+    "Format `message` as a logpoint hit in the caller's frame."
+    return Logpoint(message).format(sys._getframe(1))
+
+
+class LogpointTest(unittest.TestCase):
+    def test_literal(self):
+        self.assertEqual(log('no fields'), 'no fields')
+        self.assertEqual(log('{{braces}}'), '{braces}')
+
+    def test_expressions(self):
+        items = [1, 2, 3.5]
+        i = 'x'
+        self.assertEqual(log('total is {sum(items):.2f} after {i!r}'), "total is 6.50 after %r" % i)
+        self.assertEqual(log('{len(items)} items, {i!s}{i}'), '3 items, xx')
+
+    def test_ascii(self):
+        name = '\xe9t\xe9'
+        self.assertEqual(log('{name!a}'), ascii(name) if sys.version_info[0] >= 3 else repr(name))
+
+    def test_nested_spec(self):
+        name = 'bob'
+        width = 6
+        places = 3
+        self.assertEqual(log('[{name:>{width}}]'), '[   bob]')
+        self.assertEqual(log('{3.14159:.{places}f} {width:{"<" if width else ">"}{width - 3}}|'), '3.142 6  |')
+
+    def test_invalid(self):
+        for message in ['{}', '{ }', '{x!q}', '{x:{y:{z}}}', '{x', '{sum(}']:
+            with self.assertRaises((ValueError, SyntaxError), msg=message):
+                Logpoint(message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+from __future__ import unicode_literals
+import socket
+import threading
+import unittest
+
+from bugjar import protocol
+from bugjar.protocol import (
+    Channel, ETX_FRAMING, LENGTH_FRAMING, JSONCodec, CODECS, COMPRESSIONS, COMPRESSED, HEADER, SHARED,
+    SharedRing, diff_frame, patch_frame, shared_memory
+)
+
+
+class ChannelTestCase(unittest.TestCase):
+    "Connects pairs of channels, and checks messages sent from one to the other."
+    def connect(self, framing=ETX_FRAMING, codec=JSONCodec):
+        "Connect a sending and a receiving channel, with the given protocol"
+        self.near, self.far = socket.socketpair()
+        self.sender = Channel(self.near)
+        self.receiver = Channel(self.far)
+        for closable in (self.near, self.far, self.sender, self.receiver):
+            self.addCleanup(closable.close)
+        self.sender.framing_out = self.receiver.framing_in = framing
+        self.sender.codec_out = self.receiver.codec_in = codec
+
+    def transfer(self, messages):
+        """Send `messages` (from another thread, so a large message can't
+        fill the socket), and return what was received.
+        """
+        def send():
+            for event, data in messages:
+                self.near.sendall(self.sender.pack(event, data))
+            self.near.shutdown(socket.SHUT_WR)
+        thread = threading.Thread(target=send)
+        thread.start()
+        try:
+            return [self.receiver.unpack(payload) for payload in self.receiver.payloads()]
+        finally:
+            thread.join()
+
+    def assertTransfers(self, messages):
+        received = self.transfer(messages)
+        self.assertEqual([list(message) for message in received], [list(message) for message in messages])
+        self.assertEqual(self.receiver.received, len(messages))
+        self.assertEqual(self.receiver.received_wire_bytes, self.sender.sent_wire_bytes)
+
+
+class ChannelTest(ChannelTestCase):
+    def test_etx_framing(self):
+        self.connect()
+        self.assertTransfers([('stack', {'line': 1}), ('ping', {}), ('text', {'s': '\xe9'})])
+
+    def test_length_framing(self):
+        for codec in CODECS:
+            self.connect(LENGTH_FRAMING, codec)
+            # An ETX byte in a length framed message is just data.
+            self.assertTransfers([('stack', {'line': 1}), ('text', {'s': '\x03'})])
+
+    def test_large_message(self):
+        # A message bigger than the read buffer grows it.
+        for framing in (ETX_FRAMING, LENGTH_FRAMING):
+            self.connect(framing)
+            big = ('stack', {'text': 'x' * (5 * protocol.BUFFER_SIZE)})
+            self.assertTransfers([('first', {}), big, ('last', {})])
+            self.assertTrue(len(self.receiver._buffer) > 5 * protocol.BUFFER_SIZE)
+
+    def test_switch_framing(self):
+        # The framing can change between one message and the next.
+        self.connect()
+        self.near.sendall(self.sender.pack('protocol', {}))
+        self.sender.framing_out = LENGTH_FRAMING
+        self.near.sendall(self.sender.pack('after', {'n': 1}))
+        self.near.shutdown(socket.SHUT_WR)
+        payloads = self.receiver.payloads()
+        self.assertEqual(self.receiver.unpack(next(payloads))[0], 'protocol')
+        self.receiver.framing_in = LENGTH_FRAMING
+        self.assertEqual(self.receiver.unpack(next(payloads))[0], 'after')
+        self.assertEqual(list(payloads), [])
+
+    def test_compression(self):
+        for compression in COMPRESSIONS:
+            self.connect(LENGTH_FRAMING)
+            self.sender.compression_out = compression()
+            self.receiver.compression_in = compression()
+            small = ('small', {'text': 'x' * 10})
+            large = ('large', {'text': 'x' * (2 * protocol.COMPRESS_THRESHOLD)})
+            self.assertTransfers([small, large, small])
+            self.assertTrue(self.sender.sent_wire_bytes < self.sender.sent_bytes)
+
+    def test_compression_threshold(self):
+        self.connect(LENGTH_FRAMING)
+        self.sender.compression_out = protocol.ZlibCompression()
+        # Small messages aren't compressed.
+        message = self.sender.pack('event', {'text': 'x' * 10})
+        self.assertFalse(HEADER.unpack_from(message)[0] & COMPRESSED)
+        # Nor are messages that wouldn't get any smaller.
+        self.sender.threshold = 1
+        message = self.sender.pack('event', {})
+        self.assertFalse(HEADER.unpack_from(message)[0] & COMPRESSED)
+        message = self.sender.pack('event', {'text': 'x' * (2 * protocol.COMPRESS_THRESHOLD)})
+        self.assertTrue(HEADER.unpack_from(message)[0] & COMPRESSED)
+
+    def test_unexpected_compression(self):
+        self.connect(LENGTH_FRAMING)
+        self.sender.compression_out = protocol.ZlibCompression()
+        self.near.sendall(self.sender.pack('large', {'text': 'x' * (2 * protocol.COMPRESS_THRESHOLD)}))
+        with self.assertRaises(ValueError):
+            next(self.receiver.payloads())
+
+
+@unittest.skipIf(shared_memory is None, 'needs multiprocessing.shared_memory')
+class SharedMemoryTest(ChannelTestCase):
+    SIZE = 64 * 1024
+
+    def ring(self, size):
+        """Create a ring, and attach a reader to it.
+
+        attach() stops the resource tracker removing the ring, which is
+        only right in another process; here, the reader shares the
+        writer's registration.
+        """
+        writer = SharedRing.create(size)
+        reader = SharedRing(shared_memory.SharedMemory(writer.name))
+        return writer, reader
+
+    def share(self):
+        "Connect with length framing, sending large messages through a ring"
+        self.connect(LENGTH_FRAMING)
+        # The channels close the rings.
+        self.sender.shared_out, self.receiver.shared_in = self.ring(self.SIZE)
+        self.sender.shared_threshold = 1024
+
+    def test_shared(self):
+        self.share()
+        messages = [('small', {'n': i}) if i % 2 else ('large', {'text': 'x' * 20000}) for i in range(40)]
+        # Whatever doesn't fit in the ring (if the reader falls behind)
+        # goes on the socket.
+        self.assertTransfers(messages)
+        self.assertTrue(self.sender.shared_out.written > 0)
+
+    def test_compressed_and_shared(self):
+        self.share()
+        self.sender.compression_out = protocol.ZlibCompression()
+        self.receiver.compression_in = protocol.ZlibCompression()
+        self.sender.threshold = self.sender.shared_threshold = 100
+        self.assertTransfers([('large', {'text': 'x' * 100000})])
+        self.assertTrue(0 < self.sender.shared_out.written < 1000)
+
+    def test_oversize(self):
+        # A message bigger than the ring goes on the socket.
+        self.share()
+        self.assertTransfers([('huge', {'text': 'x' * (2 * self.SIZE)}), ('small', {})])
+        self.assertEqual(self.sender.shared_out.written, 0)
+
+    def test_ring_full(self):
+        # Until the reader catches up, messages that don't fit go on the
+        # socket.
+        self.share()
+        message = ('large', {'text': 'x' * (self.SIZE // 3)})
+        headers = [HEADER.unpack_from(self.sender.pack(*message))[0] & SHARED for i in range(4)]
+        self.assertEqual(headers, [SHARED, SHARED, 0, 0])
+
+    def test_unexpected_shared(self):
+        self.share()
+        self.addCleanup(self.receiver.shared_in.close)
+        self.receiver.shared_in = None
+        self.near.sendall(self.sender.pack('large', {'text': 'x' * 2048}))
+        with self.assertRaises(ValueError):
+            next(self.receiver.payloads())
+
+    def test_ring(self):
+        writer, reader = self.ring(100)
+        self.addCleanup(writer.close)
+        self.addCleanup(reader.close)
+        locations = [writer.write(payload) for payload in (b'a' * 40, b'b' * 40)]
+        self.assertIsNone(writer.write(b'c' * 40))
+        self.assertEqual([reader.read(location) for location in locations], [b'a' * 40, b'b' * 40])
+        # Once everything has been read, the next message starts at the
+        # beginning of the ring.
+        location = writer.write(b'c' * 40)
+        self.assertEqual(protocol.SHARED_LOCATION.unpack(location)[0] % writer.size, 0)
+        self.assertEqual(reader.read(location), b'c' * 40)
+        self.assertIsNone(writer.write(b'd' * 101))
+
+
+class FrameDeltaTest(unittest.TestCase):
+    FRAME = {
+        'line': 10,
+        'locals': {'a': '1', 'b': "'text'", 'c': '[1, 2]'},
+        'globals': {'x': '1'},
+        'ref': None,
+    }
+
+    def assertRoundTrip(self, old, new):
+        changes = diff_frame(old, new)
+        # Changes go over the wire, so they have to survive encoding.
+        for codec in CODECS:
+            decoded = codec.decode(codec.encode(changes))
+            self.assertEqual(patch_frame(old, decoded), new, codec.name)
+        return changes
+
+    def test_unchanged(self):
+        self.assertEqual(self.assertRoundTrip(self.FRAME, dict(self.FRAME)), {})
+
+    def test_changes(self):
+        new = dict(self.FRAME, line=11, ref=7)
+        new['locals'] = {'a': '2', 'c': '[1, 2]', 'd': 'None'}
+        changes = self.assertRoundTrip(self.FRAME, new)
+        # Only what has changed is sent.
+        self.assertEqual(changes, {'line': 11, 'ref': 7, 'locals': [{'a': '2', 'd': 'None'}, ['b']]})
+
+    def test_replaced_namespace(self):
+        self.assertRoundTrip(self.FRAME, dict(self.FRAME, globals=None))
+        self.assertRoundTrip(dict(self.FRAME, globals=None), self.FRAME)
+
+    def test_new_key(self):
+        self.assertRoundTrip(self.FRAME, dict(self.FRAME, task='main'))
+
+    def test_original_unchanged(self):
+        old = dict(self.FRAME, locals=dict(self.FRAME['locals']))
+        patch_frame(old, diff_frame(old, dict(self.FRAME, locals={})))
+        self.assertEqual(old, self.FRAME)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+from __future__ import unicode_literals
+from collections import OrderedDict, defaultdict, deque
+from threading import Thread
+import time
+import unittest
+
+from bugjar.reprs import SUMMARIZERS, ReprEngine, register_summarizer, type_name
+
+
+def start_thread(target):
+    thread = Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class Slow(object):
+    "A value whose repr takes `delay` seconds"
+    def __init__(self, delay):
+        self.delay = delay
+
+    def __repr__(self):
+        time.sleep(self.delay)
+        return 'Slow(%s)' % self.delay
+
+
+class Custom(dict):
+    def __repr__(self):
+        return 'Custom!'
+
+
+class ReprEngineTest(unittest.TestCase):
+    def test_scalars(self):
+        engine = ReprEngine(max_chars=20)
+        self.assertEqual(engine.repr(42), '42')
+        self.assertEqual(engine.repr(None), 'None')
+        self.assertEqual(engine.repr(str('x') * 100), "'xxxxxxx...xxxxxxxx'")
+
+    def test_max_chars(self):
+        engine = ReprEngine(max_chars=50)
+        for value in [list(range(1000)), {'a': 'b' * 1000}, Slow(0)]:
+            self.assertTrue(len(engine.repr(value)) <= 50)
+
+    def test_python_repr(self):
+        engine = ReprEngine(start_thread=start_thread)
+        try:
+            self.assertEqual(engine.repr(Slow(0)), 'Slow(0)')
+            self.assertEqual(engine.repr([Slow(0)]), '[Slow(0)]')
+        finally:
+            engine.stop()
+
+    def test_timeout(self):
+        engine = ReprEngine(timeout=0.1, start_thread=start_thread)
+        try:
+            self.assertIn('(repr timed out)', engine.repr(Slow(1.0)))
+            # The type is slow from now on; it isn't tried again.
+            start = time.time()
+            self.assertIn('Slow object at', engine.repr(Slow(0)))
+            self.assertTrue(time.time() - start < 0.1)
+            self.assertEqual(engine.skipped, 2)
+        finally:
+            engine.stop()
+
+    def test_budget(self):
+        engine = ReprEngine(timeout=1.0, budget=0.1, start_thread=start_thread)
+        try:
+            engine.reset_budget()
+            self.assertEqual(engine.repr(Slow(0.15)), 'Slow(0.15)')
+            # The budget has run out.
+            self.assertIn('Slow object at', engine.repr(Slow(0)))
+            engine.reset_budget()
+            self.assertEqual(engine.repr(Slow(0)), 'Slow(0)')
+        finally:
+            engine.stop()
+
+    def test_run_python(self):
+        engine = ReprEngine(run_python=False)
+        self.assertIn('Slow object at', engine.repr(Slow(1.0)))
+        self.assertEqual(engine.repr([1, 2]), '[1, 2]')
+
+    def test_containers(self):
+        engine = ReprEngine()
+        self.assertEqual(engine.repr(OrderedDict([(2, 1), (1, 2)])), 'OrderedDict({2: 1, 1: 2})')
+        self.assertEqual(engine.repr(defaultdict(list, {1: [1]})), 'defaultdict(%r, {1: [1]})' % list)
+        self.assertEqual(engine.repr(deque([1, 2])), 'deque([1, 2])')
+        self.assertEqual(engine.repr(bytearray(b'ab')), 'bytearray(%r)' % b'ab')
+        # Items are listed in the dict's own order, not sorted.
+        value = {'b': 1, 'a': 2}
+        self.assertEqual(engine.repr(value), repr(value))
+        self.assertEqual(engine.repr(frozenset()), 'frozenset()')
+        # A container with a __repr__ of its own is asked for it.
+        self.assertEqual(engine.repr(Custom()), 'Custom!')
+
+    def test_large_containers(self):
+        # Containers with a repr written in C are abbreviated, without
+        # a full repr being made first.
+        engine = ReprEngine()
+        for value in [
+                defaultdict(list, ((i, [i]) for i in range(300000))),
+                OrderedDict((i, i) for i in range(300000)),
+                set(range(300000)),
+                bytearray(50 * 1024 * 1024),
+                b'x' * (50 * 1024 * 1024)]:
+            start = time.time()
+            text = engine.repr(value)
+            self.assertTrue(time.time() - start < 0.1, type(value))
+            self.assertTrue(len(text) <= engine.max_chars, type(value))
+            self.assertIn('...', text)
+
+    def test_summarizer(self):
+        register_summarizer(type_name(Slow), lambda value: 'a slow value')
+        try:
+            engine = ReprEngine()
+            self.assertEqual(engine.repr(Slow(1.0)), 'a slow value')
+            self.assertEqual(engine.repr([Slow(1.0)]), '[a slow value]')
+        finally:
+            del SUMMARIZERS[type_name(Slow)]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+from __future__ import unicode_literals
+import sys
+import unittest
+
+from bugjar.watchpoints import MISSING, Watchpoint, Watchpoints, dotted_names, fingerprint, unchanged
+
+counter = 0
+
+
+class State(object):
+    def __init__(self):
+        self.state = 'idle'
+
+
+def same(old, new):
+    return unchanged(fingerprint(old), fingerprint(new))
+
+
+class FingerprintTest(unittest.TestCase):
+    def test_scalars(self):
+        # Immutable scalars are compared by value (and type).
+        self.assertTrue(same(1000, int('1000')))
+        self.assertTrue(same('text', ''.join(['te', 'xt'])))
+        self.assertFalse(same(1, 2))
+        self.assertFalse(same(1, True))
+        self.assertFalse(same(1, 1.0))
+        self.assertTrue(same(None, None))
+
+    def test_nan(self):
+        nan = float('nan')
+        self.assertTrue(same(nan, nan))
+
+    def test_containers(self):
+        # A builtin container changes when its length does, but not when
+        # an element is changed in place.
+        items = [1, 2]
+        before = fingerprint(items)
+        items[0] = 3
+        self.assertTrue(unchanged(before, fingerprint(items)))
+        items.append(4)
+        self.assertFalse(unchanged(before, fingerprint(items)))
+        self.assertFalse(same([1, 2], [1, 2]))
+
+    def test_objects(self):
+        value = State()
+        before = fingerprint(value)
+        value.state = 'busy'
+        self.assertTrue(unchanged(before, fingerprint(value)))
+        self.assertFalse(same(State(), value))
+        self.assertFalse(same(MISSING, value))
+
+
+class WatchpointTest(unittest.TestCase):
+    def test_dotted_names(self):
+        self.assertEqual(dotted_names('x'), ['x'])
+        self.assertEqual(dotted_names(' self.state.name '), ['self', 'state', 'name'])
+        for expression in ['x[0]', 'f()', 'a + b', 'x.', '']:
+            with self.assertRaises(ValueError):
+                dotted_names(expression)
+
+    def test_global(self):
+        watchpoint = Watchpoint(1, 'counter', sys._getframe(), repr)
+        self.assertIs(watchpoint.namespace, globals())
+        self.assertEqual(watchpoint.repr, repr(counter))
+        self.assertTrue(watchpoint.can_change(increment.__code__))
+        self.assertFalse(watchpoint.can_change(State.__init__.__code__))
+        watchpoint = Watchpoint(2, 'undefined_name', sys._getframe(), repr)
+        self.assertIs(watchpoint.value(), MISSING)
+        self.assertEqual(watchpoint.repr, '<not defined>')
+
+    def test_local(self):
+        total = 1
+        watchpoint = Watchpoint(1, 'total', sys._getframe(), repr)
+        self.assertIs(watchpoint.frame, sys._getframe())
+        self.assertEqual(watchpoint.value(), 1)
+        self.assertTrue(watchpoint.can_change(self.test_local.__code__))
+        self.assertFalse(watchpoint.can_change(increment.__code__))
+
+    def test_attribute(self):
+        # The object is found once, when the watchpoint is set.
+        machine = State()
+        watchpoint = Watchpoint(1, 'machine.state', sys._getframe(), repr)
+        machine.state = 'busy'
+        machine = None
+        self.assertEqual(watchpoint.value(), 'busy')
+        self.assertTrue(watchpoint.is_attribute)
+        self.assertTrue(watchpoint.can_change(State.__init__.__code__))
+
+
+def increment():
+    global counter
+    counter += 1
+    return sys._getframe()
+
+
+class WatchpointsTest(unittest.TestCase):
+    def setUp(self):
+        self.changes = []
+        self.watchpoints = Watchpoints(lambda *args: self.changes.append(args))
+        self.watchpoint = Watchpoint(1, 'counter', sys._getframe(), repr)
+        self.watchpoints.add(self.watchpoint)
+
+    def test_check(self):
+        frame = increment()
+        self.assertTrue(self.watchpoints.observe(frame, 'line'))
+        watchpoint, changed_in, old, new = self.changes[0]
+        self.assertIs(watchpoint, self.watchpoint)
+        self.assertIs(changed_in, frame)
+        self.assertEqual(int(new), int(old) + 1)
+        # Nothing has changed since.
+        self.assertFalse(self.watchpoints.observe(frame, 'line'))
+        self.assertEqual(len(self.changes), 1)
+
+    def test_only_code_that_can_change(self):
+        self.assertEqual(self.watchpoints.watching(State.__init__.__code__), ())
+        self.assertEqual(self.watchpoints.watching(increment.__code__), (self.watchpoint,))
+        # Only lines and returns are checked.
+        frame = increment()
+        self.assertFalse(self.watchpoints.observe(frame, 'call'))
+        self.assertTrue(self.watchpoints.observe(frame, 'return'))
+
+    def test_remove(self):
+        self.assertIs(self.watchpoints.remove(1), self.watchpoint)
+        self.assertIsNone(self.watchpoints.remove(1))
+        self.assertFalse(self.watchpoints.observe(increment(), 'line'))
+        self.assertEqual(len(self.watchpoints), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()